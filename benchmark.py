@@ -0,0 +1,588 @@
+"""
+Benchmarks of yaml4schm's build
+
+Every benchmark generates it's input into a temporary directory and prints time that is spent per node
+by every stage of the build, so results of different versions of the tool could be compared
+
+Usage:
+    python benchmark.py hierarchy --depth 1000 --width 1
+    python benchmark.py hierarchy --depth 4 --width 12
+    python benchmark.py postprocess --depth 3 --width 223
+    python benchmark.py memory --depth 3 --width 223
+    python benchmark.py connect --units 1000 2000 4000 8000
+    python benchmark.py fanout --flops 250 500 1000 2000
+    python benchmark.py fanout --flops 250 500 --sources 4
+    python benchmark.py operators --operands 10 100 1000
+"""
+import gc
+import os
+import glob
+import sys
+import json
+import time
+import tempfile
+import shutil
+import argparse
+import resource
+import subprocess
+import yaml
+import yaml4schm
+import operators
+from yaml4schm_defs import TOOL_HDELK, TOOL_D3HW, RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS
+
+_OPTIONS = (RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS)
+
+
+def generate_hierarchy(path: str, depth: int, width: int) -> str:
+    """
+    Generates hierarchy of units, every level of hierarchy is described by it's own file
+    and contains `width` instances of the next level's unit, connected in chain
+    :param path: directory for generated files
+    :param depth: levels of hierarchy
+    :param width: nested units per unit
+    :return: path of top unit's file
+    """
+    for level in range(depth):
+        lines = []
+        if level == 0:
+            lines += ["display:", "  '.*': {view: nested}"]
+        lines += ["io:", "  I: {dir: in}", "  O: {dir: out}"]
+        if level < depth - 1:
+            lines += ["units:"]
+            lines += [f"  U{i}: {{unit: level{level + 1}.yaml}}" for i in range(width)]
+            lines += ["nets:", "  - [.I, U0.I]"]
+            lines += [f"  - [U{i - 1}.O, U{i}.I]" for i in range(1, width)]
+            lines += [f"  - [U{width - 1}.O, .O]"]
+        with open(os.path.join(path, f"level{level}.yaml"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    return os.path.join(path, "level0.yaml")
+
+
+def generate_flat(path: str, units: int) -> str:
+    """
+    Generates single unit with `units` instances of a leaf unit, connected in chain
+    by nets of the instances (self-relative endpoints), so every net has it's endpoints in two instances
+    :param path: directory for generated files
+    :param units: nested units
+    :return: path of top unit's file
+    """
+    with open(os.path.join(path, "leaf.yaml"), "w") as f:
+        f.write("io:\n  I: {dir: in}\n  O: {dir: out}\n")
+    lines = ["io:", "  I: {dir: in}", "  O: {dir: out}", "units:"]
+    for i in range(units):
+        lines += [f"  U{i}:", "    unit: leaf.yaml"]
+        if i < units - 1:
+            lines += ["    nets:", f"      - [.O, U{i + 1}.I]"]
+    lines += ["nets:", "  - [.I, U0.I]", f"  - [U{units - 1}.O, .O]"]
+    with open(os.path.join(path, "top.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return os.path.join(path, "top.yaml")
+
+
+def generate_fanout(path: str, flops: int, sources: int) -> str:
+    """
+    Generates unit with `flops` flip-flops that share single clock net, driven by `sources` drivers
+    :param path: directory for generated files
+    :param flops: nested units driven by the net
+    :param sources: nested units that drive the net
+    :return: path of top unit's file
+    """
+    with open(os.path.join(path, "ff.yaml"), "w") as f:
+        f.write("io:\n  D: {dir: in}\n  C: {dir: in}\n  Q: {dir: out}\n")
+    with open(os.path.join(path, "drv.yaml"), "w") as f:
+        f.write("io:\n  O: {dir: out}\n")
+    lines = ["units:"]
+    lines += [f"  DRV{i}: {{unit: drv.yaml}}" for i in range(sources)]
+    lines += [f"  FF{i}: {{unit: ff.yaml}}" for i in range(flops)]
+    lines += ["nets:", "  - {srcr: 'DRV\\d+\\.O', dstr: 'FF\\d+\\.C', name: CLK}"]
+    with open(os.path.join(path, "top.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return os.path.join(path, "top.yaml")
+
+
+def _count_nodes(schm: dict) -> int:
+    nodes = 0
+    stack = [schm]
+    while len(stack) > 0:
+        nodes += 1
+        stack.extend(stack.pop().get("children", []))
+    return nodes
+
+
+def measure_build(tool: str, filepath: str, repeat: int) -> tuple:
+    """
+    Builds schematic stage by stage
+    :return: tuple with count of rendered nodes (units and top unit's ports) and dict with best time
+        of every stage (in seconds)
+    """
+    best = {}
+    nodes = 0
+    for _ in range(repeat):
+        times = {}
+        t = time.perf_counter()
+        ctx = yaml4schm.BuildContext()
+        data = yaml4schm.load_unit(filepath, "", "", {}, None, ctx=ctx)
+        times["load"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        meta = yaml4schm.RenderMeta()
+        schm = yaml4schm.render_unit(tool, data, "", is_top=True, custom=data,
+                                     templates=yaml4schm.RenderTemplates(ctx), meta=meta)
+        times["render"] = time.perf_counter() - t
+        nodes = _count_nodes(schm)
+
+        t = time.perf_counter()
+        yaml4schm.connect(tool, schm, _OPTIONS, meta)
+        times["connect"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        yaml4schm.renderer(tool, schm)
+        yaml4schm.postprocess(tool, schm, meta)
+        times["postprocess"] = time.perf_counter() - t
+
+        for k, v in times.items():
+            best[k] = min(best.get(k, v), v)
+    return nodes, best
+
+
+def _report(nodes: int, times: dict, total: str = None) -> None:
+    if total is not None:
+        times = {**times, total: sum(times.values())}
+    print(f"{'stage':<12} {'total, ms':>12} {'per node, us':>14}")
+    for k, v in times.items():
+        print(f"{k:<12} {v * 1e3:>12.1f} {v * 1e6 / nodes:>14.1f}")
+
+
+def adaptation_passes(tool: str, schm: dict, meta: "yaml4schm.RenderMeta") -> None:
+    """
+    Reference implementation of yaml4schm.postprocess: the same per-unit steps, but a walk over units per step
+    (as it were before steps were fused), so single pass is compared with it
+    """
+    if tool == TOOL_HDELK:
+        yaml4schm.hdelk_adaptation(schm, meta)
+        return
+    for step in (yaml4schm._d3hw_unit_defaults, yaml4schm._d3hw_unit_ports, yaml4schm._d3hw_unit_map_ids):
+        for unit in yaml4schm._walk_tree(schm):
+            step(unit, meta)
+    stack = [schm]
+    while len(stack) > 0:
+        unit = stack.pop()
+        stack.extend(unit.get("children", []))  # NOTE: content of unit is walked before it's hidden
+        yaml4schm._d3hw_unit_hide_content(unit, meta)
+
+
+def measure_postprocess(tool: str, filepath: str, repeat: int) -> tuple:
+    """
+    Compares separate passes of tool adaptation with single pass postprocessing
+    :return: tuple with count of rendered nodes, dict with best time of every way (in seconds)
+        and flag whether results are the same
+    """
+    ctx = yaml4schm.BuildContext()
+    data = yaml4schm.load_unit(filepath, "", "", {}, None, ctx=ctx)
+    meta = yaml4schm.RenderMeta()
+    schm = yaml4schm.render_unit(tool, data, "", is_top=True, custom=data, templates=yaml4schm.RenderTemplates(ctx),
+                                 meta=meta)
+    nodes = _count_nodes(schm)
+    yaml4schm.connect(tool, schm, _OPTIONS, meta)
+
+    def _copy(schm):
+        result_meta = yaml4schm.RenderMeta()
+        return yaml4schm._relocate(schm, "/", "/", meta, result_meta), result_meta
+
+    def _passes(schm, meta):
+        adaptation_passes(tool, schm, meta)
+
+    def _single_pass(schm, meta):
+        yaml4schm.postprocess(tool, schm, meta)
+
+    best = {}
+    results = {}
+    ways = [("passes", _passes), ("single pass", _single_pass)]
+    for _ in range(repeat):
+        for name, func in ways:
+            result, result_meta = _copy(schm)
+            gc.disable()    # NOTE: as timeit does, otherwise collections of previous results are measured
+            t = time.perf_counter()
+            func(result, result_meta)
+            t = time.perf_counter() - t
+            gc.enable()
+            best[name] = min(best.get(name, t), t)
+            results[name] = result
+        ways.reverse()
+    same = len(set(json.dumps(v) for v in results.values())) == 1
+    return nodes, best, same
+
+
+def measure_connect(tool: str, filepath: str, repeat: int) -> tuple:
+    """
+    Connects rendered schematic (it's rendered again for every measurement, as connect modifies it)
+    :return: tuple with count of net endpoints and best time of connect (in seconds)
+    """
+    ctx = yaml4schm.BuildContext()
+    data = yaml4schm.load_unit(filepath, "", "", {}, None, ctx=ctx)
+    best = None
+    endpoints = 0
+    for _ in range(repeat):
+        meta = yaml4schm.RenderMeta()
+        schm = yaml4schm.render_unit(tool, data, "", is_top=True, custom=data,
+                                     templates=yaml4schm.RenderTemplates(ctx), meta=meta)
+        t = time.perf_counter()
+        yaml4schm.connect(tool, schm, _OPTIONS, meta)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+        endpoints = sum(len(v["sources"]) + len(v["targets"])
+                        for v in (meta.get(schm, "connected_nets") or {}).values())
+    return endpoints, best
+
+
+# Lays out HDElk schematic (read from stdin) with ELK the same way as hdelk.js does, but text sizes are estimated,
+# prints layout time in milliseconds
+_ELK_LAYOUT_JS = """
+const ELK = require(process.argv[1]);
+const sides = {inPorts: "WEST", outPorts: "EAST", northPorts: "NORTH", southPorts: "SOUTH"};
+function transform(node) {
+    node.width = node.width || 60;
+    node.height = node.height || 40;
+    node.ports = node.ports || [];
+    for (const [group, side] of Object.entries(sides)) {
+        (node[group] || []).forEach(function(p) {
+            node.ports.push({id: p.id, width: 8, height: 8, layoutOptions: {"elk.port.side": side}});
+        });
+        delete node[group];
+    }
+    node.layoutOptions = {"elk.portConstraints": "FIXED_SIDE"};
+    (node.edges || []).forEach(function(e, i) {
+        e.id = e.id || node.id + "E" + i;
+        if (e.label) {
+            e.labels = [{text: e.label, width: 7 * e.label.length, height: 12}];
+        }
+    });
+    (node.children || []).forEach(transform);
+}
+let data = "";
+process.stdin.on("data", chunk => data += chunk);
+process.stdin.on("end", function() {
+    const graph = JSON.parse(data);
+    transform(graph);
+    const t = process.hrtime.bigint();
+    new ELK().layout(graph).then(function() {
+        console.log(Number(process.hrtime.bigint() - t) / 1e6);
+    });
+});
+"""
+_ELK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo", "html", "js", "hdelk", "elk.bundled.js")
+
+
+def _elk_layout(schm: dict) -> float or None:
+    """ Returns ELK layout time of HDElk schematic (in seconds) or None if Node.js isn't available """
+    node = shutil.which("node")
+    if node is None or not os.path.exists(_ELK_PATH):
+        return None
+    result = subprocess.run([node, "-e", _ELK_LAYOUT_JS, _ELK_PATH], input=json.dumps(schm),
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout) / 1e3
+
+
+def measure_fanout(filepath: str, fanout: int, repeat: int) -> tuple:
+    """
+    Builds HDElk schematic with given fan-out threshold of junctions (see yaml4schm._HDELK_FANOUT)
+    :return: tuple with count of edges, size of HTML page (in bytes) and best time of build and of layout
+        (in seconds, layout time is None if it isn't measured)
+    """
+    yaml4schm._HDELK_FANOUT = fanout
+    best = {}
+    for _ in range(repeat):
+        t = time.perf_counter()
+        _, schm = yaml4schm.build(TOOL_HDELK, filepath)
+        t = time.perf_counter() - t
+        best["build"] = min(best.get("build", t), t)
+        layout = _elk_layout(schm)
+        if layout is not None:
+            best["layout"] = min(best.get("layout", layout), layout)
+    edges = len(schm.get("edges", []))
+    return edges, len(yaml4schm.tool_html(TOOL_HDELK, schm)), best["build"], best.get("layout", None)
+
+
+def generate_expressions(operands: int) -> list:
+    """
+    Generates operator expressions of given amount of operands: a long operation,
+    an operation with unit's port map for every operand and `operands` nested parentheses
+    :param operands: amount of operands in every expression
+    :return: list of expressions
+    """
+    signals = [f"/sub{i % 10}/s.S{i}" for i in range(operands)]
+    port_maps = [f"~MUX(/.A{i}, {signals[i]}, $~/.SEL, @/.CLK, #/.RST, d:/.D)" for i in range(operands)]
+    return [
+        " and ".join(signals),
+        " or ".join(port_maps),
+        "(" * operands + " xor ".join(signals[:2]) + ")" * operands,
+    ]
+
+
+def _yaml_expressions(data) -> list:
+    """ Returns operator expressions of YAML description, including ones of it's nested units """
+    result = []
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == "operators" and isinstance(v, dict):
+                result += [e for e in v.values() if isinstance(e, str)]
+            else:
+                result += _yaml_expressions(v)
+    elif isinstance(data, list):
+        for v in data:
+            result += _yaml_expressions(v)
+    return result
+
+
+def expression_corpus(files: list) -> list:
+    """
+    Collects operator expressions of operators._TESTS and of given YAML files
+    :param files: YAML files to take expressions from
+    :return: list of expressions
+    """
+    result = []
+    for test in operators._TESTS.values():
+        if "\n" not in test.strip():
+            result.append(test)
+        else:
+            result += _yaml_expressions(yaml.safe_load(test))
+    for filepath in files:
+        with open(filepath, "r") as f:
+            try:
+                result += _yaml_expressions(yaml.safe_load(f))
+            except yaml.YAMLError:
+                pass
+    return result
+
+
+def measure_parse(expressions: list, repeat: int) -> tuple:
+    """
+    Parses every expression by operators.parse_line
+    :return: tuple with count of expressions that failed to parse and best time of parsing all of them (in seconds)
+    """
+    best = None
+    for _ in range(repeat):
+        errors = 0
+        t = time.perf_counter()
+        for line in expressions:
+            try:
+                operators.parse_line(line, operators.Expression("", [0]))
+            except (ValueError, NotImplementedError):
+                errors += 1
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return errors, best
+
+
+def _peak_rss() -> int:
+    """ Returns peak resident set size of the process (in bytes) """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024    # NOTE: Linux reports it in kilobytes
+
+
+def measure_memory(tool: str, filepath: str) -> tuple:
+    """
+    Builds schematic once (peak memory of the process can't be reset, so measurement isn't repeated)
+    :return: tuple with count of rendered nodes, peak RSS of the process before and after the build
+        and size of schematic's JSON (in bytes, None if schematic is too deep for json's encoder)
+    """
+    before = _peak_rss()
+    _, schm = yaml4schm.build(tool, filepath)
+    after = _peak_rss()
+    try:
+        size = len(json.dumps(schm))
+    except RecursionError:
+        size = None     # NOTE: json's encoder is recursive
+    return _count_nodes(schm), before, after, size
+
+
+def bench_hierarchy(args) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        filepath = generate_hierarchy(path, args.depth, args.width)
+        nodes, times = measure_build(args.tool, filepath, args.repeat)
+    print(f"Hierarchy of depth {args.depth} and width {args.width}: {nodes} nodes, tool {args.tool}, "
+          f"best of {args.repeat}")
+    _report(nodes, times, "build")
+
+
+def bench_postprocess(args) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        filepath = generate_hierarchy(path, args.depth, args.width)
+        nodes, times, same = measure_postprocess(args.tool, filepath, args.repeat)
+    print(f"Postprocessing of hierarchy of depth {args.depth} and width {args.width}: {nodes} nodes, "
+          f"tool {args.tool}, best of {args.repeat}, results are {['different', 'the same'][same]}")
+    _report(nodes, times)
+
+
+def bench_memory(args) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        filepath = generate_hierarchy(path, args.depth, args.width)
+        nodes, before, after, size = measure_memory(args.tool, filepath)
+    print(f"Build of hierarchy of depth {args.depth} and width {args.width}: {nodes} nodes, tool {args.tool}")
+    print(f"{'':<16} {'total, MB':>12} {'per node, KB':>14}")
+    for k, v in (("peak RSS", after), ("build's peak", after - before), ("JSON", size)):
+        if v is not None:
+            print(f"{k:<16} {v / 2**20:>12.1f} {v / 2**10 / nodes:>14.2f}")
+
+
+def bench_connect(args) -> None:
+    print(f"Connect of flat unit with chained instances, tool {args.tool}, best of {args.repeat}")
+    print(f"{'units':>8} {'endpoints':>10} {'total, ms':>12} {'per endpoint, us':>18}")
+    for units in args.units:
+        with tempfile.TemporaryDirectory() as path:
+            filepath = generate_flat(path, units)
+            endpoints, t = measure_connect(args.tool, filepath, args.repeat)
+        print(f"{units:>8} {endpoints:>10} {t * 1e3:>12.1f} {t * 1e6 / endpoints:>18.1f}")
+
+
+def bench_fanout(args) -> None:
+    print(f"HDElk schematic of flip-flops with shared clock of {args.sources} driver(s), "
+          f"junction above fan-out of {args.threshold}, best of {args.repeat}")
+    print(f"{'flops':>8} {'way':<10} {'edges':>8} {'page, KB':>10} {'build, ms':>11} {'layout, ms':>12}")
+    for flops in args.flops:
+        with tempfile.TemporaryDirectory() as path:
+            filepath = generate_fanout(path, flops, args.sources)
+            for way, fanout in (("pairs", 0), ("junction", args.threshold)):
+                edges, size, build, layout = measure_fanout(filepath, fanout, args.repeat)
+                layout = "n/a" if layout is None else f"{layout * 1e3:.1f}"
+                print(f"{flops:>8} {way:<10} {edges:>8} {size / 2**10:>10.1f} {build * 1e3:>11.1f} {layout:>12}")
+
+
+def bench_operators(args) -> None:
+    print(f"Parsing of operator expressions, each parsed {args.times} times, best of {args.repeat}")
+    print(f"{'expressions':<24} {'count':>6} {'errors':>7} {'chars':>9} {'total, ms':>12} {'per char, us':>14}")
+    sets = [("corpus", expression_corpus(args.files))]
+    sets += [(f"{n} operands", generate_expressions(n)) for n in args.operands]
+    for name, expressions in sets:
+        errors, t = measure_parse(expressions * args.times, args.repeat)
+        chars = sum(len(e) for e in expressions) * args.times
+        print(f"{name:<24} {len(expressions):>6} {errors:>7} {chars:>9} {t * 1e3:>12.1f} {t * 1e6 / chars:>14.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    hierarchy = subparsers.add_parser("hierarchy",
+                                      help="Build of generated hierarchy (deep one is a chain, wide one is a tree)")
+    hierarchy.add_argument("--depth",
+                           default=100,
+                           dest="depth",
+                           help="Levels of hierarchy",
+                           type=int)
+    hierarchy.add_argument("--width",
+                           default=1,
+                           dest="width",
+                           help="Nested units per unit",
+                           type=int)
+    hierarchy.set_defaults(func=bench_hierarchy)
+
+    postprocess = subparsers.add_parser("postprocess",
+                                        help="Tool adaptation of generated hierarchy's schematic "
+                                             "by separate passes and by single pass")
+    postprocess.add_argument("--depth",
+                             default=3,
+                             dest="depth",
+                             help="Levels of hierarchy",
+                             type=int)
+    postprocess.add_argument("--width",
+                             default=223,
+                             dest="width",
+                             help="Nested units per unit",
+                             type=int)
+    postprocess.set_defaults(func=bench_postprocess)
+
+    memory = subparsers.add_parser("memory",
+                                   help="Peak memory of generated hierarchy's build (run it in a separate process "
+                                        "for every measurement)")
+    memory.add_argument("--depth",
+                        default=3,
+                        dest="depth",
+                        help="Levels of hierarchy",
+                        type=int)
+    memory.add_argument("--width",
+                        default=223,
+                        dest="width",
+                        help="Nested units per unit",
+                        type=int)
+    memory.set_defaults(func=bench_memory)
+
+    connect = subparsers.add_parser("connect",
+                                    help="Connect of generated flat unit, time per endpoint should not depend "
+                                         "on amount of units")
+    connect.add_argument("--units",
+                         default=[1000, 2000, 4000, 8000],
+                         dest="units",
+                         help="Amounts of nested units to measure",
+                         nargs="+",
+                         type=int)
+    connect.set_defaults(func=bench_connect)
+
+    fanout = subparsers.add_parser("fanout",
+                                   help="HDElk schematic with high fan-out net drawn by edge per target and "
+                                        "thru junction node: page size, build and ELK layout time (needs Node.js)")
+    fanout.add_argument("--flops",
+                        default=[250, 500, 1000, 2000],
+                        dest="flops",
+                        help="Amounts of flip-flops driven by the net",
+                        nargs="+",
+                        type=int)
+    fanout.add_argument("--sources",
+                        default=1,
+                        dest="sources",
+                        help="Amount of drivers of the net",
+                        type=int)
+    fanout.add_argument("--threshold",
+                        default=16,
+                        dest="threshold",
+                        help="Fan-out above which net is drawn thru junction",
+                        type=int)
+    fanout.set_defaults(func=bench_fanout)
+
+    operators_parser = subparsers.add_parser("operators",
+                                             help="Parsing of operator expressions: ones of operators._TESTS "
+                                                  "and of YAML files and generated ones")
+    operators_parser.add_argument("--operands",
+                                  default=[10, 100, 1000],
+                                  dest="operands",
+                                  help="Amounts of operands of generated expressions",
+                                  nargs="+",
+                                  type=int)
+    operators_parser.add_argument("--files",
+                                  default=sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                        "demo", "*.yaml"))),
+                                  dest="files",
+                                  help="YAML files to take operator expressions from",
+                                  nargs="*",
+                                  type=str)
+    operators_parser.add_argument("--times",
+                                  default=100,
+                                  dest="times",
+                                  help="Times every expression is parsed per measurement",
+                                  type=int)
+    operators_parser.set_defaults(func=bench_operators)
+
+    for p in subparsers.choices.values():
+        if p is fanout or p is operators_parser:
+            p.add_argument("--repeat",
+                           default=3,
+                           dest="repeat",
+                           help="Times to repeat every measurement, best time is reported",
+                           type=int)
+            continue
+        p.add_argument("-t", "--tool",
+                       choices=(TOOL_HDELK, TOOL_D3HW),
+                       default=TOOL_D3HW,
+                       dest="tool",
+                       help="Target rendering tool",
+                       type=str)
+        if p is not memory:
+            p.add_argument("--repeat",
+                           default=3,
+                           dest="repeat",
+                           help="Times to repeat every measurement, best time is reported",
+                           type=int)
+
+    args = parser.parse_args()
+    args.func(args)
+    sys.exit(0)
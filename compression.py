@@ -0,0 +1,132 @@
+"""
+WSGI middleware that compresses responses
+
+Responses are gzipped when client accepts it, response is big enough and it's content is worth to compress
+Compressed bodies are kept in LRU cache keyed by body digest, so repeated responses
+(i.e. same schematic requested again) are served without compressing again
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from static_assets import accepts_encoding, compressible
+
+_MIN_SIZE = 1024                # Smaller responses aren't compressed
+_LEVEL = 5                      # Compresses d3hw JSON ~10x, twice faster than default level 6 for about same ratio
+_CACHE_SIZE = 32 * 1024 * 1024  # Max total size of cached compressed bodies, bytes
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses of wrapped WSGI application
+    """
+
+    def __init__(self, app, min_size: int = _MIN_SIZE, level: int = _LEVEL, cache_size: int = _CACHE_SIZE):
+        """
+        :param app: WSGI application
+        :param min_size: responses smaller than that aren't compressed
+        :param level: gzip compression level
+        :param cache_size: max total size of cached compressed bodies, 0 disables cache
+        """
+        self._app = app
+        self._min_size = min_size
+        self._level = level
+        self._cache_size = cache_size
+        self._cached = OrderedDict()    # Body digest -> compressed body
+        self._cached_size = 0
+        self._mutex = threading.Lock()
+
+    def _compress(self, body):
+        if self._cache_size == 0:
+            return gzip.compress(body, self._level, mtime=0)
+        digest = hashlib.sha1(body).digest() + len(body).to_bytes(8, "little")
+        with self._mutex:
+            compressed = self._cached.get(digest, None)
+            if compressed is not None:
+                self._cached.move_to_end(digest)
+                return compressed
+        compressed = gzip.compress(body, self._level, mtime=0)
+        if len(compressed) > self._cache_size:
+            return compressed
+        with self._mutex:
+            if digest not in self._cached:
+                self._cached[digest] = compressed
+                self._cached_size += len(compressed)
+                while self._cached_size > self._cache_size:
+                    _, dropped = self._cached.popitem(last=False)
+                    self._cached_size -= len(dropped)
+        return compressed
+
+    @staticmethod
+    def _header(headers, name):
+        name = name.lower()
+        for k, v in headers:
+            if k.lower() == name:
+                return v
+        return None
+
+    def _varies(self, headers):
+        """ Checks whether response could be compressed for some clients and not for others """
+        return self._header(headers, "Content-Encoding") is None and \
+            compressible(self._header(headers, "Content-Type"))
+
+    def _vary(self, headers):
+        """
+        Returns headers with Accept-Encoding in Vary, so shared caches don't serve compressed response
+        to clients that don't accept it or vice versa
+        """
+        vary = self._header(headers, "Vary")
+        if vary is None:
+            return headers + [("Vary", "Accept-Encoding")]
+        if "accept-encoding" in [v.strip().lower() for v in vary.split(",")]:
+            return headers
+        return [(k, v) for k, v in headers if k.lower() != "vary"] + [("Vary", vary + ", Accept-Encoding")]
+
+    def _should_compress(self, environ, status, headers, size):
+        if size < self._min_size or environ.get("REQUEST_METHOD") == "HEAD" or status[:3] != "200":
+            return False
+        if self._header(headers, "Content-Encoding") is not None:
+            return False
+        if self._header(headers, "ETag") is not None:
+            # NOTE: responses with ETag (static files) care about their encoding themselves
+            return False
+        return compressible(self._header(headers, "Content-Type"))
+
+    def __call__(self, environ, start_response):
+        if not accepts_encoding(environ.get("HTTP_ACCEPT_ENCODING"), "gzip"):
+            def _plain_start_response(status, headers, exc_info=None):
+                if self._varies(headers):
+                    headers = self._vary(headers)
+                return start_response(status, headers, exc_info)
+
+            return self._app(environ, _plain_start_response)
+
+        response = {}
+        chunks = []
+
+        def _start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            response["exc_info"] = exc_info
+            return chunks.append
+
+        result = self._app(environ, _start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        body = b"".join(chunks)
+
+        status, headers = response["status"], response["headers"]
+        if self._should_compress(environ, status, headers, len(body)):
+            body = self._compress(body)
+            headers = self._vary([(k, v) for k, v in headers if k.lower() != "content-length"])
+            headers += [
+                ("Content-Encoding", "gzip"),
+                ("Content-Length", str(len(body))),
+            ]
+        elif self._varies(headers):
+            headers = self._vary(headers)
+        start_response(status, headers, response["exc_info"])
+        return [body]
@@ -0,0 +1,81 @@
+// Content of collapsed units (marked with hwMeta.lazy) isn't sent with the page, it's requested when unit is expanded
+//
+// Fetched content is merged into source data of the diagram (d3-hwschematic's input format) and whole diagram
+// is bound again with HwSchematic.bindData, so d3-hwschematic prepares it the same way as a page with all content.
+// Only the input format (children / _children, edges / _edges, hwMeta) is used here, not the library's internals.
+// Source data is never passed to bindData itself (it's changed in place there), a copy of it is.
+(function(exports) {
+
+    function walk(node, fn) {
+        var stack = [node];
+        while (stack.length > 0) {
+            var n = stack.pop();
+            fn(n);
+            (n.children || []).forEach(function(c) { stack.push(c); });
+            (n._children || []).forEach(function(c) { stack.push(c); });
+        }
+    }
+
+    function findNode(graph, id) {
+        var result = null;
+        walk(graph, function(n) {
+            if (n.id === id) {
+                result = n;
+            }
+        });
+        return result;
+    }
+
+    // Ids of expanded units of graph
+    function expandedIds(graph) {
+        var result = new Set();
+        walk(graph, function(n) {
+            if ((n.children !== undefined) && (n.children !== null) && (n.children.length > 0)) {
+                result.add(n.id);
+            }
+        });
+        return result;
+    }
+
+    // Puts fetched content of collapsed unit into source data, unit is left collapsed there
+    function merge(source, id, content) {
+        var node = findNode(source, id);
+        if (node === null) {
+            return false;
+        }
+        node._children = content.children;
+        node._edges = content.edges;
+        delete node.hwMeta.lazy;
+        return true;
+    }
+
+    // Returns copy of source data where units with given ids are expanded and the rest are collapsed
+    function prepare(source, expanded) {
+        var graph = JSON.parse(JSON.stringify(source));
+        walk(graph, function(n) {
+            var isExpanded = (n.children !== undefined) && (n.children !== null) && (n.children.length > 0);
+            var canExpand = (n._children !== undefined) && (n._children !== null);
+            if ((n === graph) || (expanded.has(n.id) === isExpanded) || (!isExpanded && !canExpand)) {
+                return;
+            }
+            var children = n.children;
+            var edges = n.edges;
+            n.children = n._children;
+            n.edges = n._edges;
+            n._children = children;
+            n._edges = edges;
+            ["children", "edges", "_children", "_edges"].forEach(function(k) {
+                if (n[k] === undefined) {
+                    delete n[k];
+                }
+            });
+        });
+        return graph;
+    }
+
+    exports.findNode = findNode;
+    exports.expandedIds = expandedIds;
+    exports.merge = merge;
+    exports.prepare = prepare;
+
+})(typeof module !== "undefined" ? module.exports : (window.yaml4schmLazy = {}));
@@ -0,0 +1,96 @@
+"""
+JSON Patch (RFC 6902) for JSON-like data
+
+Only `add`, `remove` and `replace` operations are produced, those are enough to turn one document into another
+"""
+
+
+def _pointer(path: str, key) -> str:
+    return path + "/" + str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _equal(a, b) -> bool:
+    """ Compares values as JSON values (i.e. True isn't equal to 1) """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return len(a) == len(b) and all(k in b and _equal(v, b[k]) for k, v in a.items())
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _diff(old, new, path, patch):
+    if type(old) is not type(new) or not isinstance(old, (dict, list)):
+        if not _equal(old, new):
+            patch.append({"op": "replace", "path": path, "value": new})
+        return
+
+    if isinstance(old, dict):
+        for k in old:
+            if k not in new:
+                patch.append({"op": "remove", "path": _pointer(path, k)})
+        for k, v in new.items():
+            if k not in old:
+                patch.append({"op": "add", "path": _pointer(path, k), "value": v})
+            else:
+                _diff(old[k], v, _pointer(path, k), patch)
+        return
+
+    # Skip common head and tail, so a single insertion or removal results in a single operation
+    head = 0
+    limit = min(len(old), len(new))
+    while head < limit and _equal(old[head], new[head]):
+        head += 1
+    tail = 0
+    while tail < limit - head and _equal(old[-1-tail], new[-1-tail]):
+        tail += 1
+    old_end = len(old) - tail
+    new_end = len(new) - tail
+    paired = min(old_end, new_end) - head
+    for i in range(head, head + paired):
+        _diff(old[i], new[i], _pointer(path, i), patch)
+    for i in range(old_end - 1, head + paired - 1, -1):
+        patch.append({"op": "remove", "path": _pointer(path, i)})
+    for i in range(head + paired, new_end):
+        patch.append({"op": "add", "path": _pointer(path, i), "value": new[i]})
+
+
+def diff(old, new) -> list:
+    """
+    Makes patch that turns one document into another
+    :param old: original document
+    :param new: target document
+    :return: list of JSON Patch operations
+    """
+    patch = []
+    _diff(old, new, "", patch)
+    return patch
+
+
+def apply(doc, patch: list):
+    """
+    Applies patch made by `diff` to a document
+    :param doc: document, changed in place
+    :param patch: list of JSON Patch operations
+    :return: patched document
+    """
+    for op in patch:
+        keys = [k.replace("~1", "/").replace("~0", "~") for k in op["path"].split("/")[1:]]
+        if len(keys) == 0:
+            doc = op["value"]
+            continue
+        parent = doc
+        for k in keys[:-1]:
+            parent = parent[int(k)] if isinstance(parent, list) else parent[k]
+        k = keys[-1]
+        if isinstance(parent, list):
+            k = len(parent) if k == "-" else int(k)
+            if op["op"] == "add":
+                parent.insert(k, op["value"])
+                continue
+        if op["op"] == "remove":
+            del parent[k]
+        else:
+            parent[k] = op["value"]
+    return doc
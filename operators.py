@@ -174,6 +174,16 @@ units = [
 
 special = ["fsm", "code", ] # TODO: chain for chaining heterogenous operators by order
 
+# Lookup tables for the parser (lists above are kept for ordering and for users of the module)
+_OPERATORS = frozenset(operators)
+_UNITS = frozenset(units)
+_SPECIAL_PORTS = frozenset(("@", "#", "$", "%"))
+_TOKEN_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_./")
+_PORT_NAME = re.compile(r"\w+")
+# Rest of a token, once it's first char is accepted: '/' is allowed only before first '.'
+_TOKEN_TAIL = re.compile(r"[A-Za-z0-9_/]*(?:\.[A-Za-z0-9_.]*)?")
+_TOKEN_TAIL_DOT = re.compile(r"[A-Za-z0-9_.]*")
+
 
 class Unit(object):
     def __init__(self, unit_type, ports):
@@ -183,7 +193,7 @@ class Unit(object):
 
 
 def token_kind(token):
-    if token in units or token[0:1] == NEG and token[1:] in units:
+    if token in _UNITS or token[0:1] == NEG and token[1:] in _UNITS:
         return KIND_UNIT
     elif token == KIND_FMS:
         return KIND_FMS
@@ -329,7 +339,7 @@ class Expression(PrettyPrinter):
                     # At this moment operation operator is expected
                     if self._type is None:
                         # If this is a first operator occurrence - store it
-                        if token not in operators:
+                        if token not in _OPERATORS:
                             raise ValueError(f"#01 Unexpected token '{token}' at position {pos[0]-len(token)} on line '{line}'! Operator expected")
                         if not dry_run:
                             self._type = token
@@ -561,17 +571,16 @@ class Expression(PrettyPrinter):
 
 
 def allowed_token_char(token, char, is_port):
-    more = ""
-    if token == "" and is_port:
-        # @#$& for first port char
-        more += "@#$%"
-    if token == "" or token in ("@", "#", "$", "%") or token[-1:] == ":":
-        # for first char NEG or char after @#$% is allowed
-        # also NEG allowed after : (port name separator)
-        more += NEG
-    if re.match(r"^[A-Za-z0-9_./"+more+"]$", char) is None:
+    if char not in _TOKEN_CHARS:
         # Allow alphanumerics with underscore, dots (port name delimiter) and hierarchy delimiters
-        if char == ":" and is_port and re.match(r"^\w+$", token) is not None:
+        if token == "" and is_port and char in _SPECIAL_PORTS:
+            # @#$% for first port char
+            pass
+        elif char == NEG and (token == "" or token in _SPECIAL_PORTS or token[-1:] == ":"):
+            # for first char NEG or char after @#$% is allowed
+            # also NEG allowed after : (port name separator)
+            pass
+        elif char == ":" and is_port and _PORT_NAME.fullmatch(token) is not None:
             # Also allow single ':' after alphanumerics if this is port assignment expression
             pass
         else:
@@ -591,9 +600,12 @@ def parse_line(line, expression, pos=None, level=0, relative_path=""):
     escape = False
     current_token = ""
     closed_token = False
+    # Enclosing expressions of nested expressions, so nesting depth isn't limited by recursion
+    parents = []
 
     is_unit = expression.kind == KIND_UNIT
-    while pos[0] < len(line):
+    line_len = len(line)
+    while pos[0] < line_len:
         char = line[pos[0]]
         add_char = None
         pos[0] += 1
@@ -632,9 +644,10 @@ def parse_line(line, expression, pos=None, level=0, relative_path=""):
                 or token_kind(current_token) == KIND_UNIT:
                 # Empty token could be if this is a nested expression
                     if expression.process_token(line, pos, DUMMY_TOKEN, dry_run=True):
-                        nested = Expression(current_token, pos, relative_path=relative_path)
-                        parse_line(line, nested, pos, level+1, relative_path)
-                        expression.process_token(line, pos, nested)
+                        parents.append(expression)
+                        expression = Expression(current_token, pos, relative_path=relative_path)
+                        is_unit = expression.kind == KIND_UNIT
+                        level += 1
                         current_token = ""; closed_token = False
                 else:
                     # TODO: if level==0 then port map for arbitrary unit / fsm / code
@@ -654,7 +667,13 @@ def parse_line(line, expression, pos=None, level=0, relative_path=""):
                 if level != 0:
                     expression.process_token(line, pos, current_token, last=True)
                     current_token = ""; closed_token = False
-                    return
+                    if not parents:
+                        return
+                    nested = expression
+                    expression = parents.pop()
+                    is_unit = expression.kind == KIND_UNIT
+                    level -= 1
+                    expression.process_token(line, pos, nested)
                 else:
                     raise ValueError(f"#13 Unexpected '{char}' char at position {pos[0]} on line '{line}'!")
             ##################
@@ -696,7 +715,10 @@ def parse_line(line, expression, pos=None, level=0, relative_path=""):
             # Common chars are added into current token
             elif allowed_token_char(current_token, char, is_unit):
                 if not closed_token:
-                    add_char = char
+                    # Rest of the token is taken at once, it's chars are allowed whatever token is before them
+                    tail = (_TOKEN_TAIL, _TOKEN_TAIL_DOT)["." in current_token or char == "."].match(line, pos[0])
+                    pos[0] = tail.end()
+                    add_char = char + tail.group()
                 else:
                     assert False, "#A3 This should be already covered by `raise ValueError(f\"Ports/KIND_FMS specification for unit...`"
             else:
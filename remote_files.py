@@ -0,0 +1,363 @@
+"""
+Access to remote (HTTP / HTTPS) files
+
+Remote file references are in following form: 'https://host/base@/path/to/file.yaml'
+where part before '@/' is a base (i.e. a library root) and the rest is a path within base
+'@/' could be omitted, in this case host itself is the base
+References within remote file are resolved relative to the file, paths starting with `@` - relative to file's base
+
+Fetched files are kept in local on-disk cache and are revalidated with ETag / If-Modified-Since
+Connections are reused, remote dependencies of a file are fetched concurrently
+"""
+import os
+import re
+import sys
+import json
+import time
+import gzip
+import hashlib
+import posixpath
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_REVALIDATE_AFTER = 10      # Seconds for which fetched file is used without revalidation (if server didn't told otherwise)
+_TIMEOUT = 30
+_WORKERS = 8
+_MAX_REDIRECTS = 5
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+_REFS_RE = re.compile(r"""(?:^|[\s{,])(?:unit|source)[ \t]*:[ \t]*["']?([^\s"'#,}\]]+)""", re.MULTILINE)
+
+
+def is_url(path: str) -> bool:
+    return isinstance(path, str) and (path[:7] == "http://" or path[:8] == "https://")
+
+
+def split_url(url: str):
+    """
+    Splits reference into base and path within base
+    :param url: reference like 'https://host/base@/path'
+    :return: tuple ('https://host/base', '/path')
+    """
+    if "@/" in url:
+        base, path = url.split("@/", 1)
+        return base, "/" + path
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}", parts.path or "/"
+
+
+def real_url(url: str) -> str:
+    """ Returns URL to request for given reference """
+    base, path = split_url(url)
+    return base.rstrip("/") + path
+
+
+def url_dir(url: str) -> str:
+    """
+    Returns directory of remote file, keeping it's base
+    :param url: reference like 'https://host/base@/path/file.yaml'
+    :return: directory like 'https://host/base@/path'
+    """
+    base, path = split_url(url)
+    return base + "@" + posixpath.dirname(path)
+
+
+def resolve_url(root: str, ref: str) -> str:
+    """
+    Resolves reference from remote file
+    :param root: directory of the file with reference (in 'https://host/base@/path' form)
+    :param ref: reference
+    :return: resolved reference in 'https://host/base@/path' form
+    """
+    if is_url(ref):
+        return ref
+    base, path = split_url(root)
+    if ref[:1] == "@":
+        path = ref[1:]
+    elif ref[:1] == "<" and ref[-1:] == ">":
+        raise ValueError(f"Looking for files by name (`{ref}`) is not supported within remote {root}")
+    else:
+        path = posixpath.join(path, ref)
+    return base + "@" + posixpath.normpath("/" + path.lstrip("/"))
+
+
+def scan_refs(text: str) -> list:
+    """
+    Looks for values of `unit` and `source` nodes in YAML text without parsing it
+    Used only as hints for prefetching, so false positives are harmless
+    """
+    return [r for r in _REFS_RE.findall(text) if r[:1] != "<"]
+
+
+def scan_urls(url: str, content: bytes) -> list:
+    """ Returns resolved references from remote file's content """
+    root = url_dir(url)
+    result = []
+    for ref in scan_refs(content.decode("utf-8", errors="replace")):
+        try:
+            result.append(resolve_url(root, ref))
+        except ValueError:
+            pass
+    return result
+
+
+class HttpFetcher:
+    """
+    Fetches remote files, keeps them in a local cache, revalidates cached files
+    """
+
+    def __init__(self, cache_path: str = None, revalidate_after: float = _REVALIDATE_AFTER,
+                 timeout: float = _TIMEOUT, workers: int = _WORKERS):
+        """
+        :param cache_path: directory for on-disk cache. If None then cache is kept in memory only
+        :param revalidate_after: seconds for which file is used without revalidation
+        :param timeout: network timeout, seconds
+        :param workers: amount of concurrent fetches
+        """
+        self._cache_path = cache_path
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+        self._revalidate_after = revalidate_after
+        self._timeout = timeout
+        self._workers = workers
+        self._entries = {}          # In-memory cache: URL -> (meta, content)
+        self._inflight = {}         # URL -> Future
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+
+    @property
+    def cache_path(self):
+        return self._cache_path
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    @staticmethod
+    def _normalize(url):
+        # NOTE: same file could be referred with different bases
+        return real_url(url)
+
+    def _entry(self, url):
+        entry = self._entries.get(url, None)
+        if entry is None and self._cache_path is not None:
+            key = self._key(url)
+            try:
+                with open(os.path.join(self._cache_path, key + ".json"), "r") as f:
+                    meta = json.load(f)
+                with open(os.path.join(self._cache_path, key + ".body"), "rb") as f:
+                    content = f.read()
+            except (OSError, ValueError):
+                return None
+            # NOTE: entry from disk could be stale, force revalidation
+            meta["checked"] = 0
+            entry = self._entries[url] = (meta, content)
+        return entry
+
+    def _store(self, url, meta, content):
+        self._entries[url] = (meta, content)
+        if self._cache_path is None:
+            return
+        key = self._key(url)
+        for suffix, data, mode in ((".body", content, "wb"), (".json", json.dumps(meta), "w")):
+            path = os.path.join(self._cache_path, key + suffix)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            try:
+                with open(tmp_path, mode) as f:
+                    f.write(data)
+                os.replace(tmp_path, path)  # NOTE: atomic, so cache could be shared by multiple processes
+            except OSError:
+                return  # NOTE: file is kept in memory anyway, on-disk copy is an optimization only
+
+    def _fresh(self, entry):
+        if entry is None:
+            return False
+        meta = entry[0]
+        return time.time() - meta["checked"] < meta.get("max_age", self._revalidate_after)
+
+    def _connection(self, scheme, netloc):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get((scheme, netloc), None)
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self._timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self._timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def _request(self, url, headers):
+        parts = urlsplit(url)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        for attempt in (0, 1):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", target, headers=headers)
+                response = conn.getresponse()
+                return response, response.read()
+            except (http.client.HTTPException, ConnectionError, OSError):
+                # NOTE: kept alive connection could be closed by server, so try again with a new one
+                conn.close()
+                del self._local.connections[(parts.scheme, parts.netloc)]
+                if attempt == 1:
+                    raise
+
+    def _fetch(self, url):
+        """ Fetches file or revalidates cached one """
+        entry = self._entry(url)
+        headers = {"Accept-Encoding": "gzip"}
+        if entry is not None:
+            if entry[0].get("etag") is not None:
+                headers["If-None-Match"] = entry[0]["etag"]
+            if entry[0].get("last_modified") is not None:
+                headers["If-Modified-Since"] = entry[0]["last_modified"]
+        target = url
+        for redirect in range(_MAX_REDIRECTS+1):
+            try:
+                response, content = self._request(target, headers)
+            except (http.client.HTTPException, OSError):
+                if entry is not None:
+                    return entry[1]     # NOTE: stale file is better than nothing
+                raise
+            if response.status not in _REDIRECTS:
+                break
+            location = response.getheader("Location", None)
+            if location is None:
+                raise IOError(f"Fetching remote file {url} failed: redirect without location")
+            target = urljoin(target, location)
+            if not is_url(target):
+                raise IOError(f"Fetching remote file {url} failed: redirect to unsupported location {target}")
+        else:
+            raise IOError(f"Fetching remote file {url} failed: more than {_MAX_REDIRECTS} redirects")
+
+        max_age = None
+        cache_control = response.getheader("Cache-Control", "") or ""
+        if "no-cache" in cache_control or "no-store" in cache_control:
+            max_age = 0
+        else:
+            m = re.search(r"max-age=(\d+)", cache_control)
+            if m is not None:
+                max_age = int(m.group(1))
+
+        # NOTE: only 200 is a content of the file, 304 is accepted only if there is cached file
+        if response.status == 304 and entry is not None:
+            meta, content = entry
+        elif response.status == 404:
+            raise FileNotFoundError(f"Remote file {url} is not found")
+        elif response.status != 200:
+            raise IOError(f"Fetching remote file {url} failed with status {response.status} {response.reason}")
+        else:
+            if response.getheader("Content-Encoding", "") == "gzip":
+                content = gzip.decompress(content)
+            meta = {
+                "url": url,
+                "etag": response.getheader("ETag", None),
+                "last_modified": response.getheader("Last-Modified", None),
+            }
+        meta = {**meta, "checked": time.time()}
+        if max_age is not None:
+            meta["max_age"] = max_age
+        elif "max_age" in meta:
+            del meta["max_age"]
+        self._store(url, meta, content)
+        return content
+
+    def _start(self, url):
+        """
+        Returns (future, True) if caller should do the fetching, (future, False) if fetch is already in progress
+        or (None, False) if cached data is fresh
+        """
+        with self._mutex:
+            future = self._inflight.get(url, None)
+            if future is not None:
+                return future, False
+            if self._fresh(self._entry(url)):
+                return None, False
+            future = self._inflight[url] = Future()
+            return future, True
+
+    def _run(self, url, future):
+        try:
+            future.set_result(self._fetch(url))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._mutex:
+                del self._inflight[url]
+
+    def fetch(self, url: str) -> bytes:
+        """ Returns content of remote file """
+        url = self._normalize(url)
+        future, owner = self._start(url)
+        if future is None:
+            return self._entries[url][1]
+        if owner:
+            self._run(url, future)
+        return future.result()
+
+    def prefetch(self, urls, discover=None) -> None:
+        """
+        Starts concurrent fetching of remote files. Doesn't waits for completion
+        :param urls: files to fetch
+        :param discover: callable(url, content) that returns list of files referred by fetched file,
+        those are fetched too
+        """
+        for url in urls:
+            url = self._normalize(url)
+            future, owner = self._start(url)
+            if not owner:
+                continue
+            if self._pool is None:
+                with self._mutex:
+                    if self._pool is None:
+                        self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix="yaml4schm-fetch")
+            self._pool.submit(self._run, url, future)
+            if discover is not None:
+                future.add_done_callback(
+                    lambda f, url=url: f.exception() is None and self.prefetch(discover(url, f.result()), discover))
+
+    def timestamp(self, url: str) -> int:
+        """ Returns timestamp of remote file (Last-Modified or time when file were fetched) """
+        url = self._normalize(url)
+        self.fetch(url)
+        meta = self._entries[url][0]
+        if meta.get("last_modified") is not None:
+            try:
+                return int(parsedate_to_datetime(meta["last_modified"]).timestamp())
+            except (TypeError, ValueError):
+                pass
+        return int(meta["checked"])
+
+
+_DEFAULT_FETCHER = None
+
+
+def default_fetcher() -> HttpFetcher:
+    """
+    Returns process wide fetcher
+    On-disk cache location is taken from YAML4SCHM_HTTP_CACHE environment variable
+    (default is ~/.cache/yaml4schm/http, empty value disables on-disk cache)
+    If cache directory can't be created then files are cached in memory only
+    """
+    global _DEFAULT_FETCHER
+    if _DEFAULT_FETCHER is None:
+        cache_path = os.environ.get(
+            "YAML4SCHM_HTTP_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "yaml4schm", "http"))
+        try:
+            _DEFAULT_FETCHER = HttpFetcher(cache_path if cache_path != "" else None)
+        except OSError as e:
+            print(f"WARNING: on-disk cache of remote files at {cache_path} is disabled: {e}", file=sys.stderr)
+            _DEFAULT_FETCHER = HttpFetcher(None)
+    return _DEFAULT_FETCHER
+
+
+def set_default_fetcher(fetcher: HttpFetcher) -> None:
+    global _DEFAULT_FETCHER
+    _DEFAULT_FETCHER = fetcher
@@ -0,0 +1,196 @@
+"""
+Content-addressed on-disk cache of built schematics
+
+Built schematic is fully determined by it's inputs (tool, build options, version of the tool)
+and by content of all files that were read during build (dependency closure).
+Dependency closure is known only after build, so lookup is made in two steps:
+  * manifest - addressed by inputs, lists dependency closures (file path -> content hash) that were seen for them
+  * object - addressed by inputs and dependency closure, keeps built schematic
+Cache directory could be shared by multiple processes (CLI, documentation builds, server workers),
+files are written atomically and are never modified in place
+"""
+import os
+import sys
+import json
+import hashlib
+import threading
+
+_MAX_VARIANTS = 8       # Dependency closures that are kept in a manifest
+_MAX_OBJECTS = 10000    # Objects that are kept in cache, least recently used are removed above that
+_PRUNE_PERIOD = 100     # Check cache size every that many stores
+
+
+def key(*parts) -> str:
+    """ Returns cache key for given JSON-serializable parts """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    Keeps built schematics in a directory
+    """
+
+    def __init__(self, path: str, max_objects: int = _MAX_OBJECTS):
+        """
+        :param path: cache directory
+        :param max_objects: amount of objects to keep in cache
+        """
+        self._path = path
+        self._max_objects = max_objects
+        self._stored = 0
+        self._mutex = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _item_path(self, kind, item_key):
+        return os.path.join(self._path, kind, item_key[:2], item_key + ".json")
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write(path, value):
+        os.makedirs(os.path.split(path)[0], exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, separators=(",", ":"))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)  # NOTE: atomic, so cache could be shared by multiple processes
+
+    def get(self, inputs: str, digest):
+        """
+        Looks for built schematic
+        :param inputs: key of build inputs (see `key`)
+        :param digest: callable(file_path) that returns hash of file's current content.
+            Any exception it raises means that file is changed
+        :return: stored value or None if nothing is stored for current content of dependencies
+        """
+        manifest = self._read(self._item_path("m", inputs))
+        if manifest is None:
+            return None
+        hashes = {}
+        for variant in manifest:
+            for file_path, file_hash in variant["deps"]:
+                if file_path not in hashes:
+                    try:
+                        hashes[file_path] = digest(file_path)
+                    except Exception:
+                        hashes[file_path] = None
+                if hashes[file_path] != file_hash:
+                    break
+            else:
+                object_path = self._item_path("o", variant["object"])
+                value = self._read(object_path)
+                if value is not None:
+                    try:
+                        os.utime(object_path)   # NOTE: mtime is used to find least recently used objects
+                    except OSError:
+                        pass
+                    return value
+        return None
+
+    def put(self, inputs: str, deps: dict, value) -> None:
+        """
+        Stores built schematic
+        :param inputs: key of build inputs (see `key`)
+        :param deps: files that were read during build, file path -> content hash
+        :param value: JSON-serializable value to store
+        """
+        deps = sorted(deps.items())
+        object_key = key(inputs, deps)
+        object_path = self._item_path("o", object_key)
+        if not os.path.exists(object_path):
+            try:
+                self._write(object_path, value)
+            except RecursionError:
+                return  # NOTE: json's encoder is recursive, so too deep value (i.e. deep hierarchy) isn't stored
+            except OSError:
+                return  # NOTE: cache is an optimization only, so build isn't failed if it can't be stored
+
+        # NOTE: concurrent updates of a manifest could loose a variant, that results just in a cache miss later
+        manifest_path = self._item_path("m", inputs)
+        manifest = [v for v in (self._read(manifest_path) or []) if v["object"] != object_key]
+        manifest = [{"deps": deps, "object": object_key}] + manifest[:_MAX_VARIANTS-1]
+        try:
+            self._write(manifest_path, manifest)
+        except OSError:
+            return
+
+        with self._mutex:
+            self._stored += 1
+            prune = self._stored % _PRUNE_PERIOD == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> None:
+        """ Removes least recently used objects and manifests above the limit """
+        for kind in ("o", "m"):
+            items = []
+            root = os.path.join(self._path, kind)
+            for dir_path, _, files in os.walk(root):
+                for fn in files:
+                    path = os.path.join(dir_path, fn)
+                    try:
+                        items.append((os.stat(path).st_mtime, path))
+                    except OSError:
+                        pass
+            if len(items) <= self._max_objects:
+                continue
+            items.sort()
+            for _, path in items[:len(items) - self._max_objects]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def open_cache(path: str) -> RenderCache or None:
+    """
+    Returns render cache in given directory
+    If directory can't be created (i.e. home directory isn't writable) then warning is printed
+    and None is returned, so build runs without cache
+    """
+    try:
+        return RenderCache(path)
+    except OSError as e:
+        print(f"WARNING: render cache at {path} is disabled: {e}", file=sys.stderr)
+        return None
+
+
+_DEFAULT_CACHE = None
+_DEFAULT_CACHE_FAILED = False
+
+
+def default_cache() -> RenderCache or None:
+    """
+    Returns process wide render cache
+    Location is taken from YAML4SCHM_RENDER_CACHE environment variable
+    (default is ~/.cache/yaml4schm/render, empty value disables cache)
+    None is returned if cache is disabled or it's directory can't be created
+    """
+    global _DEFAULT_CACHE, _DEFAULT_CACHE_FAILED
+    if _DEFAULT_CACHE is None and not _DEFAULT_CACHE_FAILED:
+        cache_path = os.environ.get(
+            "YAML4SCHM_RENDER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "yaml4schm", "render"))
+        if cache_path == "":
+            return None
+        _DEFAULT_CACHE = open_cache(cache_path)
+        _DEFAULT_CACHE_FAILED = _DEFAULT_CACHE is None  # NOTE: warned once, not on every build
+    return _DEFAULT_CACHE
+
+
+def set_default_cache(cache: RenderCache) -> None:
+    global _DEFAULT_CACHE
+    _DEFAULT_CACHE = cache
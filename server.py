@@ -1,12 +1,18 @@
 from typing import Tuple
 import os
-from bottle import Bottle, run, SimpleTemplate, request, static_file, response
+from bottle import Bottle, run, SimpleTemplate, request, static_file, response, HTTPResponse, HTTPError
+from email.utils import formatdate
 import json
 import yaml
+import hashlib
+import threading
+from collections import OrderedDict
 import yaml4schm
-from yaml4schm import load_unit, render_unit, connect, renderer, tool_adaptation, cleanup
+import json_patch
 from yaml4schm_defs import TOOL_HDELK, TOOL_D3HW
-from yaml4schm_defs import RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS
+from render_cache import default_cache
+from static_assets import StaticAssets, accepts_encoding
+from compression import CompressionMiddleware
 from operators import parse_line, Expression
 from server_data import new_domain, DataDomain
 
@@ -43,11 +49,49 @@ _no_cache = os.environ.get("YAML4SCHM_NO_CACHE", None) == "TRUE"
 if _no_cache:
     print("NOTE: Static files caching is disabled")
 
+# Built schematics are cached on disk, cache is shared with CLI and other workers
+_render_cache = None if _no_cache else default_cache()
+
 _DOMAINS = {}
 
 _POST = "POST"
 _GET = "GET"
 
+_EDITOR_SESSIONS_MAX = 256
+_editor_sessions = OrderedDict()    # (session, tool, path) -> (revision, diagram, source) last sent to editor
+_editor_sessions_mutex = threading.Lock()
+
+_LAZY_SCHEMATICS_MAX = 32
+_lazy_schematics = OrderedDict()    # (tool, path, revision) -> schematic shown with collapsed units as stubs
+_lazy_schematics_mutex = threading.Lock()
+
+_BUILD_STATES_MAX = 64
+_build_states = OrderedDict()       # (session, tool, path) -> yaml4schm.BuildState, for incremental builds in editor
+_shadow_build = os.environ.get("YAML4SCHM_SHADOW_BUILD", "FALSE").upper() == "TRUE"
+if _shadow_build:
+    print("NOTE: Incremental builds are compared with full builds")
+
+
+_BUILD_BUDGET = "files=1000,units=100000,nets=200000,operators=20000,yaml_bytes=33554432,seconds=10"
+"""
+Default limits of a single build (see yaml4schm.BuildBudget), so a single diagram can't stall the server
+Time limit bounds the whole build (render, connect and postprocess of loaded units too), the other limits bound
+the amount of loaded data
+Overridden with YAML4SCHM_BUILD_BUDGET environment variable, and per files domain
+with YAML4SCHM_BUILD_BUDGET_<DOMAIN NAME> environment variable
+"""
+_build_budgets = {}     # Files domain name -> yaml4schm.BuildBudget
+
+
+def _build_budget(domain_name):
+    budget = _build_budgets.get(domain_name, None)
+    if budget is None:
+        budget = yaml4schm.BuildBudget.parse(os.environ.get(
+            f"YAML4SCHM_BUILD_BUDGET_{domain_name.upper()}",
+            os.environ.get("YAML4SCHM_BUILD_BUDGET", _BUILD_BUDGET)))
+        _build_budgets[domain_name] = budget
+    return budget
+
 
 def get_domains():
     if len(_DOMAINS) == 0:
@@ -56,13 +100,14 @@ def get_domains():
         domain_prefix = "YAML4SCHM_FILES_DOMAIN_"
         for k in env:
             # TODO: read configs
-            # TODO: create domain that corresponds to it's kind (fs, http, git)
             if k[:len(domain_prefix)] == domain_prefix:
                 domain_name = k[len(domain_prefix):].lower()
                 _DOMAINS[domain_name] = new_domain(
                     name=domain_name,
                     path=os.environ.get(k)
                 )
+        for domain_name in _DOMAINS:
+            _build_budget(domain_name)  # NOTE: wrong budget specification is reported on start
     return _DOMAINS
 
 
@@ -115,7 +160,7 @@ templates = {
                 r" yaml4schm_version=yaml4schm_version, server_version=server_version,"
                 r" meta=meta,"
                 r" svg_style=svg_style,"
-                r" title=title, static_svg=static_svg, stylesheet=stylesheet)",
+                r" title=title, static_svg=static_svg, stylesheet=stylesheet, subtree_url=subtree_url)",
         EDIT:   r"% rebase('d3hw_edit_tpl.html',"
                 r" yaml4schm_version=yaml4schm_version, server_version=server_version,"
                 r" meta=meta,"
@@ -126,15 +171,14 @@ templates = {
 }
 
 
-def _file_content(file_path):
-    with open(file_path, "r") as f:
-        return f.read()
-
-
-svg_style = {
-    TOOL_HDELK: "",
-    TOOL_D3HW: _file_content("demo/html/css/d3/d3-hwschematic.css")
+svg_stylesheet = {
+    TOOL_HDELK: None,
+    TOOL_D3HW: "/css/d3/d3-hwschematic.css",
 }
+"""
+Stylesheets for SVG elements of schematic
+Those are served as a cached stylesheet, and inlined into SVG only when page is rendered for embedding
+"""
 
 renderers = {}
 for _tool in templates:
@@ -144,8 +188,7 @@ for _tool in templates:
 
 
 def _internal_path(path):
-    """Convert URL path into the path on the hosting server"""
-    # TODO: remove this
+    """Convert URL path into files domain and the path within it"""
 
     path_items = path.split('/')
     if len(path_items) < 2:
@@ -154,19 +197,19 @@ def _internal_path(path):
     if "/../" in path:
         raise ValueError(
             "<pre>Hierarchy ('..' items) in the file path is not supported!<pre>")
-    if path_items[0] == "demo":
-        files_domain = "demo"
-    else:
-        files_domain = os.environ.get(
-            "YAML4SCHM_FILES_DOMAIN_"+path_items[0].upper(), None)
-        if files_domain is None:
-            raise ValueError(
-                f"<pre>Files domain '{path_items[0]}' is not defined!</pre>")  # TODO: 404
-    return files_domain, files_domain + "/" + "/".join(path_items[1:])
+    files_domain, error = _get_domain(path_items[0])
+    if error is not None:
+        raise ValueError(
+            f"<pre>Files domain '{path_items[0]}' is not defined!</pre>")  # TODO: 404
+    return files_domain, "/" + "/".join(path_items[1:])
 
 
-def build_schm(tool, source_data, make_shell, override_source_text=None, create=False):
-    """Build schematic data out of YAML description"""
+def build_schm(tool, source_data, make_shell, override_source_text=None, create=False, state=None, root=None, depth=None):
+    """
+    Build schematic data out of YAML description
+    If build state is specified then schematic is built incrementally
+    If root and/or depth are specified then only that part of hierarchy is built (see yaml4schm.build)
+    """
 
     print(f"build_schm(\n  tool={tool},\n  source_data={source_data},\n"
           "  make_shell={make_shell},\n  override_source_text={override_source_text})")
@@ -177,13 +220,20 @@ def build_schm(tool, source_data, make_shell, override_source_text=None, create=
         path = source_data
         files_domain, file_path = _internal_path(path)
     else:
+        files_domain = None
         file_path = ""
 
     if load_from_file:
         if override_source_text is not None:
             source = override_source_text
         else:
-            if not os.path.exists(file_path):
+            if files_domain.isdir(file_path):
+                raise ValueError(
+                    f"Path {source_data} is directory, not file!")  # TODO: 404
+            file_data, error = files_domain.get_file(file_path, ["content"])
+            if error is not None:
+                raise ValueError(error)
+            if file_data["content"] is None:
                 if not create:
                     raise ValueError(
                         f"File {source_data} is not found!")       # TODO: 404
@@ -202,12 +252,8 @@ nets:
   - [   THE_DOCS.GOT_IDEA,     YOUR_IMAGINATION.IDEAS,         name:DO_IT      ]
   - [   EXAMPLES.GOT_IDEA,     YOUR_IMAGINATION.IDEAS,         name:DO_IT      ]
 """
-            elif not os.path.isfile(file_path):
-                raise ValueError(
-                    f"Path {source_data} is directory, not file!")  # TODO: 404
             else:
-                with open(file_path, "r") as f:
-                    source = f.read()
+                source = file_data["content"]
         source_string = override_source_text
         unit_data = source_data
     else:
@@ -227,25 +273,17 @@ nets:
     else:
         hunit = None
 
-    old_root = yaml4schm._ROOT_PATH
-    yaml4schm._ROOT_PATH = files_domain
+    # Files are read via domain, so paths are relative to domain's root
+    old_root, old_files = yaml4schm._ROOT_PATH, yaml4schm._FILES
+    yaml4schm._ROOT_PATH = "/"
+    yaml4schm._FILES = files_domain
     try:
-        data = load_unit(file_path, "", "", {}, None,
-                         yaml_string=source_string)
-        if hunit is not None:
-            hdata = load_unit(file_path, "", "", {}, None, yaml_string=hunit)
-        else:
-            hdata = data
-    except Exception as e:
-        yaml4schm._ROOT_PATH = old_root
-        raise e
-
-    schm = render_unit(tool, hdata, "", is_top=True, custom=hdata)
-    connect(tool, schm, (RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS))
-    renderer(tool, schm)
-    tool_adaptation(tool, schm)
-    cleanup(schm)
-    return source, data, schm
+        unit_type, schm = yaml4schm.build(tool, file_path, yaml_string=source_string, shell_string=hunit,
+                                          cache=_render_cache, state=state, root=root, depth=depth,
+                                          budget=_build_budget("" if files_domain is None else files_domain.name))
+    finally:
+        yaml4schm._ROOT_PATH, yaml4schm._FILES = old_root, old_files
+    return source, unit_type, schm
 
 
 def render(tool, source_data, make_shell, draw_only=False, title=""):
@@ -254,22 +292,38 @@ def render(tool, source_data, make_shell, draw_only=False, title=""):
     print(f"render(\n  tool={tool},\n  source_data={source_data},\n  make_shell={make_shell},\n  draw_ony={draw_only})\n"
           f"  title={title}")
     try:
-        _, data, schm = build_schm(tool, source_data, make_shell)
+        _, _, schm = build_schm(tool, source_data, make_shell)
     except Exception as e:
         return f"Schematic rendering failed due to exception: {e}"
 
+    subtree_url = ""
+    if tool == TOOL_D3HW and not draw_only and not make_shell and isinstance(source_data, str):
+        # NOTE: content of collapsed units isn't sent with the page, it's requested when unit is expanded
+        #       and is taken from the same schematic, kept in memory
+        revision = _schm_revision(schm)
+        subtree_url = f"/{tool}/subtree/{source_data}?revision={revision}&id="
+        with _lazy_schematics_mutex:
+            _lazy_schematics.pop((tool, source_data, revision), None)
+            _lazy_schematics[(tool, source_data, revision)] = schm
+            while len(_lazy_schematics) > _LAZY_SCHEMATICS_MAX:
+                _lazy_schematics.popitem(last=False)
+        schm = yaml4schm.d3hw_stubbed(schm)
+
     if reload_template:
         tooler = SimpleTemplate(templates[tool][VIEW])
     else:
         tooler = renderers[tool][VIEW]
 
     if draw_only:
+        # NOTE: SVG could be taken out of the page, so styles are kept within it
         meta = ""
         stylesheet = ""
+        style = svg_style(tool)
         static_svg = "false"
     else:
         meta = '<meta charset="utf-8">'
-        stylesheet = ""
+        stylesheet = svg_style_link(tool)
+        style = ""
         static_svg = "false"
 
     return tooler.render(
@@ -279,11 +333,17 @@ def render(tool, source_data, make_shell, draw_only=False, title=""):
         title=f"{title}",
         static_svg=static_svg,
         meta=meta,
-        svg_style=svg_style[tool],
+        svg_style=style,
         stylesheet=stylesheet,
+        subtree_url=subtree_url,
         display_customizations="")
 
 
+def _schm_revision(schm):
+    """ Identifies built schematic, so content of collapsed units is taken from the same schematic as the page """
+    return hashlib.md5(json.dumps(schm, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 @app.route('/<tool>/show/<path:path>')
 def show(tool, path):
     """Page with schematic to view in browser"""
@@ -311,25 +371,80 @@ def draw(tool, path):
 
 @app.route('/<tool>/json/<path:path>')
 def show_json(tool, path):
-    """ Completely built schematic in JSON format """
+    """
+    Completely built schematic in JSON format
+    Query parameters:
+        root - hierarchical path of unit (i.e. /U1/X1), only this unit is built and returned
+        depth - levels of nested units to build under root (or top), deeper units aren't built
+    """
 
+    root = request.query.get("root", None)
+    depth = request.query.get("depth", None)
     common = {
         "tool": tool,
         "path": path
     }
+    if root is not None:
+        common["root"] = root
+    if depth is not None:
+        common["depth"] = depth
 
     response.content_type = 'application/json'
-    print(f"show_json(\n  tool={tool},\n  path={path})")
+    print(f"show_json(\n  tool={tool},\n  path={path},\n  root={root},\n  depth={depth})")
     if tool not in _allowed_tools:
         return _error(f"Tool '{tool}' is not supported!", common)
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = -1
+        if depth < 0:
+            return _error("Depth should be a non-negative integer!", common)
 
     try:
-        _, _, schm = build_schm(tool, path, make_shell=False)
+        _, _, schm = build_schm(tool, path, make_shell=False, root=root, depth=depth)
     except Exception as e:
         return _error(f"Failed due to exception {e}", common)
     return _success({"schematic": schm}, common)
 
 
+@app.route('/<tool>/subtree/<path:path>')
+def show_subtree(tool, path):
+    """ Content of collapsed unit in JSON format, page with schematic takes it when unit is expanded """
+
+    unit_id = request.query.get("id", None)
+    revision = request.query.get("revision", None)
+    common = {
+        "tool": tool,
+        "path": path,
+        "id": unit_id
+    }
+
+    response.content_type = 'application/json'
+    print(f"show_subtree(\n  tool={tool},\n  path={path},\n  id={unit_id})")
+    if tool != TOOL_D3HW:
+        return _error(f"Tool '{tool}' is not supported!", common)
+    if unit_id is None:
+        return _error("Unit's id is not specified!", common)
+
+    with _lazy_schematics_mutex:
+        schm = _lazy_schematics.get((tool, path, revision), None)
+        if schm is not None:
+            _lazy_schematics.move_to_end((tool, path, revision))
+    if schm is None:
+        # NOTE: page could be rendered by another worker or schematic is evicted already, so it's built again
+        try:
+            _, _, schm = build_schm(tool, path, make_shell=False)
+        except Exception as e:
+            return _error(f"Failed due to exception {e}", common)
+        if revision is not None and revision != _schm_revision(schm):
+            return _error("Schematic was changed, reload the page", common)
+    content = yaml4schm.d3hw_hidden_content(schm, unit_id)
+    if content is None:
+        return _error(f"There is no collapsed unit with id '{unit_id}'", common)
+    return _success(content, common)
+
+
 @app.route('/<tool>/edit/<path:path>', method="GET")
 def editor(tool, path):
     """ Schematic editor page """
@@ -343,7 +458,7 @@ def editor(tool, path):
         tooler = renderers[tool][EDIT]
 
     meta = '<meta charset="utf-8">'
-    stylesheet = ''
+    stylesheet = svg_style_link(tool)
     static_svg = "false"
 
     return tooler.render(
@@ -355,7 +470,7 @@ def editor(tool, path):
         title="Editing: "+path,
         static_svg=static_svg,
         meta=meta,
-        svg_style=svg_style[tool],
+        svg_style="",
         stylesheet=stylesheet,
         display_customizations="")
 
@@ -372,7 +487,7 @@ def edit(tool, path):
 
     try:
         source, _, schm = build_schm(
-            tool, path, make_shell=False, override_source_text=data, create=True)
+            tool, path, make_shell=False, override_source_text=data, create=True, state=_build_state(tool, path))
     except Exception as e:
         return _error(f"Rendering schematic failed due to exception: {e}", {})
 
@@ -385,7 +500,7 @@ def edit(tool, path):
     else:
         hash = None
 
-    return _success({"diagram": schm, "source": source, "hash": hash}, {})
+    return _success(_editor_data(tool, path, schm, source, hash), {})
 
 
 @app.route('/live/debug/<subject>', method="GET")
@@ -477,7 +592,7 @@ def save_by_path(tool, path):
     # Build schematics to make sure data is OK
     try:
         content, _, diagram = build_schm(
-            tool, path, make_shell=False, override_source_text=text, create=True)
+            tool, path, make_shell=False, override_source_text=text, create=True, state=_build_state(tool, path))
     except Exception as e:
         return _error(f"Schematic check failed due to exception: {e}!", {})
 
@@ -492,11 +607,7 @@ def save_by_path(tool, path):
     else:
         hash = update_result[file_path]["hash"]
 
-    return _success({
-        "diagram": diagram,
-        "source": content,
-        "hash": hash
-    }, {})
+    return _success(_editor_data(tool, path, diagram, content, hash), {})
 
 
 @app.route('/<tool>/test')
@@ -509,38 +620,115 @@ def test(tool):
     return render(tool, "demo/unit3.yaml", make_shell=False, title="Test")
 
 
+_STATIC_CACHE_CONTROL = "public, max-age=604800"
+_STATIC_CACHE_CONTROL_IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Static files are kept in memory along with gzipped version, in debug mode changed files are reloaded
+_static_assets = {
+    "js": StaticAssets("demo/html/js", check_changes=_no_cache),
+    "css": StaticAssets("demo/html/css", check_changes=_no_cache),
+    "monaco_assets": StaticAssets("demo/html/monaco-src/assets", check_changes=_no_cache),
+    "monaco": StaticAssets("demo/html/monaco", check_changes=_no_cache),
+}
+_static_routes = (
+    ("/monaco/assets/", "monaco_assets"),
+    ("/monaco/", "monaco"),
+    ("/js/", "js"),
+    ("/css/", "css"),
+)
+
+
+def _static_asset(url):
+    for prefix, kind in _static_routes:
+        if url[:len(prefix)] == prefix:
+            return _static_assets[kind].get(url[len(prefix):])
+    return None
+
+
+def _asset_fingerprint(asset):
+    return asset.etag[:16]
+
+
+def asset_url(url):
+    """
+    Returns URL of static file with content fingerprint, so file could be cached forever
+    Used by templates
+    """
+    asset = _static_asset(url)
+    if asset is None:
+        return url
+    return f"{url}?v={_asset_fingerprint(asset)}"
+
+
+def svg_style(tool):
+    """Stylesheet for SVG elements of schematic as text"""
+
+    if svg_stylesheet[tool] is None:
+        return ""
+    return _static_asset(svg_stylesheet[tool]).content.decode("utf-8")
+
+
+def svg_style_link(tool):
+    """Link to stylesheet for SVG elements of schematic"""
+
+    if svg_stylesheet[tool] is None:
+        return ""
+    return f'<link rel="stylesheet" id="svg-style" href="{asset_url(svg_stylesheet[tool])}">'
+
+
+SimpleTemplate.defaults["asset_url"] = asset_url
+
+
+def _static(kind, path):
+    """Serve static file from memory"""
+
+    asset = _static_assets[kind].get(path)
+    if asset is None:
+        return HTTPError(404, "File does not exist.")
+    if _no_cache:
+        cache_control = "no-cache"
+    elif request.query.get("v") == _asset_fingerprint(asset):
+        # NOTE: URL with fingerprint always refers to the same content
+        cache_control = _STATIC_CACHE_CONTROL_IMMUTABLE
+    else:
+        cache_control = _STATIC_CACHE_CONTROL
+    headers = {
+        "Content-Type": asset.mimetype,
+        "ETag": f'"{asset.etag}"',
+        "Last-Modified": formatdate(asset.mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if headers["ETag"] in request.headers.get("If-None-Match", ""):
+        return HTTPResponse(status=304, **headers)
+    body = asset.content
+    if asset.gzipped is not None and accepts_encoding(request.headers.get("Accept-Encoding"), "gzip"):
+        body = asset.gzipped
+        headers["Content-Encoding"] = "gzip"
+    headers["Content-Length"] = str(len(body))
+    return HTTPResponse(body, **headers)
+
+
 @app.route('/js/<path:path>')
 def js(path):
     """ Static Javascript Files """
-    response = static_file(path, root="demo/html/js")
-    if _no_cache:
-        response.set_header("Cache-Control", "no-cache")
-    return response
+    return _static("js", path)
 
 
 @app.route('/css/<path:path>')
 def css(path):
     """ Static CSS Files """
-    response = static_file(path, root="demo/html/css")
-    if _no_cache:
-        response.set_header("Cache-Control", "no-cache")
-    return response
+    return _static("css", path)
 
 @app.route('/monaco/assets/<path:path>')
 def monaco(path):
     """ Monaco editor complementary """
-    response = static_file(path, root="demo/html/monaco-src/assets")
-    if _no_cache:
-        response.set_header("Cache-Control", "no-cache")
-    return response
+    return _static("monaco_assets", path)
 
 @app.route('/monaco/<path:path>')
 def monaco(path):
     """ Monaco editor """
-    response = static_file(path, root="demo/html/monaco")
-    if _no_cache:
-        response.set_header("Cache-Control", "no-cache")
-    return response
+    return _static("monaco", path)
 
 
 @app.route('/rest/1.0/domains/domainsList')
@@ -767,6 +955,62 @@ def _save_files(domain: DataDomain, files, dry_run=False):
     return True, None
 
 
+def _build_state(tool, path):
+    """State of previous build for editor's session"""
+
+    session = request.json.get("session", None)
+    if session is None:
+        return None
+    key = (session, tool, path)
+    with _editor_sessions_mutex:
+        state = _build_states.pop(key, None)
+        if state is None:
+            state = yaml4schm.BuildState(shadow=_shadow_build)
+        _build_states[key] = state
+        while len(_build_states) > _BUILD_STATES_MAX:
+            _build_states.popitem(last=False)
+    return state
+
+
+def _editor_data(tool, path, diagram, source, hash):
+    """
+    Data for response to editor
+    If editor's session already have got a diagram then JSON Patch to that diagram is sent instead of a full one
+    (unless patch is bigger) and source is sent only if it's changed
+    """
+    session = request.json.get("session", None)
+    if session is None:
+        return {"diagram": diagram, "source": source, "hash": hash}
+
+    client_revision = request.json.get("revision", None)
+    if not isinstance(client_revision, int):
+        client_revision = None
+    key = (session, tool, path)
+    with _editor_sessions_mutex:
+        last = _editor_sessions.pop(key, None)
+        # NOTE: revisions should only grow for client, even if session were dropped
+        revision = max(client_revision or 0, 0 if last is None else last[0]) + 1
+        _editor_sessions[key] = (revision, diagram, source)
+        while len(_editor_sessions) > _EDITOR_SESSIONS_MAX:
+            _editor_sessions.popitem(last=False)
+
+    result = {"revision": revision, "hash": hash}
+    if last is None or client_revision != last[0]:
+        result["diagram"] = diagram
+        result["source"] = source
+        return result
+
+    patch = json_patch.diff(last[1], diagram)
+    if len(json.dumps(patch)) < len(json.dumps(diagram)):
+        result["diagram_patch"] = patch
+        result["base"] = last[0]
+    else:
+        result["diagram"] = diagram
+    if source != last[2]:
+        result["source"] = source
+    return result
+
+
 def _get_domain(domain) -> Tuple[DataDomain, str]:
     domains = get_domains()
     if domain not in domains:
@@ -782,7 +1026,11 @@ def _success(data, rest):
     return json.dumps({"SUCCESS": True, **data, **rest, **_versions})
 
 
+# WSGI application to serve, responses are compressed if client accepts that
+application = CompressionMiddleware(app)
+
+
 if __name__ == "__main__":
     host = os.environ.get("SERVER_HOST", "localhost")
     port = os.environ.get("SERVER_PORT", 8083)
-    run(app, host=host, port=int(port), debug=True)
+    run(application, host=host, port=int(port), debug=True)
@@ -1,15 +1,25 @@
 import os
+import re
+import sys
+import time
+import posixpath
 import hashlib
+import sqlite3
+import subprocess
+import threading
+from collections import OrderedDict
+from urllib.request import pathname2url
+from remote_files import is_url, split_url, scan_urls, default_fetcher
 
 
-def new_domain(name, path, meta_path=None):
+def new_domain(name, path, meta_path=None, lock_store=None):
     """
     Factory for new domain object
     Selects domain which fits for selected path
     """
-    for cl in (DataDomain, ):
+    for cl in (GitDataDomain, HttpDataDomain, DataDomain):
         if cl.path_supported(path):
-            return cl(name, path, meta_path)
+            return cl(name, path, meta_path, lock_store)
     return None
 
 
@@ -18,6 +28,254 @@ _HASH = "hash"
 _LOCK = "lock"
 _TIMESTAMP = "timestamp"
 
+LOCK_STORE_FILES = "files"
+LOCK_STORE_SQLITE = "sqlite"
+
+_LOCK_SUFFIX = ".lock"
+_LOCK_MIGRATED_SUFFIX = ".migrated"   # NOTE: legacy lock files are renamed so, not removed
+_LEGACY_LOCK = re.compile(r"[0-9a-f]{32}")  # NOTE: legacy lock file contains just secret's hash (see DataDomain._lock_hash)
+_LOCK_DB = ".locks.sqlite"
+_LOCK_BATCH = 500   # NOTE: keeps IN (...) lists below SQLite's host parameters limit
+
+
+def new_lock_store(kind, meta_path, path=None):
+    """
+    Factory for lock store object
+    :param kind: LOCK_STORE_SQLITE, LOCK_STORE_FILES or None for default (LOCK_STORE_SQLITE)
+    :param meta_path: path to metadata for files
+    :param path: path to data files (default is meta_path)
+    """
+    if kind is None:
+        kind = os.environ.get("YAML4SCHM_LOCK_STORE", LOCK_STORE_SQLITE).lower()
+    if kind == LOCK_STORE_SQLITE:
+        return SqliteLockStore(meta_path, path)
+    if kind == LOCK_STORE_FILES:
+        return FilesLockStore(meta_path)
+    raise ValueError(f"Lock store '{kind}' is not supported!")
+
+
+class LockStore:
+    """
+    LockStore keeps lock values of domain's files
+    Lock value is a string, empty string means that file is not locked
+    """
+
+    def __init__(self, meta_path):
+        self._meta_path = meta_path
+
+    @staticmethod
+    def _key(file_path):
+        if file_path[:1] == "/":
+            file_path = file_path[1:]
+        return file_path
+
+    def get(self, file_path):
+        """ Returns lock value for the file """
+        raise NotImplementedError("LockStore.get Not implemented")
+
+    def get_many(self, files):
+        """
+        Returns lock values (as dict) for specified files
+        Only locked files are in result. If files is None then all locked files are returned
+        """
+        raise NotImplementedError("LockStore.get_many Not implemented")
+
+    def set(self, file_path, lock):
+        """ Sets lock value for the file. If lock is None then lock is removed """
+        raise NotImplementedError("LockStore.set Not implemented")
+
+
+class FilesLockStore(LockStore):
+    """
+    Legacy lock store - lock value is kept in '<file>.lock' file under meta_path
+    """
+
+    def _lock_path(self, file_path):
+        return os.path.join(self._meta_path, self._key(file_path)+_LOCK_SUFFIX)
+
+    def get(self, file_path):
+        lock_path = self._lock_path(file_path)
+        if os.path.isfile(lock_path):
+            with open(lock_path, "r") as f:
+                return f.readline().strip()
+        return ""
+
+    def get_many(self, files):
+        if files is None:
+            files = ["/"+os.path.relpath(p, self._meta_path)[:-len(_LOCK_SUFFIX)] for p in _lock_files(self._meta_path)]
+        locks = {}
+        for file_path in files:
+            lock = self.get(file_path)
+            if lock != "":
+                locks[file_path] = lock
+        return locks
+
+    def set(self, file_path, lock):
+        lock_path = self._lock_path(file_path)
+        if lock is not None:
+            with open(lock_path, "w") as f:
+                f.write(lock)
+        else:
+            if os.path.isfile(lock_path):
+                os.remove(lock_path)
+
+
+class SqliteLockStore(LockStore):
+    """
+    Lock store that keeps all lock values of domain in a single SQLite database (WAL mode) under meta_path
+    Legacy '<file>.lock' files of domain's schematic files are migrated into database on first use
+    Database is opened on first use, if it can't be opened for writing (i.e. data directory is read-only)
+    then locks are only read: from database opened read-only if it exists, otherwise from legacy lock files
+    """
+
+    def __init__(self, meta_path, path=None):
+        """
+        :param meta_path: path to metadata for files
+        :param path: path to data files (default is meta_path), only locks of existing files are migrated
+        """
+        super().__init__(meta_path)
+        self._path = meta_path if path is None else path
+        self._db_path = os.path.join(meta_path, _LOCK_DB)
+        self._local = threading.local()
+        self._mutex = threading.Lock()
+        self._opened = False
+        self._read_only = False
+        self._fallback = None   # FilesLockStore, if there is no database and it can't be created
+
+    def _store(self):
+        """ Opens database on first call, returns lock store to use: self or fallback one """
+        if not self._opened:
+            with self._mutex:
+                if not self._opened:
+                    self._open()
+                    self._opened = True
+        return self if self._fallback is None else self._fallback
+
+    def _open(self):
+        try:
+            db = self._db()
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS locks (path TEXT PRIMARY KEY, lock TEXT NOT NULL)")
+                db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._migrate()
+            return
+        except (sqlite3.Error, OSError) as e:
+            error = e
+        self._local = threading.local()     # NOTE: drops connection that failed
+        if os.path.isfile(self._db_path):
+            print(f"WARNING: lock store at {self._db_path} is read-only: {error}", file=sys.stderr)
+            self._read_only = True
+        else:
+            print(f"WARNING: lock store at {self._db_path} can't be created, lock files are used: {error}",
+                  file=sys.stderr)
+            self._fallback = FilesLockStore(self._meta_path)
+
+    def _db(self):
+        # NOTE: sqlite3 connections can't be shared between threads, so there is one per thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self._read_only:
+                # NOTE: immutable database is read without WAL's shared memory file, which can't be created here,
+                #       it's safe only if there is no WAL file left with changes not checkpointed to database
+                mode = "mode=ro" if os.path.isfile(self._db_path+"-wal") else "mode=ro&immutable=1"
+                db = sqlite3.connect(f"file:{pathname2url(self._db_path)}?{mode}", uri=True, timeout=30)
+            else:
+                db = sqlite3.connect(self._db_path, timeout=30)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _migrate(self):
+        """
+        Moves lock values from legacy '<file>.lock' files into database
+        Only lock files of existing schematic files with a lock value in them are taken,
+        they are renamed to '<file>.lock.migrated' afterwards. Any other '*.lock' file is left as is
+        """
+        db = self._db()
+        if db.execute("SELECT value FROM meta WHERE key='migrated'").fetchone() is not None:
+            return
+        migrated = []
+        with db:
+            for lock_path in _lock_files(self._meta_path):
+                file_path = os.path.relpath(lock_path, self._meta_path)[:-len(_LOCK_SUFFIX)]
+                if not os.path.isfile(os.path.join(self._path, file_path)):
+                    continue
+                try:
+                    with open(lock_path, "r") as f:
+                        lock = f.read(64).strip()
+                except (OSError, ValueError):
+                    continue
+                if _LEGACY_LOCK.fullmatch(lock) is None:
+                    continue
+                db.execute("INSERT OR IGNORE INTO locks (path, lock) VALUES (?, ?)", (self._key(file_path), lock))
+                migrated.append(lock_path)
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+        for lock_path in migrated:
+            try:
+                os.replace(lock_path, lock_path + _LOCK_MIGRATED_SUFFIX)
+            except OSError:
+                pass    # NOTE: lock is in database already, sidecar is just left in place
+
+    def get(self, file_path):
+        store = self._store()
+        if store is not self:
+            return store.get(file_path)
+        row = self._db().execute("SELECT lock FROM locks WHERE path=?", (self._key(file_path),)).fetchone()
+        if row is None:
+            return ""
+        return row[0]
+
+    def get_many(self, files):
+        store = self._store()
+        if store is not self:
+            return store.get_many(files)
+        db = self._db()
+        if files is None:
+            return {"/"+k: v for k, v in db.execute("SELECT path, lock FROM locks")}
+        files = list(files)
+        keys = {}
+        for file_path in files:
+            keys.setdefault(self._key(file_path), []).append(file_path)
+        key_list = list(keys.keys())
+        locks = {}
+        for i in range(0, len(key_list), _LOCK_BATCH):
+            batch = key_list[i:i+_LOCK_BATCH]
+            rows = db.execute(
+                f"SELECT path, lock FROM locks WHERE path IN ({','.join('?'*len(batch))})", batch)
+            for k, v in rows:
+                for file_path in keys[k]:
+                    locks[file_path] = v
+        return locks
+
+    def set(self, file_path, lock):
+        store = self._store()
+        if store is not self:
+            return store.set(file_path, lock)
+        db = self._db()
+        with db:
+            if lock is not None:
+                db.execute("INSERT OR REPLACE INTO locks (path, lock) VALUES (?, ?)", (self._key(file_path), lock))
+            else:
+                db.execute("DELETE FROM locks WHERE path=?", (self._key(file_path),))
+
+
+def _lock_files(meta_path):
+    """
+    Returns paths of legacy '<file>.lock' files under meta_path
+    Only lock files of schematic files ('*.yaml.lock', '*.yml.lock') are taken,
+    so lock files of other tools (Cargo.lock, yarn.lock, ...) are never mistaken for them
+    """
+    result = []
+    for root, dirs, files in os.walk(meta_path):
+        for f in files:
+            if f[-len(_LOCK_SUFFIX):] != _LOCK_SUFFIX:
+                continue
+            name = f[:-len(_LOCK_SUFFIX)].lower()
+            if name[-4:] == ".yml" or name[-5:] == ".yaml":
+                result.append(os.path.join(root, f))
+    return result
+
 
 class DataDomain:
     """
@@ -25,13 +283,18 @@ class DataDomain:
     """
     # TODO: check where custom_data is missing
 
-    def __init__(self, name, path, meta_path=None):
+    local = True    # True if domain's files are on local file system
+
+    def __init__(self, name, path, meta_path=None, lock_store=None):
         self._name = name
         self._path = path               # Path to data files
         if meta_path is None:
             meta_path = path
         self._meta_path = meta_path     # Path to metadata for files
         # TODO: check that path exist
+        if lock_store is None or isinstance(lock_store, str):
+            lock_store = new_lock_store(lock_store, meta_path, path)
+        self._lock_store = lock_store   # Keeps lock values of files
 
     @staticmethod
     def path_supported(path):
@@ -73,6 +336,13 @@ class DataDomain:
             raise NotImplementedError("custom data is not supported yet")
         return os.path.isfile(self._full_path(file_path))
 
+    def _dir_exists(self, file_path, custom_data=None):
+        # NOTE: depends on domain kind
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        return os.path.isdir(self._full_path(file_path))
+
     def _find_file(self, from_path, path_pattern, custom_data=None):
         raise NotImplementedError("DataDomain._find_file Not implemented yet")
         if custom_data is not None:
@@ -93,7 +363,7 @@ class DataDomain:
         if custom_data is not None:
             # TODO: support custom data
             raise NotImplementedError("custom data is not supported yet")
-        with open(self._full_path(file_path), "r") as f:
+        with open(self._full_path(file_path), "r", encoding="utf-8") as f:
             return f.read()
 
     def _file_hash(self, file_path, custom_data=None):
@@ -116,23 +386,12 @@ class DataDomain:
         if not self._file_exists(file_path, custom_data):
             return None
         else:
-            lock_path = self._aux_path(file_path+".lock")
-            if os.path.isfile(lock_path):
-                with open(lock_path, "r") as f:
-                    return f.readline().strip()
-            else:
-                return ""
+            return self._lock_store.get(file_path)
 
     def _file_lock_set(self, file_path, lock):
         # NOTE: depends on domain kind (also could be http, git)
         # NOTE: http files are always locked
-        lock_path = self._aux_path(file_path+".lock")
-        if lock is not None:
-            with open(lock_path, "w") as f:
-                f.write(lock)
-        else:
-            if os.path.isfile(lock_path):
-                os.remove(lock_path)
+        self._lock_store.set(file_path, lock)
 
     def list_files(self, custom_data=None):
         # NOTE: depends on domain kind (also could be http, git)
@@ -169,11 +428,15 @@ class DataDomain:
         if files is None:
             files = self.list_files(custom_data)
 
+        files = list(files)
+        stored = self._lock_store.get_many(files)   # NOTE: single lookup for whole batch
+
         locks = {}
         for file_path in files:
-            lock = self._file_lock(file_path, custom_data)
-            if lock != "":  # NOTE: unlocked files are skipped in result
-                locks[file_path] = lock
+            if not self._file_exists(file_path, custom_data):
+                locks[file_path] = None
+            elif file_path in stored:   # NOTE: unlocked files are skipped in result
+                locks[file_path] = stored[file_path]
 
         return locks
 
@@ -230,6 +493,10 @@ class DataDomain:
 
         return True, None
 
+    def isdir(self, file_path, custom_data=None):
+        """ Checks whether path within domain is a directory, not a file """
+        return self._dir_exists(file_path, custom_data)
+
     def get_file(self, file_path, fields, custom_data=None):
         if not self._file_exists(file_path, custom_data):
             file_exists = False
@@ -280,9 +547,275 @@ class DataDomain:
         # NOTE: depends on domain kind
         # NOTE: locks shouldn't be checked since DataDomain only provides ways for data storage abstraction
         try:
-            with open(self._full_path(file_path), "w") as f:
+            with open(self._full_path(file_path), "w", encoding="utf-8") as f:
                 f.write(content)
         except Exception as e:
             return None, f"Failed to save file '{file_path}' in domain '{self.name}' due to exception: {e}!"
 
         return True, None
+
+
+_GIT_PATH_RE = re.compile(r"^git://(?P<repo>.+?)@/(?P<ref>[^^]+)\^?$")
+_GIT_REF_TTL = 1.0          # Seconds for which resolved ref is reused
+_GIT_TREES_CACHED = 16      # Amount of commits for which tree listings are kept
+_READ_ONLY_LOCK = "read-only"
+
+
+class ReadOnlyDataDomain(DataDomain):
+    """
+    Base for domains with read-only files (git, http)
+    Such files are always locked
+    """
+
+    local = False
+
+    def _file_lock(self, file_path, custom_data=None):
+        if not self._file_exists(file_path, custom_data):
+            return None
+        return _READ_ONLY_LOCK
+
+    def _file_lock_set(self, file_path, lock):
+        raise PermissionError(f"Files of domain '{self.name}' are read-only")
+
+    def get_files_lock(self, files, custom_data=None):
+        if files is None:
+            files = self.list_files(custom_data)
+        return {file_path: self._file_lock(file_path, custom_data) for file_path in files}
+
+    def save_file(self, file_path, content):
+        return None, f"Failed to save file '{file_path}' in domain '{self.name}' since it's read-only!"
+
+
+class GitDataDomain(ReadOnlyDataDomain):
+    """
+    DataDomain that reads files straight from a local (bare or non-bare) git repository at a given ref
+    No checkout is required. Blob object ids are used as files hashes
+    Domain path format: git://<repository path>@/<ref>^
+    i.e. git:///srv/schematics.git@/main^ or git://./schematics@/v1.0^
+    Files of domain are read-only
+    """
+
+    def __init__(self, name, path, meta_path=None, lock_store=None):
+        m = _GIT_PATH_RE.match(path)
+        if m is None:
+            raise ValueError(f"Git domain path should be like git://<repository path>@/<ref>^, got '{path}'")
+        self._name = name
+        self._path = path
+        self._meta_path = meta_path
+        self._lock_store = None     # NOTE: files are read-only so there is no locks
+        self._repo = m.group("repo")
+        self._ref = m.group("ref")
+        self._commit = None
+        self._commit_time = 0
+        self._resolved_at = None
+        self._trees = OrderedDict()  # Tree listing ({file path: blob id}) per commit
+        self._batch = None          # `git cat-file --batch` process
+        self._mutex = threading.RLock()
+
+    @staticmethod
+    def path_supported(path):
+        return path[:6] == "git://"
+
+    @property
+    def repo(self):
+        return self._repo
+
+    @property
+    def ref(self):
+        return self._ref
+
+    def _git(self, *args):
+        return subprocess.run(
+            ["git", "-C", self._repo, *args], check=True, capture_output=True).stdout
+
+    def _resolve(self):
+        """ Returns commit id for domain's ref. Resolved value is reused for _GIT_REF_TTL seconds """
+        with self._mutex:
+            now = time.monotonic()
+            if self._resolved_at is None or now - self._resolved_at > _GIT_REF_TTL:
+                commit, commit_time = self._git(
+                    "log", "-1", "--format=%H %ct", self._ref+"^{commit}", "--").decode().split()
+                self._commit = commit
+                self._commit_time = int(commit_time)
+                self._resolved_at = now
+            return self._commit
+
+    def _tree(self):
+        """ Returns tree listing ({file path: blob id}) for current commit of domain's ref """
+        commit = self._resolve()
+        with self._mutex:
+            tree = self._trees.get(commit, None)
+            if tree is not None:
+                self._trees.move_to_end(commit)
+                return tree
+            tree = {}
+            for entry in self._git("ls-tree", "-r", "-z", "--full-tree", commit).split(b"\0"):
+                if len(entry) == 0:
+                    continue
+                info, file_path = entry.split(b"\t", 1)
+                _, kind, oid = info.split()
+                if kind == b"blob":
+                    tree["/"+file_path.decode()] = oid.decode()
+            self._trees[commit] = tree
+            while len(self._trees) > _GIT_TREES_CACHED:
+                self._trees.popitem(last=False)
+            return tree
+
+    @staticmethod
+    def _norm_path(file_path):
+        return posixpath.normpath("/"+file_path.lstrip("/"))
+
+    def _blob_id(self, file_path):
+        return self._tree().get(self._norm_path(file_path), None)
+
+    def _blob(self, oid):
+        """ Reads blob content with long living `git cat-file --batch` process """
+        with self._mutex:
+            if self._batch is None or self._batch.poll() is not None:
+                self._batch = subprocess.Popen(
+                    ["git", "-C", self._repo, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._batch.stdin.write(oid.encode()+b"\n")
+            self._batch.stdin.flush()
+            header = self._batch.stdout.readline().split()
+            if len(header) < 3 or header[1] != b"blob":
+                raise ValueError(f"Object {oid} is not a blob in repository '{self._repo}'")
+            content = self._batch.stdout.read(int(header[2]))
+            self._batch.stdout.read(1)  # NOTE: trailing LF
+            return content
+
+    def _file_exists(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        return self._blob_id(file_path) is not None
+
+    def _dir_exists(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        prefix = self._norm_path(file_path).rstrip("/") + "/"
+        return any(k[:len(prefix)] == prefix for k in self._tree().keys())
+
+    def _file_binary(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        oid = self._blob_id(file_path)
+        if oid is None:
+            raise FileNotFoundError(f"File '{file_path}' is not found at '{self._ref}' of '{self._repo}'")
+        return self._blob(oid)
+
+    def _file_text(self, file_path, custom_data=None):
+        return self._file_binary(file_path, custom_data).decode("utf-8")
+
+    def _file_hash(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        return self._blob_id(file_path)
+
+    def _file_timestamp(self, file_path, custom_data=None):
+        # NOTE: commit's timestamp is used, since looking for the last commit which changed file is expensive
+        if self._file_exists(file_path, custom_data):
+            return self._commit_time
+        else:
+            return 0
+
+    def list_files(self, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        return sorted(k for k in self._tree().keys() if k[-4:].lower() == ".yml" or k[-5:].lower() == ".yaml")
+
+
+_HTTP_FILES_INDEX = "/.yaml4schm-files"
+
+
+class HttpDataDomain(ReadOnlyDataDomain):
+    """
+    DataDomain that reads files from HTTP(S) server
+    Domain path format: https://host/base@/ or https://host/base
+    Fetched files are cached and revalidated with remote_files.HttpFetcher
+    Since HTTP has no means for listing, files are listed by optional index file '<base>/.yaml4schm-files'
+    (one file path per line)
+    Files of domain are read-only
+    """
+
+    def __init__(self, name, path, meta_path=None, lock_store=None, fetcher=None):
+        self._name = name
+        self._path = path
+        self._meta_path = meta_path
+        self._lock_store = None     # NOTE: files are read-only so there is no locks
+        if "@/" in path:
+            self._base = split_url(path)[0]
+        else:
+            self._base = path.rstrip("/")
+        self._fetcher = fetcher
+
+    @staticmethod
+    def path_supported(path):
+        return is_url(path)
+
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            return default_fetcher()
+        return self._fetcher
+
+    def _url(self, file_path):
+        return self._base + "@" + self._norm_path(file_path)
+
+    def _file_exists(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        try:
+            self.fetcher.fetch(self._url(file_path))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _dir_exists(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        # NOTE: HTTP has no directories, only paths that end with '/' are taken as such
+        return file_path.strip("/") == "" or file_path[-1:] == "/"
+
+    def _file_binary(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        return self.fetcher.fetch(self._url(file_path))
+
+    def _file_text(self, file_path, custom_data=None):
+        return self._file_binary(file_path, custom_data).decode("utf-8")
+
+    def _file_timestamp(self, file_path, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        if self._file_exists(file_path, None):
+            return self.fetcher.timestamp(self._url(file_path))
+        else:
+            return 0
+
+    def list_files(self, custom_data=None):
+        if custom_data is not None:
+            # TODO: support custom data
+            raise NotImplementedError("custom data is not supported yet")
+        try:
+            index = self.fetcher.fetch(self._url(_HTTP_FILES_INDEX)).decode("utf-8")
+        except FileNotFoundError:
+            return []
+        result = [self._norm_path(f.strip()) for f in index.splitlines() if f.strip() != ""]
+        return sorted(f for f in result if f[-4:].lower() == ".yml" or f[-5:].lower() == ".yaml")
+
+    @staticmethod
+    def _norm_path(file_path):
+        return posixpath.normpath("/"+file_path.lstrip("/"))
+
+    def prefetch(self, files):
+        """ Starts concurrent fetching of specified files and files that are referred by them """
+        self.fetcher.prefetch([self._url(file_path) for file_path in files], discover=scan_urls)
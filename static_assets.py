@@ -0,0 +1,131 @@
+"""
+Static assets served from memory
+
+Files are loaded on first request and kept in memory together with their gzip-compressed version,
+so every next request is served without touching disk and without compressing again
+"""
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+_GZIP_LEVEL = 9             # Compression is made once per file, so it's worth to compress as good as possible
+_GZIP_MIN_SIZE = 1024       # Smaller files aren't compressed
+_GZIP_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+_ENCODING_RE = re.compile(r"^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?")
+
+
+def accepts_encoding(accept_encoding: str or None, encoding: str) -> bool:
+    """
+    Checks whether encoding is acceptable according to value of Accept-Encoding header
+    :param accept_encoding: value of Accept-Encoding header
+    :param encoding: content encoding, like "gzip"
+    """
+    if not accept_encoding:
+        return False
+    any_q = None
+    for item in accept_encoding.lower().split(","):
+        m = _ENCODING_RE.match(item)
+        if m is None:
+            continue
+        try:
+            q = float(m.group(2)) if m.group(2) is not None else 1.0
+        except ValueError:
+            q = 0.0
+        if m.group(1) == encoding:
+            return q > 0
+        if m.group(1) == "*":
+            any_q = q
+    return any_q is not None and any_q > 0
+
+
+def compressible(mimetype: str or None) -> bool:
+    """ Checks whether content of given type is worth to compress """
+    return mimetype is not None and mimetype.startswith(_GZIP_TYPES)
+
+
+class Asset:
+    """
+    Static file loaded into memory
+    """
+
+    __slots__ = ("path", "mimetype", "content", "gzipped", "etag", "mtime")
+
+    def __init__(self, path: str, content: bytes, mtime: float):
+        """
+        :param path: full path of the file
+        :param content: file content
+        :param mtime: file modification time
+        """
+        self.path = path
+        self.content = content
+        self.mtime = mtime
+        mimetype, encoding = mimetypes.guess_type(path)
+        if mimetype is None or encoding is not None:
+            mimetype = "application/octet-stream"
+        if mimetype.startswith("text/") or mimetype == "application/javascript":
+            mimetype += "; charset=UTF-8"
+        self.mimetype = mimetype
+        self.etag = hashlib.md5(content).hexdigest()
+        self.gzipped = None
+        if len(content) >= _GZIP_MIN_SIZE and compressible(mimetype):
+            gzipped = gzip.compress(content, _GZIP_LEVEL, mtime=0)
+            if len(gzipped) < len(content):
+                self.gzipped = gzipped
+
+
+class StaticAssets:
+    """
+    Serves files under a root directory from memory
+    """
+
+    def __init__(self, root: str, check_changes: bool = False):
+        """
+        :param root: root directory of files
+        :param check_changes: if True then file's modification time is checked on every request
+            and file is reloaded if it's changed (for debug)
+        """
+        self._root = os.path.abspath(root)
+        self._check_changes = check_changes
+        self._assets = {}
+        self._mutex = threading.Lock()
+
+    @property
+    def root(self):
+        return self._root
+
+    def _full_path(self, path):
+        full_path = os.path.abspath(os.path.join(self._root, path.lstrip("/\\")))
+        if not full_path.startswith(self._root + os.sep):
+            return None
+        return full_path
+
+    def get(self, path: str) -> Asset or None:
+        """
+        Returns asset by it's path within root
+        :param path: path within root
+        :return: Asset or None if file isn't exists or not within root
+        """
+        asset = self._assets.get(path, None)
+        if asset is not None and not self._check_changes:
+            return asset
+        full_path = self._full_path(path)
+        if full_path is None:
+            return None
+        try:
+            mtime = os.stat(full_path).st_mtime
+            if asset is not None and asset.mtime == mtime:
+                return asset
+            if not os.path.isfile(full_path):
+                return None
+            with open(full_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        asset = Asset(full_path, content, mtime)
+        with self._mutex:
+            self._assets[path] = asset
+        return asset
@@ -0,0 +1,45 @@
+"""
+Build budget: yaml_bytes limit counts UTF-8 bytes of loaded files, not characters
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml4schm
+from yaml4schm_defs import TOOL_D3HW
+
+_TOP = "units:\n  U: {unit: nested.yaml}\n"
+_NESTED = "# " + "Ж" * 100 + "\nio: {A: {}}\n"   # NOTE: 2 bytes per character of the comment
+
+
+class YamlBytesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        for name, text in (("top.yaml", _TOP), ("nested.yaml", _NESTED)):
+            with open(os.path.join(self._tmp, name), "w", encoding="utf-8") as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _exceeded(self, yaml_bytes):
+        ctx = yaml4schm.BuildContext(budget=yaml4schm.BuildBudget(yaml_bytes=yaml_bytes))
+        yaml4schm.build(TOOL_D3HW, os.path.join(self._tmp, "top.yaml"), ctx=ctx)
+        return ctx.meter.exceeded
+
+    def test_multibyte_text(self):
+        size = len(_TOP.encode("utf-8")) + len(_NESTED.encode("utf-8"))
+        self.assertLess(len(_TOP) + len(_NESTED), size - 1)
+        self.assertIsNone(self._exceeded(size))
+        self.assertIn("yaml_bytes", self._exceeded(size - 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Compression middleware: every response of compressible type varies by Accept-Encoding,
+whether it's compressed for this client or not, so shared caches keep plain and compressed copies apart
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import gzip
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compression import CompressionMiddleware
+
+_BIG = b"{}" * 1024
+
+
+def _app(body, content_type, headers=()):
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", content_type), ("Content-Length", str(len(body))), *headers])
+        return [body]
+    return app
+
+
+def _get(app, accept_encoding=None):
+    environ = {"REQUEST_METHOD": "GET"}
+    if accept_encoding is not None:
+        environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["headers"] = dict(headers)
+        response["vary"] = [v for k, v in headers if k.lower() == "vary"]
+
+    response["body"] = b"".join(CompressionMiddleware(app)(environ, start_response))
+    return response
+
+
+class VaryTest(unittest.TestCase):
+
+    def test_compressed(self):
+        response = _get(_app(_BIG, "application/json"), "gzip")
+        self.assertEqual(response["headers"]["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response["body"]), _BIG)
+        self.assertEqual(response["vary"], ["Accept-Encoding"])
+
+    def test_client_without_gzip(self):
+        for accept_encoding in (None, "identity", "gzip;q=0"):
+            response = _get(_app(_BIG, "application/json"), accept_encoding)
+            self.assertNotIn("Content-Encoding", response["headers"])
+            self.assertEqual(response["body"], _BIG)
+            self.assertEqual(response["vary"], ["Accept-Encoding"])
+
+    def test_small_response(self):
+        response = _get(_app(b"{}", "text/html; charset=UTF-8"), "gzip")
+        self.assertNotIn("Content-Encoding", response["headers"])
+        self.assertEqual(response["vary"], ["Accept-Encoding"])
+
+    def test_not_compressible(self):
+        for accept_encoding in (None, "gzip"):
+            response = _get(_app(_BIG, "image/png"), accept_encoding)
+            self.assertNotIn("Content-Encoding", response["headers"])
+            self.assertEqual(response["vary"], [])
+
+    def test_other_vary(self):
+        for accept_encoding in (None, "gzip"):
+            response = _get(_app(_BIG, "application/json", [("Vary", "Cookie")]), accept_encoding)
+            self.assertEqual(response["vary"], ["Cookie, Accept-Encoding"])
+            response = _get(_app(_BIG, "application/json", [("Vary", "accept-encoding")]), accept_encoding)
+            self.assertEqual(response["vary"], ["accept-encoding"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Connection of nets: every target of a net is connected once, whatever amount of net's sources is
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml4schm
+from yaml4schm_defs import TOOL_D3HW, TOOL_HDELK
+
+_MULTI_SOURCE_NET = """
+units:
+  A: {unit: {io: {O: {dir: out}}}}
+  B: {unit: {io: {O: {dir: out}}}}
+  C: {unit: {io: {I: {}}}}
+  D: {unit: {io: {I: {}}}}
+  E: {unit: {io: {I: {}}}}
+nets:
+  - [[A.O, B.O], [C.I, D.I, E.I]]
+"""
+
+
+class MultiSourceNetTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, "top.yaml")
+        with open(self._path, "w") as f:
+            f.write(_MULTI_SOURCE_NET)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def test_hdelk_edge_per_source_and_target(self):
+        _, schm = yaml4schm.build(TOOL_HDELK, self._path)
+        pairs = [(e["sources"][0], e["targets"][0]) for e in schm["edges"]]
+        self.assertEqual(sorted(pairs), sorted((s, t) for s in ("/A.O", "/B.O") for t in ("/C.I", "/D.I", "/E.I")))
+
+    def test_d3hw_targets_once(self):
+        _, schm = yaml4schm.build(TOOL_D3HW, self._path)
+        self.assertEqual(len(schm["edges"]), 1)
+        self.assertEqual(len(schm["edges"][0]["sources"]), 2)
+        self.assertEqual(len(schm["edges"][0]["targets"]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+d3hw ids: every unit, port and edge of built schematic has its own id
+
+Edge ids are derived from resolved endpoints, so nets written with the same text in different units don't share id
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml4schm
+from yaml4schm_defs import TOOL_D3HW
+
+# U1 and U2 declare the same net text in the same scope
+_SAME_NET_TEXT = """
+units:
+  U1:
+    unit:
+      io: {OUT: {dir: out}}
+      units: {X: {unit: {io: {IN: {}}}}}
+      nets: [[.OUT, X.IN]]
+  U2:
+    unit:
+      io: {OUT: {dir: out}}
+      units: {X: {unit: {io: {IN: {}}}}}
+      nets: [[.OUT, X.IN]]
+"""
+
+
+def _ids(schm):
+    units = []
+    edges = []
+    stack = [schm]
+    while len(stack) > 0:
+        unit = stack.pop()
+        units.append(unit["id"])
+        units += [p["id"] for p in unit.get("ports", [])]
+        edges += [e["id"] for e in unit.get("edges", []) + unit.get("_edges", [])]
+        stack += unit.get("children", []) + unit.get("_children", [])
+    return units, edges
+
+
+class D3hwIdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_same_net_text_in_different_units(self):
+        path = os.path.join(self.dir, "top.yaml")
+        with open(path, "w") as f:
+            f.write(_SAME_NET_TEXT)
+        _, schm = yaml4schm.build(TOOL_D3HW, path)
+        units, edges = _ids(schm)
+        self.assertEqual(len(edges), 4)
+        self.assertEqual(len(set(edges)), len(edges))
+        self.assertEqual(len(set(units + edges)), len(units) + len(edges))
+
+
+if __name__ == "__main__":
+    unittest.main()
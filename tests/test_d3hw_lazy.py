@@ -0,0 +1,98 @@
+"""
+Lazy loading of collapsed d3hw units: data that page binds after units are expanded one by one
+should be the same as if the page were sent with all content, so layout is the same too
+
+Runs page's script (demo/html/js/d3hw/yaml4schm-lazy.js) with Node.js, skipped if it isn't available
+"""
+import os
+import sys
+import json
+import shutil
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml4schm
+from yaml4schm_defs import TOOL_D3HW
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+_DEMO = os.path.join(_ROOT, "demo")
+_LAZY_JS = os.path.join(_DEMO, "html", "js", "d3hw", "yaml4schm-lazy.js")
+
+# Expands units one by one on lazy page and on page with all content,
+# prints graphs that would be bound to the diagram after every step
+_EXPAND_JS = r"""
+const lazy = require(process.argv[1]);
+const input = JSON.parse(require("fs").readFileSync(0, "utf-8"));
+function visible(n) {
+    const result = Object.assign({}, n);
+    delete result._children;
+    delete result._edges;
+    result.hwMeta = Object.assign({}, n.hwMeta);
+    delete result.hwMeta.lazy;
+    if (n.children !== undefined) {
+        result.children = n.children.map(visible);
+    }
+    return result;
+}
+const expanded = lazy.expandedIds(input.eager);
+const steps = [];
+for (const id of input.order) {
+    lazy.merge(input.page, id, input.contents[id]);
+    expanded.add(id);
+    steps.push([visible(lazy.prepare(input.page, expanded)), visible(lazy.prepare(input.eager, expanded))]);
+}
+process.stdout.write(JSON.stringify(steps));
+"""
+
+
+def _collapsed_ids(schm):
+    """ Ids of collapsed units, parents go before their nested units """
+    result = []
+    queue = [schm]
+    while len(queue) > 0:
+        u = queue.pop(0)
+        if "_children" in u or "_edges" in u:
+            result.append(u["id"])
+        queue += u.get("children", []) + u.get("_children", [])
+    return result
+
+
+@unittest.skipIf(shutil.which("node") is None, "Node.js is not available")
+class LazyExpandTest(unittest.TestCase):
+
+    def setUp(self):
+        self._root_path = yaml4schm._ROOT_PATH
+        yaml4schm._ROOT_PATH = _DEMO
+
+    def tearDown(self):
+        yaml4schm._ROOT_PATH = self._root_path
+
+    def _check(self, filename):
+        _, schm = yaml4schm.build(TOOL_D3HW, os.path.join(_DEMO, filename))
+        eager = json.loads(json.dumps(schm))
+        page = yaml4schm.d3hw_stubbed(schm)
+        order = _collapsed_ids(schm)
+        self.assertGreater(len(order), 0)
+        contents = {i: yaml4schm.d3hw_hidden_content(schm, i) for i in order}
+        self.assertEqual(json.dumps(schm), json.dumps(eager))   # NOTE: kept schematic isn't changed
+        result = subprocess.run(["node", "-e", _EXPAND_JS, _LAZY_JS], check=True, capture_output=True, text=True,
+                                input=json.dumps({"eager": eager, "page": page, "order": order, "contents": contents}))
+        steps = json.loads(result.stdout)
+        self.assertEqual(len(steps), len(order))
+        for unit_id, (lazy, full) in zip(order, steps):
+            self.assertEqual(lazy, full, f"{filename}: differs after expanding {unit_id}")
+
+    def test_top(self):
+        self._check("top.yaml")
+
+    def test_top_d(self):
+        self._check("top_d.yaml")
+
+    def test_afifo(self):
+        self._check("afifo.yaml")
+
+
+if __name__ == "__main__":
+    unittest.main()
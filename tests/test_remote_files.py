@@ -0,0 +1,133 @@
+"""
+Remote files against a stand-in HTTP server (http.server serving a copy of demo/ from a temporary directory)
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import functools
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import yaml4schm
+import remote_files
+from remote_files import url_dir, resolve_url, scan_refs
+from yaml4schm_defs import TOOL_D3HW
+
+_DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo")
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    requests = None     # List of (path, status) of served requests
+
+    def log_request(self, code="-", size="-"):
+        self.requests.append((self.path, int(code)))
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # NOTE: '/moved/<path>' is redirected to '/<path>', '/loop/' to itself, '/stale/' is never modified
+        if self.path[:7] == "/moved/":
+            self._reply(302, {"Location": self.path[6:]}, b"<html>moved</html>")
+        elif self.path[:6] == "/loop/":
+            self._reply(307, {"Location": self.path}, b"")
+        elif self.path[:7] == "/stale/":
+            self._reply(304, {}, b"")
+        else:
+            super().do_GET()
+
+    def _reply(self, status, headers, body):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("ETag", '"redirect"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+
+class ResolveTest(unittest.TestCase):
+
+    def test_file_at_base_root(self):
+        self.assertEqual(resolve_url(url_dir("https://host/lib@/top.yaml"), "unit1.yaml"),
+                         "https://host/lib@/unit1.yaml")
+        self.assertEqual(resolve_url(url_dir("http://127.0.0.1:8765@/top.yaml"), "unit1.yaml"),
+                         "http://127.0.0.1:8765@/unit1.yaml")
+        self.assertEqual(resolve_url(url_dir("http://127.0.0.1:8765/top.yaml"), "unit1.yaml"),
+                         "http://127.0.0.1:8765@/unit1.yaml")
+
+    def test_nested_file(self):
+        self.assertEqual(resolve_url(url_dir("https://host/lib@/a/top.yaml"), "unit1.yaml"),
+                         "https://host/lib@/a/unit1.yaml")
+        self.assertEqual(resolve_url(url_dir("https://host/lib@/a/top.yaml"), "@/unit1.yaml"),
+                         "https://host/lib@/unit1.yaml")
+
+    def test_refs_dont_span_lines(self):
+        self.assertEqual(scan_refs("unit:\n  io:\n    A: {}\n  units:\n    U: {unit: u.yaml}\n"), ["u.yaml"])
+
+
+class HttpBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, "demo")
+        shutil.copytree(_DEMO, self._path, ignore=shutil.ignore_patterns("html"))
+        self._requests = []
+        handler = type("Handler", (_Handler,), {"requests": self._requests})
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(handler, directory=self._path))
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._root_path = yaml4schm._ROOT_PATH
+        yaml4schm._ROOT_PATH = self._path   # NOTE: files within angle braces are searched locally
+        remote_files.set_default_fetcher(remote_files.HttpFetcher(None))
+        self._base = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        yaml4schm._ROOT_PATH = self._root_path
+        remote_files.set_default_fetcher(None)
+        shutil.rmtree(self._tmp)
+
+    def test_build_same_as_local(self):
+        url = f"http://127.0.0.1:{self._server.server_address[1]}@/top.yaml"
+        _, remote = yaml4schm.build(TOOL_D3HW, url)
+        _, local = yaml4schm.build(TOOL_D3HW, os.path.join(self._path, "top.yaml"))
+        self.assertEqual(json.dumps(remote, sort_keys=True), json.dumps(local, sort_keys=True))
+        self.assertEqual([r for r in self._requests if r[1] != 200], [])
+
+    def test_redirect(self):
+        _, redirected = yaml4schm.build(TOOL_D3HW, f"{self._base}/moved@/top.yaml")
+        _, local = yaml4schm.build(TOOL_D3HW, os.path.join(self._path, "top.yaml"))
+        self.assertEqual(json.dumps(redirected, sort_keys=True), json.dumps(local, sort_keys=True))
+        self.assertIn(("/moved/top.yaml", 302), self._requests)
+
+    def test_redirect_body_isnt_cached(self):
+        fetcher = remote_files.HttpFetcher(os.path.join(self._tmp, "cache"))
+        with open(os.path.join(self._path, "top.yaml"), "rb") as f:
+            self.assertEqual(fetcher.fetch(f"{self._base}/moved/top.yaml"), f.read())
+        for name in os.listdir(os.path.join(self._tmp, "cache")):
+            with open(os.path.join(self._tmp, "cache", name), "rb") as f:
+                data = f.read()
+                self.assertNotIn(b"<html>moved", data)
+                self.assertNotIn(b'redirect', data)
+        with self.assertRaises(IOError):
+            fetcher.fetch(f"{self._base}/loop/top.yaml")
+
+    def test_not_modified_without_cached_file(self):
+        fetcher = remote_files.HttpFetcher(os.path.join(self._tmp, "cache"))
+        with self.assertRaises(IOError):
+            fetcher.fetch(f"{self._base}/stale/top.yaml")
+        self.assertEqual(os.listdir(os.path.join(self._tmp, "cache")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Render cache is shared by CLI runs and server: the same file is rendered once, whatever path spelling,
+working directory or budget of the build are
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server
+import yaml4schm
+from server_data import new_domain
+from render_cache import RenderCache
+from yaml4schm_defs import TOOL_D3HW
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+_DEMO = os.path.join(_ROOT, "demo")
+
+
+class SharedEntryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, "demo")
+        shutil.copytree(_DEMO, self._path, ignore=shutil.ignore_patterns("html"))
+        self._cache_path = os.path.join(self._tmp, "cache")
+        self._cache = RenderCache(self._cache_path)
+        self._render_cache = server._render_cache
+        server._render_cache = self._cache
+        server._DOMAINS["cachetest"] = new_domain("cachetest", self._path)
+
+    def tearDown(self):
+        server._render_cache = self._render_cache
+        del server._DOMAINS["cachetest"]
+        shutil.rmtree(self._tmp)
+
+    def _cli(self, cwd, source_path, root):
+        subprocess.run([sys.executable, os.path.join(os.path.abspath(_ROOT), "yaml4schm.py"), source_path, "-",
+                        "-f", "JSON", "-r", root, "--render-cache", self._cache_path],
+                       cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _entries(self):
+        return {kind: sum(len(files) for _, _, files in os.walk(os.path.join(self._cache_path, kind)))
+                for kind in ("m", "o")}
+
+    def test_cli_and_server_share_entry(self):
+        self._cli(self._path, "top.yaml", ".")
+        self.assertEqual(self._entries(), {"m": 1, "o": 1})
+        self._cli(self._tmp, "./top.yaml", self._path)
+        self.assertEqual(self._entries(), {"m": 1, "o": 1})
+
+        hits = []
+        get = self._cache.get
+        self._cache.get = lambda *args: hits.append(get(*args)) or hits[-1]
+        server.build_schm(TOOL_D3HW, "cachetest/top.yaml", False)
+        self.assertIsNotNone(hits[0])
+        self.assertEqual(self._entries(), {"m": 1, "o": 1})
+
+    def test_changed_root_isnt_shared(self):
+        # NOTE: top.yaml refers to files within angle braces, those are searched within root
+        self._cli(self._path, "top.yaml", ".")
+        self._cli(self._path, os.path.join("demo", "top.yaml"), self._tmp)
+        self.assertEqual(self._entries(), {"m": 1, "o": 2})
+
+    def test_file_outside_of_domain_isnt_taken(self):
+        outside = os.path.join(self._tmp, "outside.yaml")
+        with open(outside, "w") as f:
+            f.write("units: {U: {unit: {io: {A: {}}}}}\n")
+        yaml4schm.build(TOOL_D3HW, outside, cache=self._cache)
+        options = (yaml4schm.RENDER_ADD_MISSING_UNITS, yaml4schm.RENDER_ADD_MISSING_PORTS)
+        inputs = yaml4schm._build_inputs(TOOL_D3HW, outside, None, None, options)
+        self.assertIsNotNone(self._cache.get(inputs, yaml4schm._dep_hash))
+        files = yaml4schm._FILES
+        yaml4schm._FILES = new_domain("cachetest", self._path)
+        try:
+            # NOTE: the same file, but server's build couldn't read it, so it isn't taken from cache too
+            self.assertEqual(yaml4schm._build_inputs(TOOL_D3HW, "/../outside.yaml", None, None, options), inputs)
+            self.assertIsNone(self._cache.get(inputs, yaml4schm._dep_hash))
+        finally:
+            yaml4schm._FILES = files
+
+
+if __name__ == "__main__":
+    unittest.main()
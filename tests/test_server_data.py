@@ -0,0 +1,137 @@
+"""
+Lock store of local domains on data directories that can't be written (read-only mounts),
+directories requested as schematic files of local and git domains
+
+Run: python -m unittest discover -s tests
+"""
+import os
+import sys
+import stat
+import sqlite3
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server
+import server_data
+from server_data import new_domain
+from yaml4schm_defs import TOOL_D3HW
+
+_SECRET_HASH = "0123456789abcdef0123456789abcdef"
+
+
+def _writable(path):
+    # NOTE: root ignores permissions, so directory could be writable in spite of it's mode
+    try:
+        with open(os.path.join(path, ".probe"), "w"):
+            pass
+    except OSError:
+        return False
+    os.remove(os.path.join(path, ".probe"))
+    return True
+
+
+class ReadOnlyDomainTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, "data")
+        os.mkdir(self._path)
+        with open(os.path.join(self._path, "top.yaml"), "w") as f:
+            f.write("units: {}\n")
+        with open(os.path.join(self._path, "top.yaml.lock"), "w") as f:
+            f.write(_SECRET_HASH)
+
+    def tearDown(self):
+        os.chmod(self._path, stat.S_IRWXU)
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def test_read_only_directory(self):
+        os.chmod(self._path, stat.S_IRUSR | stat.S_IXUSR)
+        if _writable(self._path):
+            self.skipTest("directory permissions aren't enforced for this user")
+        domain = new_domain("data", self._path)
+        self.assertEqual(domain.get_files_lock(["/top.yaml"]), {"/top.yaml": _SECRET_HASH})
+        self.assertFalse(os.path.exists(os.path.join(self._path, server_data._LOCK_DB)))
+
+    def test_unopenable_meta_path(self):
+        # NOTE: database can't be created under a file whatever permissions are
+        domain = new_domain("data", self._path, os.path.join(self._path, "top.yaml"))
+        self.assertEqual(domain.get_files_lock(["/top.yaml"]), {})
+        lock, error = domain.lock("/top.yaml", True, "secret", False)
+        self.assertIsNone(lock)
+        self.assertIsNotNone(error)
+
+    def test_read_only_database(self):
+        db_path = os.path.join(self._path, server_data._LOCK_DB)
+        db = sqlite3.connect(db_path)
+        with db:
+            db.execute("CREATE TABLE locks (path TEXT PRIMARY KEY, lock TEXT NOT NULL)")
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("INSERT INTO locks (path, lock) VALUES ('top.yaml', ?)", (_SECRET_HASH,))
+            db.execute("INSERT INTO meta (key, value) VALUES ('migrated', '1')")
+        db.close()
+        os.chmod(db_path, stat.S_IRUSR)
+        os.chmod(self._path, stat.S_IRUSR | stat.S_IXUSR)
+        if _writable(self._path):
+            self.skipTest("directory permissions aren't enforced for this user")
+        domain = new_domain("data", self._path)
+        self.assertEqual(domain.get_files_lock(["/top.yaml"]), {"/top.yaml": _SECRET_HASH})
+        lock, error = domain.lock("/top.yaml", True, "secret", False)
+        self.assertIsNone(lock)
+        self.assertIsNotNone(error)
+
+    def test_database_isnt_opened_on_domain_creation(self):
+        new_domain("data", self._path)
+        self.assertFalse(os.path.exists(os.path.join(self._path, server_data._LOCK_DB)))
+        self.assertTrue(os.path.isfile(os.path.join(self._path, "top.yaml.lock")))
+
+
+class DirectoryPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self._tmp, "sub"))
+        with open(os.path.join(self._tmp, "sub", "top.yaml"), "w") as f:
+            f.write("units: {}\n")
+        git = ["git", "-C", self._tmp, "-c", "user.name=test", "-c", "user.email=test@localhost"]
+        try:
+            subprocess.run(git + ["init", "-q"], check=True)
+            subprocess.run(git + ["add", "."], check=True)
+            subprocess.run(git + ["commit", "-q", "-m", "test"], check=True)
+        except (OSError, subprocess.CalledProcessError):
+            self._git = None
+        else:
+            self._git = new_domain("gittest", f"git://{self._tmp}@/HEAD^")
+        self._local = new_domain("localtest", self._tmp)
+
+    def tearDown(self):
+        for name in ("gittest", "localtest"):
+            server._DOMAINS.pop(name, None)
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def _domains(self):
+        if self._git is None:
+            return [self._local]
+        return [self._local, self._git]
+
+    def test_isdir(self):
+        for domain in self._domains():
+            for path in ("/", "/sub", "/sub/"):
+                self.assertTrue(domain.isdir(path), f"{domain.name}: {path}")
+            for path in ("/sub/top.yaml", "/missing", "/su"):
+                self.assertFalse(domain.isdir(path), f"{domain.name}: {path}")
+
+    def test_build_directory(self):
+        for domain in self._domains():
+            server._DOMAINS[domain.name] = domain
+            with self.assertRaisesRegex(ValueError, "is directory, not file"):
+                server.build_schm(TOOL_D3HW, f"{domain.name}/sub", False, create=True)
+            server.build_schm(TOOL_D3HW, f"{domain.name}/sub/top.yaml", False)
+
+
+if __name__ == "__main__":
+    unittest.main()
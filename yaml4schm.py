@@ -1,15 +1,28 @@
 import copy
+import functools
 import os
 import yaml
 import json
 import re
+import sys
+import hashlib
+import time
+import threading
 import argparse
 from yaml4schm_defs import *
 from operators import Expression, parse_line
+from remote_files import is_url, url_dir, resolve_url, scan_refs, scan_urls, default_fetcher, set_default_fetcher, HttpFetcher
+from render_cache import RenderCache, key, default_cache, open_cache
 
 _SKIP_TODO        = True
 _IGNORE_UNCERTAIN = True
 
+_MEMO_VARIANTS = 8      # Differently processed variants of a unit's definition that are kept within a build
+_MEMO_DEPTH = 16        # Units nested into this many units that are being memoized aren't memoized
+_DISPLAY_REGEXES = 16384    # Compiled display rules that are kept
+_DIG_DEPTH = 100        # Default credits for digging into units that are displayed as symbols, see _process_unit_instance
+_HDELK_FANOUT = 0       # Nets of more edges (sources by targets) are drawn thru junction node by HDElk, 0 - never
+
 _VERSION = "2.1a0.0"
 _VERSION_HISTORY = {
     "2.1": "Basic support for operators (though work and checks still WIP)",
@@ -22,13 +35,17 @@ Provides generation of HTML with hardware schematic from textual description
 in YAML format.
 Uses HDElk or d3-schematic tools to generate graphics
 """
-# TODO: recursion protection
 # TODO: add custom styles
 # TODO: intermediate nets for expressions
 # TODO:
 # TODO: documentation
 
 _ROOT_PATH = None
+_FILES = None
+"""
+Files provider (like server_data.DataDomain). If specified then files are read with it's `get_file`
+and looked up with it's `list_files` instead of local file system. Paths are relative to provider's root
+"""
 
 
 def find_file(root: str, filename: str) -> str or None:
@@ -39,6 +56,12 @@ def find_file(root: str, filename: str) -> str or None:
     :return: full file path if found otherwise None
     """
     f_low = filename.lower()
+    if _FILES is not None:
+        # Same as with os.walk below - files from upper levels of hierarchy are prior
+        for fp in sorted(_FILES.list_files(), key=lambda x: (x.count("/"), x)):
+            if os.path.split(fp)[1].lower() in (f_low, f_low+".yaml", f_low+".yml"):
+                return fp
+        return None
     for root, dirs, files in os.walk(_ROOT_PATH):
         fl = [fn.lower() for fn in files]
         for fn in (f_low, f_low+".yaml", f_low+".yml"):
@@ -47,6 +70,13 @@ def find_file(root: str, filename: str) -> str or None:
     return None
 
 
+def _file_dir(filepath: str) -> str:
+    """ Returns directory of file to guess paths from, for remote file it keeps the file's base """
+    if is_url(filepath):
+        return url_dir(filepath)
+    return os.path.split(filepath)[0]
+
+
 def guess_filepath(root: str, path: str) -> str:
     """
     Guesses full file path by given path
@@ -55,12 +85,13 @@ def guess_filepath(root: str, path: str) -> str:
     Special patterns for path:
         If path starts with @ then it's relative to _ROOT_PATH
         If path is within angle braces < > then path should be a filename and it would be searched within _ROOT_PATH
+        If path is URL (i.e. https://host/base@/path) then it's remote file
+        Paths within remote files are resolved relative to remote file, `@` paths - relative to it's base
+        (files within angle braces are still searched within _ROOT_PATH)
     :return: full file path
     """
-    if path[0:1] == "@":
-        if _ROOT_PATH is None:
-            raise ValueError("For usage of paths, starting with `@`, a root path should be specified")
-        return os.path.join(_ROOT_PATH, path[1:])
+    if is_url(path):
+        return path
     if path[0:1] == "<" and path[-1:] == ">":
         if _ROOT_PATH is None:
             raise ValueError("For usage of paths inside angle braces, i.e `<`,`>`, a root path should be specified")
@@ -68,24 +99,536 @@ def guess_filepath(root: str, path: str) -> str:
         if r is None:
             raise ValueError(f"File {path} wasn't found within {_ROOT_PATH}")
         return r
+    if is_url(root):
+        return resolve_url(root, path)
+    if path[0:1] == "@":
+        if _ROOT_PATH is None:
+            raise ValueError("For usage of paths, starting with `@`, a root path should be specified")
+        return os.path.join(_ROOT_PATH, path[1:])
     return os.path.join(root, path)  # TODO: more sophisticated guessing like libs looking (i.e "lib:unit") etc
 
 
-def _load(filepath: str, unit: bool = False, yaml_string: str = None) -> dict:
+# NOTE: hierarchy could be arbitrary deep (i.e. generated one), so trees are walked with explicit stack
+#       instead of recursion, which is limited by interpreter's recursion limit
+
+def _children(unit: dict) -> list:
+    return unit.get("children", [])
+
+
+def _walk_tree(root, nested=_children, leave=None):
+    """
+    Walks tree depth-first, in the same order as recursion does
+    :param root: tree's root
+    :param nested: callable(node) that returns list of node's nested nodes. It's called after node is yielded,
+        so caller could change node's nested nodes
+    :param leave: callable(node) that is called when node and all of it's nested nodes are walked
+    :return: generator of nodes
+    """
+    stack = [root]
+    if leave is None:
+        while len(stack) > 0:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(nested(node)))
+        return
+    leaving = object()
+    while len(stack) > 0:
+        node = stack.pop()
+        if node is leaving:
+            leave(stack.pop())
+            continue
+        yield node
+        stack.append(node)
+        stack.append(leaving)
+        stack.extend(reversed(nested(node)))
+
+
+def _iterative(func):
+    """
+    Makes recursive generator function to be run with explicit stack (see _run).
+    Within such function nested call is made as `result = yield other.step(args)`, where `other` is a function
+    that is also decorated with _iterative. Decorated function is called as usual
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        return _run(func(*args, **kwargs))
+    run.step = func
+    return run
+
+
+def _run(steps):
+    """
+    Runs function decorated with _iterative. Nested calls are pushed to explicit stack, their results
+    (or raised exceptions) are sent back into caller
+    :param steps: generator of the function
+    :return: function's result
+    """
+    stack = [steps]
+    value = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                nested = stack[-1].send(value)
+            else:
+                thrown, error = error, None
+                nested = stack[-1].throw(thrown)
+        except StopIteration as e:
+            stack.pop()
+            if len(stack) == 0:
+                return e.value
+            value = e.value
+            continue
+        except BaseException as e:
+            stack.pop()
+            if len(stack) == 0:
+                raise
+            value, error = None, e
+            continue
+        stack.append(nested)
+        value = None
+
+
+_ATOMIC = (str, int, float, bool, type(None))
+
+
+def _deepcopy(data):
+    """
+    Same as copy.deepcopy, but dicts and lists are copied with explicit stack
+    """
+    memo = {}
+    stack = []
+
+    def _copy(x):
+        cls = type(x)
+        if cls is dict or cls is list:
+            y = memo.get(id(x), None)
+            if y is None:
+                y = memo[id(x)] = {} if cls is dict else []
+                stack.append((x, y))
+            return y
+        if cls in _ATOMIC:
+            return x
+        return copy.deepcopy(x, memo)
+
+    result = _copy(data)
+    while len(stack) > 0:
+        x, y = stack.pop()
+        if type(x) is dict:
+            for k, v in x.items():
+                y[_copy(k)] = _copy(v)
+        else:
+            y.extend(_copy(v) for v in x)
+    return result
+
+
+class BuildBudgetExceeded(ValueError):
+    pass
+
+
+_LOAD_TIME_SHARE = 0.5     # Share of build's time limit for loading of units, the rest is for render, connect, etc.
+
+
+class BuildBudget:
+    """
+    Limits of a single build
+    When any of limits is reached, nested units that aren't loaded yet are left as symbol stubs
+    Time limit is for the whole build: units are loaded within first part of it (see _LOAD_TIME_SHARE),
+    the rest is for render, connect and postprocess of loaded units. If those aren't done in time
+    then build fails with BuildBudgetExceeded
+    None means no limit
+    """
+
+    LIMITS = ("files", "units", "nets", "operators", "yaml_bytes")
+
+    def __init__(self, files: int = None, units: int = None, nets: int = None, operators: int = None,
+                 yaml_bytes: int = None, seconds: float = None, dig_depth: int = _DIG_DEPTH):
+        """
+        :param files: files to load
+        :param units: unit instances to process
+        :param nets: nets to process
+        :param operators: operators' expressions to parse
+        :param yaml_bytes: total size of loaded YAML text, in UTF-8 bytes
+        :param seconds: time of the build
+        :param dig_depth: levels of file loads to dig into units, that are displayed as symbols, for their content
+        """
+        self.files = files
+        self.units = units
+        self.nets = nets
+        self.operators = operators
+        self.yaml_bytes = yaml_bytes
+        self.seconds = seconds
+        self.dig_depth = dig_depth
+
+    @staticmethod
+    def parse(spec: str) -> "BuildBudget":
+        """
+        Makes budget out of it's specification, i.e. "files=100,units=10000,seconds=2.5"
+        Limits that aren't specified are not limited
+        """
+        kwargs = {}
+        for item in spec.split(","):
+            item = item.strip()
+            if item == "":
+                continue
+            k, sep, v = item.partition("=")
+            k = k.strip()
+            if sep == "" or k not in BuildBudget.LIMITS + ("seconds", "dig_depth"):
+                raise ValueError(f"Wrong build budget item `{item}`")
+            kwargs[k] = float(v) if k == "seconds" else int(v)
+        return BuildBudget(**kwargs)
+
+
+class _BudgetMeter:
+    """
+    Spending of a build's budget
+    """
+
+    def __init__(self, budget: BuildBudget or None):
+        self.budget = budget
+        self.spent = {k: 0 for k in BuildBudget.LIMITS}
+        now = time.monotonic()
+        seconds = None if budget is None else budget.seconds
+        self.deadline = None if seconds is None else now + seconds  # Time when the whole build should be done
+        self.load_deadline = None if seconds is None else now + seconds * _LOAD_TIME_SHARE
+        self.exceeded = None    # Description of the limit that was reached
+
+    def spend(self, **amounts) -> None:
+        for k, v in amounts.items():
+            self.spent[k] += v
+
+    def check(self) -> str or None:
+        """ Returns description of reached limit, None if there is something left in the budget """
+        if self.exceeded is None and self.budget is not None:
+            for k, v in self.spent.items():
+                limit = getattr(self.budget, k)
+                if limit is not None and v >= limit:
+                    self.exceeded = f"{k} limit ({limit}) is reached"
+                    break
+            else:
+                if self.load_deadline is not None and time.monotonic() >= self.load_deadline:
+                    self.exceeded = f"time limit ({self.budget.seconds}s) for loading of units is reached"
+        return self.exceeded
+
+
+class IncludeCycleError(ValueError):
+    pass
+
+
+class BuildContext:
+    """
+    State of a single build
+    """
+
+    def __init__(self, parent: "BuildContext" = None, budget: BuildBudget = None):
+        """
+        :param parent: context of the same build, memo of processed units and budget are shared with it
+        :param budget: limits of the build
+        """
+        self.files = {}     # Files that were read during build: file path -> content hash
+        if parent is None:
+            self.units = {}     # Memo of processed units' definitions, see _process_nested_unit
+            self.paths = {}     # Guessed file paths: (root, path) -> file path
+            self.traces = []    # Units that are being processed and memoized now, innermost is the last
+            self.definitions = {}   # Processed units that came from memo: id(unit) -> (token, unit)
+            self.root = None        # Names along hierarchical path of the only unit that is built, see cut
+            self.max_level = None   # Content of units at this level of hierarchy and below isn't loaded
+            self.meter = _BudgetMeter(budget)
+            self.stack = []         # Files that are being processed now: (file path, kind of reference to it)
+            self.includes = {}      # Resolved references: file path -> {referred file path -> kind of reference}
+        else:
+            self.units = parent.units
+            self.paths = parent.paths
+            self.traces = parent.traces
+            self.definitions = parent.definitions
+            self.root = parent.root
+            self.max_level = parent.max_level
+            self.meter = parent.meter
+            self.stack = parent.stack
+            self.includes = parent.includes
+
+    def include(self, filepath: str, kind: str) -> None:
+        """
+        Notes that file is referred by the file that is being processed now, and that it's being processed
+        :param filepath: referred file path
+        :param kind: kind of reference, i.e. "unit" or "source".
+            "text" is for top unit that is loaded from text instead of file (it's not a part of cycles)
+        """
+        if len(self.stack) > 0:
+            self.includes.setdefault(self.stack[-1][0], {})[filepath] = kind
+        for i, (fp, k) in enumerate(self.stack):
+            if fp == filepath and k != "text":
+                chain = [self.stack[i][0]] + [f"({k}) {fp}" for fp, k in self.stack[i+1:]] + [f"({kind}) {filepath}"]
+                raise IncludeCycleError("Include cycle: " + " -> ".join(chain))
+        self.stack.append((filepath, kind))
+
+    def included(self) -> None:
+        """ Notes that file, that were referred last, is processed """
+        self.stack.pop()
+
+    def rendered(self) -> None:
+        """ Notes that loaded units are rendered, so references to them (memo and definitions) are released """
+        self.units.clear()
+        self.definitions.clear()
+
+    def cut(self, root: str = None, depth: int = None) -> None:
+        """
+        Limits build to a part of hierarchy, units outside of it aren't loaded
+        :param root: hierarchical path of unit to build (i.e. /U1/X1), it's ancestors are kept only as it's containers
+        :param depth: levels of nested units under root to build, units at the last level are built without content
+        """
+        self.root = [] if root is None else [name for name in root.split("/") if name != ""]
+        self.max_level = None if depth is None else len(self.root) + depth
+
+    def is_cut(self) -> bool:
+        return self.root is not None and (len(self.root) > 0 or self.max_level is not None)
+
+    def root_ancestor(self, hierpath: str) -> bool:
+        """ Checks whether unit is an ancestor of the root (see cut) """
+        if self.root is None:
+            return False
+        names = hierpath.split("/")[1:]
+        return len(names) < len(self.root) and self.root[:len(names)] == names
+
+    def note_file(self, filepath: str, file_hash: str) -> None:
+        """ Notes file as build's dependency """
+        self.files[filepath] = file_hash
+        for trace in self.traces:
+            trace.files[filepath] = file_hash
+
+    def guess_filepath(self, root: str, path: str) -> str:
+        """
+        Same as guess_filepath, but every path is guessed once per build
+        If path is resolved relative to _ROOT_PATH then _ROOT_PATH is noted as build's dependency (see _ROOT_DEP)
+        """
+        filepath = self.paths.get((root, path), None)
+        if filepath is None:
+            filepath = self.paths[(root, path)] = guess_filepath(root, path)
+        if not is_url(path) and ((path[0:1] == "<" and path[-1:] == ">") or (path[0:1] == "@" and not is_url(root))):
+            self.note_file(_ROOT_DEP, _file_hash(_ROOT_DEP))
+        return filepath
+
+    def get_display(self, hierpath: str, display: dict) -> dict:
+        """ Same as _get_display, but the query is noted by units that are being memoized """
+        for trace in self.traces:
+            trace.query(hierpath)
+        return _get_display(hierpath, display)
+
+    def memo_get(self, memo_key: tuple, hierpath: str, localpath: str, display: dict) -> dict or None:
+        """
+        Looks for processed definition of a unit
+        :param memo_key: definition's file path and processing options
+        :param hierpath: unit's path in whole hierarchy
+        :param localpath: unit's path with reference to file
+        :param display: all display rules at hosting unit's level of hierarchy
+        :return: copy of processed definition, relocated to given path, or None if there is no suitable one
+        """
+        for trace, unit in self.units.get(memo_key, ()):
+            if trace.matches(hierpath, display):
+                self.meter.spend(**trace.cost)
+                token = id(unit)
+                unit = _deepcopy(unit)
+                unit[A_LOCALPATH] = localpath
+                self.definitions[id(unit)] = (token, unit)
+                for filepath, file_hash in trace.files.items():
+                    self.note_file(filepath, file_hash)
+                for relpath in trace.queries:
+                    for outer in self.traces:
+                        outer.query(hierpath + relpath)
+                return unit
+        return None
+
+    def memo_put(self, memo_key: tuple, trace: "_DisplayTrace", unit: dict) -> None:
+        """ Keeps processed definition of a unit, see memo_get """
+        variants = self.units.setdefault(memo_key, [])
+        variants.insert(0, (trace, _deepcopy(unit)))
+        self.definitions[id(unit)] = (id(variants[0][1]), unit)
+        del variants[_MEMO_VARIANTS:]
+
+    def definition(self, unit: dict):
+        """
+        Identifies processed unit's definition
+        :return: token that is the same for units that came from the same memoized definition or None
+        """
+        token, known_unit = self.definitions.get(id(unit), (None, None))
+        return token if known_unit is unit else None
+
+
+@functools.lru_cache(maxsize=_DISPLAY_REGEXES)
+def _display_regex(rule: str):
+    """
+    Compiles display rule's key. Keys are bound to units' paths, so there are more of them in deep hierarchy
+    than re module caches (and every match would compile the key again)
+    """
+    return re.compile("^"+rule+"$")
+
+
+def _matched_display(hierpath: str, display: dict) -> list:
+    """ Returns display rules that match unit's hierarchical path, same way as _get_display does """
+    if hierpath == "":
+        hierpath = "/"
+    return [(k, v) for k, v in display.items() if _display_regex(k).match(hierpath) is not None]
+
+
+class _DisplayTrace:
+    """
+    Notes how a unit was processed: display rules from outside of the unit that were matched by it's hierarchy
+    and files that were read.
+    Unit's own display rules are bound to it's path, so they match the same way wherever the unit is placed.
+    The unit is processed the same way at another place of hierarchy if the rules from outside match it the same way
+    (and it's at the same level of hierarchy, since rules of higher levels are prior)
+    """
+
+    def __init__(self, hierpath: str, display: dict):
+        """
+        :param hierpath: unit's path in whole hierarchy
+        :param display: all display rules at hosting unit's level of hierarchy
+        """
+        self.hierpath = hierpath
+        self.display = display or {}
+        self.queries = {}   # Path relative to unit -> display rules from outside that match it
+        self.files = {}     # Files that were read while processing: file path -> content hash
+        self.cost = {}      # Spent budget (except files loads)
+
+    def query(self, hierpath: str) -> None:
+        relpath = hierpath[len(self.hierpath):]
+        if relpath not in self.queries:
+            self.queries[relpath] = copy.deepcopy(_matched_display(hierpath, self.display))
+
+    def matches(self, hierpath: str, display: dict) -> bool:
+        display = display or {}
+        return all(_matched_display(hierpath + relpath, display) == matched
+                   for relpath, matched in self.queries.items())
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def _read_text(filepath: str, ctx: BuildContext = None) -> str:
+    """
+    Reads file content as text either from local file system or with _FILES provider
+    :param filepath: file path
+    :param ctx: build context. If specified then file is noted as build's dependency
+    :return: file content
+    """
+    if is_url(filepath):
+        text = default_fetcher().fetch(filepath).decode("utf-8")
+    elif _FILES is None:
+        with open(filepath, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        result, error = _FILES.get_file(filepath, ["content"])
+        if error is not None:
+            raise ValueError(error)
+        if result["content"] is None:
+            raise FileNotFoundError(f"File {filepath} is not found within {_FILES.name}")
+        text = result["content"]
+    if ctx is not None:
+        ctx.note_file(filepath, _text_hash(text))
+    return text
+
+
+_ROOT_DEP = "<_ROOT_PATH>"
+"""
+Pseudo file that build depends on if some of paths were resolved relative to _ROOT_PATH,
+it's "content" is resolved _ROOT_PATH itself
+"""
+
+
+def _file_hash(filepath: str) -> str:
+    """ Returns hash of file's current content, same as noted in BuildContext """
+    if filepath == _ROOT_DEP:
+        return _text_hash("" if _ROOT_PATH is None else _dep_path(_ROOT_PATH))
+    return _text_hash(_read_text(filepath))
+
+
+def _dep_prefix() -> str or None:
+    """ Returns prefix of resolved paths of files that are read with non-local _FILES provider """
+    if _FILES is None or _FILES.local:
+        return None
+    return f"{type(_FILES).__name__}:{_FILES.path}:"
+
+
+def _dep_path(filepath: str) -> str:
+    """
+    Returns resolved path of file as it's kept in render cache: the same for any spelling of path,
+    working directory or way the file is read (directly or with local _FILES provider)
+    """
+    if filepath == _ROOT_DEP or is_url(filepath):
+        return filepath
+    if _FILES is None:
+        return os.path.abspath(filepath)
+    if _FILES.local:
+        return os.path.abspath(os.path.join(_FILES.path, filepath.lstrip("/")))
+    return _dep_prefix() + filepath
+
+
+def _dep_hash(dep_path: str) -> str:
+    """ Returns hash of current content of file by it's resolved path (see _dep_path) """
+    if dep_path == _ROOT_DEP or is_url(dep_path):
+        return _file_hash(dep_path)
+    prefix = _dep_prefix()
+    if prefix is not None:
+        if dep_path[:len(prefix)] != prefix:
+            raise FileNotFoundError(f"File {dep_path} is not within {_FILES.name}")
+        return _file_hash(dep_path[len(prefix):])
+    if _FILES is not None and os.path.commonpath([os.path.abspath(_FILES.path), dep_path]) != \
+            os.path.abspath(_FILES.path):
+        # NOTE: schematic that was built out of files outside of provider's root isn't taken from cache
+        raise FileNotFoundError(f"File {dep_path} is not within {_FILES.name}")
+    with open(dep_path, "r", encoding="utf-8") as f:
+        return _text_hash(f.read())
+
+
+def _prefetch(filepath: str, text: str) -> None:
+    """
+    Starts concurrent fetching of remote files that are referred by `unit` and `source` nodes of given text
+    Doesn't wait for completion, files are taken from cache later when actually loaded
+    :param filepath: file path of text
+    :param text: file content
+    """
+    root = _file_dir(filepath)
+    urls = []
+    paths = []
+    for ref in scan_refs(text):
+        try:
+            path = guess_filepath(root, ref)
+        except ValueError:
+            continue
+        if is_url(path):
+            urls.append(path)
+        else:
+            paths.append(path)
+    if len(urls) > 0:
+        default_fetcher().prefetch(urls, discover=scan_urls)
+    if len(paths) > 0 and hasattr(_FILES, "prefetch"):
+        _FILES.prefetch(paths)
+
+
+def _load(filepath: str, unit: bool = False, yaml_string: str = None, ctx: BuildContext = None) -> dict:
     """
     Loads data from given yaml file
     Processes special nodes like "source" and "merge"
     :param filepath: file path
     :param unit: loaded data is unit definition, otherwise it's treated just as structure text (YAML format)
     :param yaml_string: if set then data is loaded from yaml_string, filepath is used as root path when referencing to other files
+    :param ctx: build context
     :return: loaded data
     """
     # TODO: input filter to separate data from it's surroundings
     if yaml_string is None:
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f)
-    else:
-        data = yaml.safe_load(yaml_string)
+        yaml_string = _read_text(filepath, ctx)
+    if ctx is not None:
+        # NOTE: size is in UTF-8 bytes, not characters, ASCII text (most of files) isn't encoded to count them
+        size = len(yaml_string) if yaml_string.isascii() else len(yaml_string.encode("utf-8"))
+        limit = None if ctx.meter.budget is None else ctx.meter.budget.yaml_bytes
+        if limit is not None and ctx.meter.spent["yaml_bytes"] + size > limit:
+            ctx.meter.exceeded = f"yaml_bytes limit ({limit}) is reached"
+            raise BuildBudgetExceeded(f"File {filepath} isn't loaded, {ctx.meter.exceeded}")
+        ctx.meter.spend(files=1, yaml_bytes=size)
+    _prefetch(filepath, yaml_string)
+    data = yaml.safe_load(yaml_string)
     # TODO: check file exists, return stub if not
 
     data[A_FILEPATH] = filepath
@@ -104,29 +647,38 @@ def _load(filepath: str, unit: bool = False, yaml_string: str = None) -> dict:
             data["display"][""] = {"view": VIEW_FULL}
 
     # Process "source" nodes
-    data = _source(filepath, data)
+    data = _source(filepath, data, ctx)
 
     # Process "merge" nodes
     _merge(data)
     return data
 
 
-def _source(parentpath: str, node: dict):
+def _source(parentpath: str, node: dict, ctx: BuildContext = None):
     """
     Processes "source" nodes - loads data from external file into node, that hosts "source" node
     Filepath if determined by value of "source" node
     Data in file should be a dict
     :param parentpath: filepath of node's source
     :param node: node that should be processed
+    :param ctx: build context
     :return: alternate node version
     """
     data = {}
     for k, v in node.items():
         if k == "source":
             # Load data
-            source_path = guess_filepath(os.path.split(parentpath)[0], v)
+            if ctx is None:
+                source_path = guess_filepath(_file_dir(parentpath), v)
+                partial = _load(source_path)
+            else:
+                source_path = ctx.guess_filepath(_file_dir(parentpath), v)
+                ctx.include(source_path, "source")
+                try:
+                    partial = _load(source_path, ctx=ctx)
+                finally:
+                    ctx.included()
             # TODO: make stub in case of error
-            partial = _load(source_path)
             # Merge loaded data
             data = {**data, **partial}
             # Take a note that data were loaded and from where
@@ -134,7 +686,7 @@ def _source(parentpath: str, node: dict):
             data[A_FILEPATH] = source_path
         elif isinstance(v, dict):
             # Recurse if nested node is a dict
-            data[k] = _source(parentpath, v)
+            data[k] = _source(parentpath, v, ctx)
         else:
             # Otherwise keep previous value
             data[k] = v
@@ -178,21 +730,54 @@ def _merge_nodes(src: dict, dst: dict):
             dst[k] = v
 
 
-def _rndr(data: dict, key: str, default=None):
-    if RNDR in data and key in data[RNDR]:
-        return data[RNDR][key]
-    elif default is not None:
-        if RNDR not in data:
-            data[RNDR] = {}
-        data[RNDR][key] = default
-        return default
-    return None
-
+class RenderMeta:
+    """
+    Renderer's metadata of rendered items (units, ports, nets): attributes that aren't a part of tool's format,
+    nets of units, state of connection, etc. (attributes which are mapped to RNDR)
+    Metadata is kept aside of items (by item's identity), so rendered items are final as they are built
+    Table is owned by the build: it's filled by render_unit and is used by connect and postprocess
+    """
 
-def _rndr_set(data: dict, key: str, value) -> None:
-    if RNDR not in data:
-        data[RNDR] = {}
-    data[RNDR][key] = value
+    def __init__(self, deadline: float = None):
+        """
+        :param deadline: time (time.monotonic) when build should be done, see check_deadline
+        """
+        self._items = {}    # id(item) -> (item, metadata), item is referenced, so it's id isn't reused
+        self.d3hw_ids = D3hwIds()   # Numeric ids of items for d3hw
+        self.deadline = deadline
+
+    def check_deadline(self) -> None:
+        """
+        Stops the build if it's time limit is reached
+        Called by stages that use the table for every unit / scope, so post-load work is bounded too
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BuildBudgetExceeded("Build isn't completed, it's time limit is reached")
+
+    def of(self, item: dict) -> dict or None:
+        """ Returns item's metadata, None if item has no metadata """
+        entry = self._items.get(id(item), None)
+        return None if entry is None else entry[1]
+
+    def get(self, item: dict, key: str, default=None):
+        """ Returns item's metadata value. If there is no value then default is set (unless it's None) and returned """
+        entry = self._items.get(id(item), None)
+        if entry is not None and key in entry[1]:
+            return entry[1][key]
+        elif default is not None:
+            self.set(item, key, default)
+            return default
+        return None
+
+    def set(self, item: dict, key: str, value) -> None:
+        entry = self._items.get(id(item), None)
+        if entry is None:
+            entry = self._items[id(item)] = (item, {})
+        entry[1][key] = value
+
+    def put(self, item: dict, metadata: dict) -> None:
+        """ Sets whole item's metadata """
+        self._items[id(item)] = (item, metadata)
 
 
 def _check_allowed(data: dict, allowed: dict, filepath: str, hierpath: str, section: str):
@@ -223,8 +808,9 @@ def _next_localpath(localpath, k):
         return _next_hierpath(localpath, k)
 
 
+@_iterative
 def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localpath: str = "", display: dict = None, view: str = None,
-                           dig: bool = False, dig_depth: int = -1):
+                           dig: bool = False, dig_depth: int = -1, ctx: BuildContext = None, process_nested=None):
     """
     Determines actual view options for given unit, updates nested units as necessary
     :param data: node with unit's definition
@@ -235,6 +821,9 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
     :param view: view kind for this unit. None if view kind should be determined from display rules
     :param dig: dig further into unit's instance content even if unit would be displayed as symbol
     :param dig_depth: credits for digging. when reached to zero then digging stopped. reduced with every outer file load
+    :param ctx: build context
+    :param process_nested: callable(name, instance, job, ctx) that processes nested unit's instance instead of
+        _process_nested_unit(instance, *job, ctx). Applied only to this unit's nested units
     :return: nothing. it changes data itself
     """
 
@@ -267,6 +856,9 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
 
     _check_all_allowed(data["nets"], YAML_NET_ALLOWED, _filepath(), hierpath, "nets")
 
+    if ctx is not None:
+        ctx.meter.spend(units=1, nets=len(data["nets"]), operators=len(data.get("operators") or {}))
+
     # Update display information
     ## First use loaded
     active_display = {}
@@ -279,7 +871,8 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
             active_display[k] = v
 
     # Check how this part should be displayed before doing anything else
-    data["display"] = this_display = _get_display(hierpath, active_display)
+    get_display = _get_display if ctx is None else ctx.get_display
+    data["display"] = this_display = dict(get_display(hierpath, active_display))
 
     if view is None:
         this_view = this_display.get("view", VIEW_SYMBOL)
@@ -305,6 +898,22 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
     elif this_view == VIEW_NESTED:      # In NESTED view nested units are displayed according to their own view settings
         nested_view = None
 
+    if ctx is not None and ctx.root is not None:
+        level = hierpath.count("/")
+        if ctx.max_level is not None and level >= ctx.max_level:
+            # Below requested depth - nested units aren't loaded
+            data["units"] = {}
+            data["nets"] = []
+            data["operators"] = {}
+        elif ctx.root_ancestor(hierpath):
+            # Only nested unit on the way to the root is loaded, nets would be cut away anyway
+            data["units"] = {k: v for k, v in data["units"].items() if k == ctx.root[level]}
+            data["nets"] = []
+            data["operators"] = {}
+            for v in data["units"].values():
+                v.pop("nets", None)
+                v.pop("operators", None)
+
     # Process operators
     op_units = {}
     if "operators" in data:
@@ -334,6 +943,8 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
     for k, v in nested_units.items():
         # Process instance specific operators
         if "operators" in v:
+            if ctx is not None:
+                ctx.meter.spend(operators=len(v["operators"] or {}))
             for target, expression in v["operators"].items():
                 # print(f"Parsing expression `{expression}` for target `{target}`")
                 expr = Expression("", [0], relative_path=k)
@@ -377,34 +988,166 @@ def _process_unit_instance(data: dict, filepath: str, hierpath: str = "", localp
             part_view = nested_view
         else:
             # Otherwise - get view according to unit hierarchical path
-            part_display = _get_display(part_hierpath, active_display)  # TODO: also load display from instance
+            part_display = get_display(part_hierpath, active_display)  # TODO: also load display from instance
             part_view = part_display.get("view", VIEW_SYMBOL)
 
-        if isinstance(v["unit"], str):
-            loaded = True   # loaded = True if unit were loaded from outer file
-            nested_filepath = guess_filepath(os.path.split(_filepath())[0], v["unit"])
-            v["unit"] = _load(nested_filepath, unit=True)
-            # TODO: make stub in case of error
-        else:
-            loaded = False  # loaded = False if unit were explicitly described within it's hosting unit data
-            nested_filepath = _filepath()
-
-        _check_allowed(v["unit"],  YAML_UNIT_ALLOWED, filepath, part_hierpath, hierpath+"/units/"+k)
-
-        if isinstance(v["unit"], dict):
-            _process_unit_instance(
-                v["unit"], nested_filepath, part_hierpath, part_localpath, active_display, part_view,
-                dig,
-                # If this unit were loaded and digging is active - reduce dig_depth
-                [dig_depth, max(dig_depth-1, 0)][dig and loaded and dig_depth > 0]
-                )
+        job = (filepath, _filepath(), hierpath+"/units/"+k, part_hierpath, part_localpath, active_display, part_view,
+               dig, dig_depth)
+        if process_nested is None:
+            yield _process_nested_unit.step(v, *job, ctx)
         else:
-            raise ValueError(
-                f"Unit instance should be a dict or string with path to description file! Got: {type(v['unit'])}")
+            process_nested(k, v, job, ctx)
 
         filepath_list = filepath_list[:-1]
 
 
+@_iterative
+def _process_nested_unit(v: dict, filepath: str, unit_filepath: str, section: str, hierpath: str, localpath: str,
+                         display: dict, view: str, dig: bool, dig_depth: int, ctx: BuildContext = None):
+    """
+    Loads nested unit's definition if necessary and processes it
+    :param v: nested unit's instance
+    :param filepath: filepath for source of hosting unit
+    :param unit_filepath: filepath for source of the instance
+    :param section: instance's location in hosting unit (for error messages)
+    :param hierpath: nested unit's path in whole hierarchy
+    :param localpath: nested unit's path with reference to file
+    :param display: all display rules at this level of hierarchy
+    :param view: view kind for nested unit
+    :param dig: same as for _process_unit_instance
+    :param dig_depth: hosting unit's credits for digging
+    :param ctx: build context
+    :return: nothing. it changes v itself
+    """
+    if ctx is None:
+        yield _load_nested_unit.step(v, filepath, unit_filepath, section, hierpath, localpath, display, view, dig,
+                                     dig_depth)
+        return
+
+    exceeded = ctx.meter.check()
+    if exceeded is None:
+        unit = v["unit"]
+        try:
+            yield _load_nested_unit.step(v, filepath, unit_filepath, section, hierpath, localpath, display, view, dig,
+                                         dig_depth, ctx)
+            return
+        except BuildBudgetExceeded:
+            v["unit"] = unit
+            exceeded = ctx.meter.exceeded
+    _stub_nested_unit(v, unit_filepath, hierpath, localpath, display, exceeded, ctx)
+
+
+def _stub_nested_unit(v: dict, unit_filepath: str, hierpath: str, localpath: str, display: dict, reason: str,
+                      ctx: BuildContext = None):
+    """
+    Replaces nested unit's definition with symbol stub, that keeps only unit's type and I/O (if those are known)
+    See _process_nested_unit for params
+    :param reason: why unit isn't loaded
+    """
+    unit = v["unit"]
+    if isinstance(unit, dict):
+        stub = {k: copy.deepcopy(unit[k]) for k in ("io", "attributes") if unit.get(k) is not None}
+    else:
+        stub = {"attributes": {"type": re.sub(r"\.[^.]*$", "", os.path.split(str(unit))[-1])}}
+    stub.setdefault("attributes", {})
+    stub["attributes"][A_MISSING] = True
+    stub["attributes"]["text"] = f"Not loaded: {reason}"
+    v["unit"] = stub
+    _process_unit_instance(stub, unit_filepath, hierpath, localpath, display, VIEW_SYMBOL, False, 0, ctx)
+
+
+@_iterative
+def _load_nested_unit(v: dict, filepath: str, unit_filepath: str, section: str, hierpath: str, localpath: str,
+                      display: dict, view: str, dig: bool, dig_depth: int, ctx: BuildContext = None):
+    """
+    Loads nested unit's definition if necessary and processes it, see _process_nested_unit
+    """
+    if isinstance(v["unit"], str) and ctx is not None:
+        nested_filepath = ctx.guess_filepath(_file_dir(unit_filepath), v["unit"])
+        ctx.include(nested_filepath, "unit")
+        try:
+            yield _load_nested_file.step(v, nested_filepath, filepath, section, hierpath, localpath, display, view,
+                                         dig, dig_depth, ctx)
+        finally:
+            ctx.included()
+        return
+
+    if isinstance(v["unit"], str):
+        loaded = True   # loaded = True if unit were loaded from outer file
+        nested_filepath = guess_filepath(_file_dir(unit_filepath), v["unit"])
+        v["unit"] = _load(nested_filepath, unit=True)
+        # TODO: make stub in case of error
+    else:
+        loaded = False  # loaded = False if unit were explicitly described within it's hosting unit data
+        nested_filepath = unit_filepath
+        if ctx is not None:
+            # NOTE: definition is processed once more in place (i.e. it's shared by YAML alias), so it's changed
+            ctx.definitions.pop(id(v["unit"]), None)
+
+    yield _process_definition.step(v, filepath, nested_filepath, section, hierpath, localpath, display, view, dig,
+                                   dig_depth, loaded, ctx)
+
+
+@_iterative
+def _load_nested_file(v: dict, nested_filepath: str, filepath: str, section: str, hierpath: str, localpath: str,
+                      display: dict, view: str, dig: bool, dig_depth: int, ctx: BuildContext):
+    """
+    Loads nested unit's definition from file and processes it, see _process_nested_unit
+    :param nested_filepath: path of file with definition
+    """
+    if ctx.root_ancestor(hierpath) or len(ctx.traces) >= _MEMO_DEPTH:
+        # NOTE: root's ancestors are cut (see BuildContext.cut), so they aren't memoized
+        #       Every unit that is being memoized traces all of it's nested units, so units that are nested
+        #       too deep into units that are being memoized aren't memoized (otherwise time would grow cubic with depth)
+        v["unit"] = _load(nested_filepath, unit=True, ctx=ctx)
+        yield _process_definition.step(v, filepath, nested_filepath, section, hierpath, localpath, display, view, dig,
+                                       dig_depth, True, ctx)
+        return
+
+    # NOTE: every instance of a definition (i.e. multiple lanes of the same unit) is processed the same way
+    #       if it's processed with the same options and it's display rules are the same.
+    #       So definition is processed once, other instances take a copy
+    #       File's content doesn't change within a build, so the file path identifies it
+    memo_key = (nested_filepath, view, dig, dig_depth, hierpath.count("/"))
+    unit = ctx.memo_get(memo_key, hierpath, localpath, display)
+    if unit is not None:
+        v["unit"] = unit
+        return
+    spent = dict(ctx.meter.spent)
+    ctx.traces.append(_DisplayTrace(hierpath, display))
+    try:
+        v["unit"] = _load(nested_filepath, unit=True, ctx=ctx)
+        yield _process_definition.step(v, filepath, nested_filepath, section, hierpath, localpath, display, view, dig,
+                                       dig_depth, True, ctx)
+    finally:
+        trace = ctx.traces.pop()
+    trace.cost = {k: ctx.meter.spent[k] - spent[k] for k in ("units", "nets", "operators")}
+    ctx.memo_put(memo_key, trace, v["unit"])
+
+
+@_iterative
+def _process_definition(v: dict, filepath: str, nested_filepath: str, section: str, hierpath: str, localpath: str,
+                        display: dict, view: str, dig: bool, dig_depth: int, loaded: bool, ctx: BuildContext = None):
+    """
+    Processes nested unit's definition, see _process_nested_unit
+    :param nested_filepath: filepath for source of the definition
+    :param loaded: True if definition were loaded from outer file
+    """
+    _check_allowed(v["unit"],  YAML_UNIT_ALLOWED, filepath, hierpath, section)
+
+    if isinstance(v["unit"], dict):
+        yield _process_unit_instance.step(
+            v["unit"], nested_filepath, hierpath, localpath, display, view,
+            dig,
+            # If this unit were loaded and digging is active - reduce dig_depth
+            [dig_depth, max(dig_depth-1, 0)][dig and loaded and dig_depth > 0],
+            ctx
+            )
+    else:
+        raise ValueError(
+            f"Unit instance should be a dict or string with path to description file! Got: {type(v['unit'])}")
+
+
 def _get_display(hierpath: str, display: dict) -> dict:
     """
     Looks for display rules for specified unit
@@ -417,7 +1160,7 @@ def _get_display(hierpath: str, display: dict) -> dict:
     this_display = None
     this_display_level = None
     for k, v in display.items():
-        if re.match("^"+k+"$", hierpath) is not None:
+        if _display_regex(k).match(hierpath) is not None:
             display_level = sum(c == "/" for c in k)
             if this_display_level is None \
             or this_display_level > display_level:  # Settings from higher levels of hierarchy are prior
@@ -429,7 +1172,8 @@ def _get_display(hierpath: str, display: dict) -> dict:
     return this_display
 
 
-def load_unit(filepath: str, hierpath: str = "", localpath: str = "", display: dict = None, view: str = None, yaml_string: str = None) -> dict:
+def load_unit(filepath: str, hierpath: str = "", localpath: str = "", display: dict = None, view: str = None, yaml_string: str = None,
+              ctx: BuildContext = None, process_nested=None) -> dict:
     """
     Loads part/schematic description from yaml file
     :param filepath: path to file with data
@@ -437,11 +1181,21 @@ def load_unit(filepath: str, hierpath: str = "", localpath: str = "", display: d
     :param display: display settings
     :param view: override view from display
     :param yaml_string: if set then data is loaded from yaml_string, filepath is used as root path when referencing to other files
+    :param ctx: build context
+    :param process_nested: same as for _process_unit_instance
     :return: schematic description
     """
-    data = _load(filepath, unit=True, yaml_string=yaml_string)
-    _process_unit_instance(data, filepath, hierpath, localpath, display, view,
-                           dig=True, dig_depth=100)  # TODO: define whether to dig or not and how deep
+    if ctx is None:
+        ctx = BuildContext()
+    ctx.include(filepath, "unit" if yaml_string is None else "text")
+    try:
+        data = _load(filepath, unit=True, yaml_string=yaml_string, ctx=ctx)
+        dig_depth = _DIG_DEPTH if ctx.meter.budget is None else ctx.meter.budget.dig_depth
+        _process_unit_instance(data, filepath, hierpath, localpath, display, view,
+                               dig=True, dig_depth=dig_depth, ctx=ctx,  # TODO: define whether to dig or not
+                               process_nested=process_nested)
+    finally:
+        ctx.included()
     return data
 
 
@@ -468,14 +1222,16 @@ def _to_target(data: dict, target: dict, exclude: list or tuple) -> None:
                 _to_target(data[k], target[k], [])
 
 
-def _map_attribute(node: dict, keys: list or tuple, value) -> None:
+def _map_attribute(node: dict, keys: list or tuple, value, meta: RenderMeta) -> None:
     """
     Recursion worker for _map_attributes function
     :param node: current node
     :param keys: list with fields names in hierarchical order.
     if only one key left then value is applied to node's field with key's name
     otherwise recursed into node's field with first key's name (if node's field exist then it should be a dict)
+    if first key is RNDR then value is applied to node's metadata
     :param value: value to set
+    :param meta: renderer's metadata
     :return: nothing, changes data in place
     """
     assert len(keys) > 0, "Something went wrong"
@@ -486,25 +1242,29 @@ def _map_attribute(node: dict, keys: list or tuple, value) -> None:
         if isinstance(keys[0], (list, tuple)):
             assert all(isinstance(k, (list, tuple)) for k in keys), "Something went wrong"
             for k in keys:
-                _map_attribute(node, k, value)
+                _map_attribute(node, k, value, meta)
+        elif keys[0] == RNDR:
+            assert len(keys) == 2, "Something went wrong"
+            meta.set(node, keys[1], value)
         else:
             if keys[0] not in node:
                 node[keys[0]] = {}
-            _map_attribute(node[keys[0]], keys[1:], value)
+            _map_attribute(node[keys[0]], keys[1:], value, meta)
 
 
-def _map_attributes(data: dict, attributes: dict, keys_map: dict) -> None:
+def _map_attributes(data: dict, attributes: dict, keys_map: dict, meta: RenderMeta) -> None:
     """
     Applies values from attributes dict into target (data)
     keys_map is used to determine to which field of data dict value from attributes field should be applied
     :param data: target data to apply attributes
     :param attributes: attributes to be mapped onto data
     :param keys_map: dict with attribute name as key, and list of hierarchical chain of fields in value
+    :param meta: renderer's metadata, values of fields under RNDR are applied to it
     :return: nothing, changes data in place
     """
     for k, v in attributes.items():
         if k in keys_map:
-            _map_attribute(data, keys_map[k], v)
+            _map_attribute(data, keys_map[k], v, meta)
 
 
 def _copy_keys(source: dict, target: dict) -> None:
@@ -519,9 +1279,93 @@ def _copy_keys(source: dict, target: dict) -> None:
             target[k] = source[k]
 
 
+class RenderTemplates:
+    """
+    Rendered units that are shared by instances of the same definition (flyweights)
+    Unit is rendered once for every definition (see BuildContext.definition) and custom attributes,
+    every instance takes a copy with ids relocated to it's hierarchical path
+    """
+
+    def __init__(self, ctx: BuildContext):
+        """
+        :param ctx: context of the build that loaded units
+        """
+        self._ctx = ctx
+        self._rendered = {}     # Template key -> (hierpath, rendered unit)
+        self._meta = RenderMeta()   # Metadata of templates
+        self.stamped = 0        # Units that were copied out of templates
+        # Definitions with more than one instance, templates of others wouldn't be used
+        tokens = {}
+        for token, _ in ctx.definitions.values():
+            tokens[token] = tokens.get(token, 0) + 1
+        self._shared = {token for token, instances in tokens.items() if instances > 1}
+
+    def key(self, tool: str, data: dict, custom: dict) -> tuple or None:
+        """ Returns key of unit's template or None if unit could't be shared """
+        token = self._ctx.definition(data)
+        if token is None or token not in self._shared:
+            return None
+        signature = _signature(custom)
+        if signature is None:
+            return None
+        return tool, token, signature
+
+    def get(self, template_key: tuple, hierpath: str, meta: RenderMeta) -> dict or None:
+        """ Returns copy of the template relocated to given hierarchical path, copy's metadata is put into meta """
+        template = self._rendered.get(template_key, None)
+        if template is None:
+            return None
+        self.stamped += 1
+        return _relocate(template[1], template[0], hierpath, self._meta, meta)
+
+    def put(self, template_key: tuple, hierpath: str, result: dict, meta: RenderMeta) -> None:
+        """ Keeps copy of rendered unit (with metadata taken from meta) as a template """
+        self._rendered[template_key] = (hierpath, _relocate(result, hierpath, hierpath, meta, self._meta))
+
+
+def _relocate(node, hierpath: str, new_hierpath: str, meta: RenderMeta, new_meta: RenderMeta):
+    """
+    Copies rendered unit and changes it's ids (and nets' unit ids) from hierpath to new_hierpath
+    Metadata of copied items is taken from meta and metadata of copies is put into new_meta
+    """
+    stack = []
+    items = meta._items         # NOTE: tables are accessed directly, since it's a hot path of templates
+    new_items = new_meta._items
+
+    def _copy(x):
+        cls = type(x)
+        if cls is dict:
+            y = {}
+            entry = items.get(id(x), None)
+            if entry is not None:
+                new_items[id(y)] = (y, _copy(entry[1]))
+        elif cls is list:
+            y = []
+        else:
+            return x
+        stack.append((x, y))
+        return y
+
+    result = _copy(node)
+    while len(stack) > 0:
+        x, y = stack.pop()
+        if type(x) is list:
+            y.extend(v if type(v) is str else _copy(v) for v in x)
+            continue
+        for k, v in x.items():
+            if type(v) is not str:
+                y[k] = _copy(v)
+            elif (k == "id" or k == "unit_id") and v.startswith(hierpath):
+                y[k] = new_hierpath + v[len(hierpath):]
+            else:
+                y[k] = v
+    return result
+
+
+@_iterative
 def render_unit(tool: str, data: dict, hierpath: str = "",
-                is_top: bool = None, custom: dict = None
-                ) -> dict:
+                is_top: bool = None, custom: dict = None, render_nested=None, templates: RenderTemplates = None,
+                meta: RenderMeta = None) -> dict:
     """
     Renders unit and it's subunits in tool's format description
     :param tool: name of tool to determine proper format description
@@ -529,13 +1373,32 @@ def render_unit(tool: str, data: dict, hierpath: str = "",
     :param hierpath: unit's parent hierarchical path
     :param is_top: False if this unit isn't top
     :param custom: customized attributes for unit
+    :param render_nested: callable(name, instance, hierpath) that renders nested unit instead of render_unit.
+        Applied only to this unit's nested units
+    :param templates: if specified then instances of the same definition are rendered once (see RenderTemplates)
+    :param meta: renderer's metadata, metadata of rendered items is put into it (to be used by connect and postprocess)
     :return: rendered unit as dict
     """
+    if meta is None:
+        meta = RenderMeta()
+    meta.check_deadline()
+
     # Get custom options
     if custom is None:
         custom = {}
     else:
-        custom = copy.deepcopy(custom)
+        # NOTE: only attributes are taken from custom, so nested unit's description and other unit's keys aren't copied
+        custom = {k: copy.deepcopy(v) for k, v in custom.items() if k != "unit" and k not in YAML_UNIT_KEYS}
+
+    template_key = None
+    if templates is not None and hierpath != "":
+        template_key = templates.key(tool, data, custom)
+        if template_key is not None:
+            result = templates.get(template_key, hierpath, meta)
+            if result is not None:
+                if A_LOCALPATH in data and A_LOCALPATH not in custom and meta.get(result, A_LOCALPATH) is not None:
+                    meta.set(result, A_LOCALPATH, data[A_LOCALPATH])
+                return result
 
     # Display information
     display = data["display"]
@@ -551,7 +1414,7 @@ def render_unit(tool: str, data: dict, hierpath: str = "",
     _to_target(custom, attributes, YAML_UNIT_KEYS)
 
     # Reflect attributes into result
-    _map_attributes(result, attributes, YAML_UNIT_ATTRIBUTES_REMAP[tool])
+    _map_attributes(result, attributes, YAML_UNIT_ATTRIBUTES_REMAP[tool], meta)
 
     # Set unit's ID (do it after attributes mapping so attributes won't override ID)
     if hierpath == "":
@@ -560,25 +1423,27 @@ def render_unit(tool: str, data: dict, hierpath: str = "",
     result["id"] = hierpath
 
     # Skip hidden
-    hide = _rndr(result, "unit_hide")
+    hide = meta.get(result, "unit_hide")
     if hide is not None and (hide is True or tool in hide):
         # NOTE: hide could be a bool or list/string with tools list in which item should be hidden
         hide = True
 
     if display.get("view", VIEW_SYMBOL) == VIEW_NONE or hide:
         # TODO: create stubs for all nested units and ports and set them to be hidden
-        _rndr_set(result, "hidden", True)
+        meta.set(result, "hidden", True)
+        if template_key is not None:
+            templates.put(template_key, hierpath, result, meta)
         return result
 
     if tool == TOOL_D3HW and display.get("view", VIEW_SYMBOL) == VIEW_SYMBOL:
-        _rndr_set(result, "hide_content", True)
+        meta.set(result, "hide_content", True)
 
     childs = result["children"] = []
-    _rndr_set(result, "is_unit", True)
+    meta.set(result, "is_unit", True)
 
     # Add ports
     for k, v in data["io"].items():
-        _add_port(tool, result, hierpath+"."+k, k, v, reverse=hierpath == "/")
+        _add_port(tool, result, hierpath+"."+k, k, v, meta, reverse=hierpath == "/")
 
     # Add subunits
     if True:
@@ -590,33 +1455,39 @@ def render_unit(tool: str, data: dict, hierpath: str = "",
                 if "nets" in v:
                     _check_all_allowed(v["nets"], YAML_NET_ALLOWED, "TODO: get filepath by hierarchy", part_hierpath, "nets")
                     # TODO: make sure at least one endpoint is referred to this unit (contains . in the beginning)
-                subunit = render_unit(tool, v["unit"], part_hierpath, False, v)
+                if render_nested is None:
+                    subunit = yield render_unit.step(tool, v["unit"], part_hierpath, False, v, templates=templates,
+                                                     meta=meta)
+                else:
+                    subunit = render_nested(k, v, part_hierpath)
                 if subunit is not None:
                     childs.append(subunit)
                     # Add instance specific nets
                     if "nets" in v:
-                        nets = _rndr(subunit, "outer_nets", [])
+                        nets = meta.get(subunit, "outer_nets", [])
                         for net_data in v["nets"]:
-                            net = _net(tool, net_data)
-                            _rndr_set(net, "unit_id", result["id"])
+                            net = _net(tool, net_data, meta)
+                            meta.set(net, "unit_id", result["id"])
                             nets.append(net)
 
     # Add unit's own nets
     if "nets" in data:
-        nets = _rndr(result, "my_nets", [])
+        nets = meta.get(result, "my_nets", [])
         for net_data in data["nets"]:
-            net = _net(tool, net_data)
-            _rndr_set(net, "unit_id", result["id"])
+            net = _net(tool, net_data, meta)
+            meta.set(net, "unit_id", result["id"])
             # Append net to list
             nets.append(net)
 
     if len(childs) == 0:
         del result["children"]
 
+    if template_key is not None:
+        templates.put(template_key, hierpath, result, meta)
     return result
 
 
-def _net(tool, net_data):
+def _net(tool, net_data, meta):
     net = copy.deepcopy(NET_DEFAULTS[tool])
     attributes = {}
     # If net is specified as list - convert it to dict first
@@ -638,7 +1509,7 @@ def _net(tool, net_data):
     # Get attributes
     _to_target(net_data, attributes, YAML_NET_KEYS)
     # Map attributes into result
-    _map_attributes(net, attributes, YAML_NET_REMAP[tool])
+    _map_attributes(net, attributes, YAML_NET_REMAP[tool], meta)
     return net
 
 
@@ -653,7 +1524,39 @@ def _ext_id(id):
     return id
 
 
-def _add_to_scope(scope: dict, item: dict, root=False, port=False) -> None:
+class _Scope:
+    """
+    Units and ports that are visible for nets of a unit (scope's root), see connect
+    """
+    __slots__ = ("root", "prefix", "items", "scopes", "parent", "index", "nets")
+
+    def __init__(self, root: dict, parent: "_Scope" = None, index: dict = None):
+        self.root = root        # Unit
+        self.prefix = _ext_id(root["id"])   # Prefix of ids of items within the scope (ids don't change in connect)
+        self.items = {}         # Local id (to the root) -> unit or port
+        self.scopes = {}        # Unit id -> scope of nested unit
+        self.parent = parent    # Scope in which root is a nested unit
+        self.index = index      # Scopes of whole hierarchy: unit id -> scope (see _scope_path)
+        self.nets = []          # Nets of the scope (see _scope_nets)
+
+
+def _scope_path(scope: _Scope, local_id: str):
+    """
+    Generator of scopes along hierarchical path of local id (i.e. U1/X1/U1.Q), scopes are taken from the index
+    :return: scope and id local to it, starting with given scope
+    """
+    yield scope, local_id
+    prefix = scope.prefix
+    pos = local_id.find("/")
+    while pos >= 0:
+        scope = scope.index.get(prefix + local_id[:pos], None)
+        if scope is None:
+            return
+        yield scope, local_id[pos+1:]
+        pos = local_id.find("/", pos + 1)
+
+
+def _add_to_scope(scope: _Scope, item: dict, root=False, port=False) -> None:
     """
     Adds item to the scope. Item should be a part of it's scope or it's root
     :param scope: scope into which add item
@@ -664,11 +1567,11 @@ def _add_to_scope(scope: dict, item: dict, root=False, port=False) -> None:
     """
     # Get id for scope
     if not root:
-        root_id = _ext_id(scope["root"]["id"])
+        root_id = scope.prefix
         # Make sure item is part of scope's root
-        assert root_id == item["id"][:len(root_id)], "Something went wrong"
+        assert item["id"].startswith(root_id), "Something went wrong"
     else:
-        root_id = scope["root"]["id"]
+        root_id = scope.root["id"]
         if not port:
             # Make sure item is actually root of the scope
             assert root_id == item["id"], "Something went wrong"
@@ -678,10 +1581,11 @@ def _add_to_scope(scope: dict, item: dict, root=False, port=False) -> None:
             pass  # TODO: return assertion logic, but don't fail if it's port of an top (which is unit, not port)
 
     # Add item to scope with it's local id
-    scope["items"][item["id"][len(root_id):]] = item
+    # NOTE: local ids are repeated in scopes of every instance of a unit, so they're interned
+    scope.items[sys.intern(item["id"][len(root_id):])] = item
 
 
-def _scope_data(unit: dict, scopes: dict, scope: dict or None):
+def _scope_data(unit: dict, scopes: dict, scope: _Scope or None):
     """
     Flattens and extracts data into single level dicts
     :param unit: data with rendered units
@@ -689,42 +1593,50 @@ def _scope_data(unit: dict, scopes: dict, scope: dict or None):
     :param scope: current scope
     :return: scope for specified unit
     """
-    next_scope = None
-
-    # Init scope (now it's always for every unit)
-    if True:
-    # TODO: remove
-    #  scope is None or _rndr(unit, A_FILEPATH) is not None:
-    #  Also in case if data were loaded from file - scope should be changed
-        next_scope = {"root": unit, "items": {}, "scopes": {}}
+    unit_scope = None
+    stack = [(unit, scope)]
+    while len(stack) > 0:
+        unit, scope = stack.pop()
+        next_scope = None
+
+        # Init scope (now it's always for every unit)
+        if True:
+        # TODO: remove
+        #  scope is None or meta.get(unit, A_FILEPATH) is not None:
+        #  Also in case if data were loaded from file - scope should be changed
+            next_scope = _Scope(unit, scope, scopes)
+            if scope is not None:
+                scope.scopes[unit["id"]] = next_scope
+            scopes[unit["id"]] = next_scope
+
+        # Add unit to initial scope
         if scope is not None:
-            scope["scopes"][unit["id"]] = next_scope
-        scopes[unit["id"]] = next_scope
+            _add_to_scope(scope, unit)
+            for port in unit.get("ports", []):
+                _add_to_scope(scope, port)
+
+        # If there is local scope for this unit then
+        if next_scope is not None:
+            # Switch scope
+            scope = next_scope
+            is_root = True
+            # Add unit again but this time to the local scope
+            _add_to_scope(scope, unit, root=is_root)
+            for port in unit.get("ports", []):
+                _add_to_scope(scope, port, root=is_root, port=True)
 
-    # Add unit to initial scope
-    if scope is not None:
-        _add_to_scope(scope, unit)
-        for port in unit.get("ports", []):
-            _add_to_scope(scope, port)
+        if unit_scope is None:
+            unit_scope = scope
+        stack.extend((u, scope) for u in reversed(unit.get("children", [])))
 
-    # If there is local scope for this unit then
-    if next_scope is not None:
-        # Switch scope
-        scope = next_scope
-        is_root = True
-        # Add unit again but this time to the local scope
-        _add_to_scope(scope, unit, root=is_root)
-        for port in unit.get("ports", []):
-            _add_to_scope(scope, port, root=is_root, port=True)
+    return unit_scope
 
-    for u in unit.get("children", []):
-        _scope_data(u, scopes, scope)
 
-    return scope
+def _nested_scopes(scope: _Scope) -> list:
+    return list(scope.scopes.values())
 
 
 def _find_item_in_scope(scope, id, recurse=None, me=None, regex=False, want_list=False):
-    # TODO: add reference unit to look for item relative to this unit, not to scope's root
     """
     Looks for item within scope by it's id
     :param scope: scope in which to start looking for
@@ -737,171 +1649,169 @@ def _find_item_in_scope(scope, id, recurse=None, me=None, regex=False, want_list
     or None, None, None in case if specified id is out of this scope and subscopes (in case of recursion)
     for regex id of if list wanted - returned list, containing such tuples
     """
-    if id[:1] == "." or (regex and id[:2] == r"\."):
+    if regex:
+        return _find_regex_in_scope(scope, id, recurse, me)
+
+    ext_root = scope.prefix
+    if id[:1] == ".":
         assert me is not None, "Self reference, but me is not specified!"
-        assert me in scope["items"].values(), "Self reference, but me is not in scope!"
-        id = me["id"]+id
-        if me == scope["root"]:
-            local_id = id[len(scope["root"]["id"]):]
+        if me is scope.root:
+            local_id = id
         else:
-            local_id = id[len(_ext_id(scope["root"]["id"])):]
+            local_id = me["id"][len(ext_root):] + id
+            assert scope.items.get(me["id"][len(ext_root):], None) is me, "Self reference, but me is not in scope!"
     elif id[:1] == "/":
-        # Translate id into localized to scope id if necessary
-
-        # But first check if it's within this scope
-        if id[:len(_ext_id(scope["root"]["id"]))] != _ext_id(scope["root"]["id"]):
-            if False:
-                pass    # TODO: not sure about this check
-            else:
-                if regex or want_list:
-                    return []
-                else:
-                    return None, None, None
-        local_id = id[len(_ext_id(scope["root"]["id"])):]
+        if not id.startswith(ext_root):
+            return [] if want_list else (None, None, None)
+        local_id = id[len(ext_root):]
     else:
-        # Translate localized back into full (will be required on recursion)
         local_id = id
-        id = _ext_id(scope["root"]["id"]) + id
 
-    # Look for it within items
-    if not regex:
-        found = scope["items"].get(local_id, None)
-    else:
-        found = [v for v in scope["items"].values() if re.match(f"^{id}$", v["id"]) is not None]
-
-    # If not found or it's regex search - try to recurse into nested scopes
-    nested = []
-    if (found is None and recurse is True) or (regex and recurse is not False):
-        for k, s in scope["scopes"].items():
-            r = _find_item_in_scope(s, id, recurse, None, regex, want_list)
-            if not regex:
-                # If it's not regex search and something is found - then return result
-                if want_list and len(r) > 0 \
-                or not want_list and r[0] is not None:
-                    return r
-            else:
-                nested += r
+    # NOTE: nested scopes are looked up by the index, only ones along the id's path could contain the item
+    for s, s_local_id in (_scope_path(scope, local_id) if recurse is True else ((scope, local_id),)):
+        found = s.items.get(s_local_id, None)
+        if found is not None:
+            r = (s, s_local_id, found)
+            return [r] if want_list else r
+    return [] if want_list else (None, None, None)
+
 
-    if not regex:
-        # Return result if there were no recursion and it's not regex search
-        if found is None:
-            if not want_list:
-                return None, None, None
+def _find_regex_in_scope(scope, id, recurse=None, me=None):
+    """
+    Looks for items within scope by regex of their id, see _find_item_in_scope
+    :return: list of tuples with scope in which item were found, local id of the item to the scope, found item
+    """
+    regex_found = []
+    stack = [scope]
+    while len(stack) > 0:
+        scope = stack.pop()
+        if id[:1] == "." or id[:2] == r"\.":
+            assert me is not None, "Self reference, but me is not specified!"
+            assert me in scope.items.values(), "Self reference, but me is not in scope!"
+            id = me["id"]+id
+            if me == scope.root:
+                local_id = id[len(scope.root["id"]):]
             else:
-                return []
+                local_id = id[len(scope.prefix):]
+        elif id[:1] == "/":
+            # Translate id into localized to scope id if necessary, but first check if it's within this scope
+            if not id.startswith(scope.prefix):
+                continue
+            local_id = id[len(scope.prefix):]
         else:
-            r = [(scope, local_id, found)]
-            if not want_list:
-                return r[0]
-            else:
-                return r
-    else:
-        # If this is regex search - join
-        return [(scope, local_id, item) for item in found if item is not None] + nested
+            # Translate localized back into full (will be required for nested scopes)
+            local_id = id
+            id = scope.prefix + id
 
+        regex_found += [(scope, local_id, v) for v in scope.items.values()
+                        if re.match(f"^{id}$", v["id"]) is not None]
 
-def _walk_endpoints(scope, allow_regex=False, recurse=False, want_net=False):
+        # Look within nested scopes (in the same order as they were added)
+        if recurse is not False:
+            stack.extend(reversed(list(scope.scopes.values())))
+    return regex_found
+
+
+class _ScopeNet:
     """
-    Generator that walks thru net's endpoints of units in the scope
-    :param scope: scope of interest
-    :param allow_regex: if True then regex endpoints are also returned
-    :param recurse: if True then is recursed into nested scopes
-    :param want_net: if True then whole net specification is returned
-    :return: hosting scope of endpoint, unit for which net is specified, endpoint kind, endpoint name
+    Net that is specified for a unit of a scope, with it's endpoints (see _scope_nets)
     """
-    for unit in list(scope["items"].values()):
-        # NOTE: during endpoints walking scope items could be updated
-        # so need to fix them in a list in the beginning of walk
+    __slots__ = ("unit", "net", "endpoints")
+
+    def __init__(self, unit: dict, net: dict, endpoints: list):
+        self.unit = unit            # Unit for which net is specified
+        self.net = net              # Net
+        self.endpoints = endpoints  # Non regex endpoints: tuples of kind, endpoint and unit's path of endpoint
 
+
+def _scope_nets(scope, meta) -> list:
+    """
+    Collects nets of units in the scope and their non regex endpoints
+    :param scope: scope of interest
+    :param meta: renderer's metadata
+    :return: list of _ScopeNet
+    """
+    result = []
+    for unit in scope.items.values():
         # Skip non units
-        if not _rndr(unit, "is_unit"):
+        if not meta.get(unit, "is_unit"):
             continue
 
-        ep_lookup = (NET_SRC, NET_DST)
-        if allow_regex:
-            ep_lookup = ep_lookup + (NET_SRCR, NET_DSTR)
-
         nets = []
-        my_nets = _rndr(unit, "my_nets")
-        outer_nets = _rndr(unit, "outer_nets")
-        scope_change = _rndr(unit, A_FILEPATH) is not None
+        my_nets = meta.get(unit, "my_nets")
+        outer_nets = meta.get(unit, "outer_nets")
+        scope_change = meta.get(unit, A_FILEPATH) is not None
 
-        if unit == scope["root"] or not scope_change:
+        if unit is scope.root or not scope_change:
             # My nets are in cluded for root and for nested units as long as they are within file's scope
             if my_nets is not None:
                 nets += my_nets
-        if unit != scope["root"]:
+        if unit is not scope.root:
             # Only outer nets for non-root are included
             if outer_nets is not None:
                 nets += outer_nets
 
-        if len(nets) > 0:
-            for net in nets:
-                nr = net.get(RNDR, {})
-                if not want_net:
-                    # Return by endpoint
-                    for ep in ep_lookup:
-                        value = nr.get(ep, None)
-                        if value is None:
-                            continue
-                        if isinstance(value, str):
-                            value = (value, )
-                        for v in value:
-                            yield scope, unit, ep, v
-                else:
-                    if allow_regex or (NET_SRC in net and NET_DST in nr):
-                        yield scope, unit, "net", net
-    if recurse:
-        for s in scope["scopes"].values():
-            _walk_endpoints(s, allow_regex, recurse, want_net)  # TODO: why recursion doesn't works
+        for net in nets:
+            nr = meta.of(net) or {}
+            endpoints = []
+            for kind in (NET_SRC, NET_DST):
+                value = nr.get(kind, None)
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    value = (value, )
+                endpoints += [(kind, ep, ep.partition(".")[0]) for ep in value]
+            result.append(_ScopeNet(unit, net, endpoints))
+    return result
 
 
-def _add_missing_units(tool, scope, recurse) -> None:
+def _add_missing_units(tool, scope, recurse, meta) -> None:
     """
     Walk thru scope nets, add units to scope if referred units are not found
     (non regex src/dst of nets are used)
     :param tool: target rendering tool
     :param scope:
     :param recurse: True to recurse into nested scopes
+    :param meta: renderer's metadata
     :return:
     """
-    for _, _, _, ep in _walk_endpoints(scope, allow_regex=False):
-        # Skip references to self's ports
-        if ep[0] == ".":    # TODO: externalPorts are starting with . and they are treated as units
-            continue
-        # Change references to root's ports
-        # TODO: make it clear what is root in which cases (units are described within single file, units are loaded)
-        if ep[0:2] == "/.":
-            ep = ep[1:]
-        id = re.sub(r"\..*", "", ep)    # Extract unit path from endpoint
-        _, _, unit = _find_item_in_scope(scope, id, True)
-        # Add unit if it wasn't found
-        if unit is None:
-            # Init result with defaults
-            missing = copy.deepcopy(UNIT_DEFAULTS[tool])
-            # Get initial unit's attributes
-            attributes = {"name": id, A_MISSING: True}
-            # Reflect attributes into result
-            _map_attributes(missing, attributes, YAML_UNIT_ATTRIBUTES_REMAP[tool])
-            missing["id"] = _ext_id(scope["root"]["id"]) + id
-            # To the root of the scope
-            if "children" not in scope["root"]:
-                scope["root"]["children"] = []
-            scope["root"]["children"].append(missing)
-            # To the scope
-            scope["items"][id] = missing  # TODO: use add to scope?
-    if recurse:
-        for s in scope["scopes"].values():
-            _add_missing_units(tool, s, recurse)
-
-
-def _add_port(tool, unit, port_id, port_name, port_custom, reverse=False):
+    scopes = _walk_tree(scope, _nested_scopes) if recurse else (scope, )
+    for scope in scopes:
+        meta.check_deadline()
+        for _, ep, id in (e for n in scope.nets for e in n.endpoints):
+            # Skip references to self's ports
+            if ep[0] == ".":    # TODO: externalPorts are starting with . and they are treated as units
+                continue
+            # Change references to root's ports
+            # TODO: make it clear what is root in which cases (units are described within single file, units are loaded)
+            if ep[0:2] == "/.":
+                id = ""
+            _, _, unit = _find_item_in_scope(scope, id, True)
+            # Add unit if it wasn't found
+            if unit is None:
+                # Init result with defaults
+                missing = copy.deepcopy(UNIT_DEFAULTS[tool])
+                # Get initial unit's attributes
+                attributes = {"name": id, A_MISSING: True}
+                # Reflect attributes into result
+                _map_attributes(missing, attributes, YAML_UNIT_ATTRIBUTES_REMAP[tool], meta)
+                missing["id"] = scope.prefix + id
+                # To the root of the scope
+                if "children" not in scope.root:
+                    scope.root["children"] = []
+                scope.root["children"].append(missing)
+                # To the scope
+                scope.items[id] = missing  # TODO: use add to scope?
+
+
+def _add_port(tool, unit, port_id, port_name, port_custom, meta, reverse=False):
     """ Creates port and adds it to unit
     :param tool: target rendering tool
     :param unit: port's hosting unit
     :param port_id: id for new port
     :param port_name: name for new port
     :param port_custom: custom settings for port
+    :param meta: renderer's metadata
     :param reverse: if True then direction is reversed (required for top unit's ports)
     :return:
     """
@@ -912,13 +1822,13 @@ def _add_port(tool, unit, port_id, port_name, port_custom, reverse=False):
         _pin_attrs_to_name(tool, attributes)
         port_name = attributes["name"]
         _map_attributes(port, attributes,
-                        YAML_UNIT_ATTRIBUTES_REMAP[tool])  # Use UNIT's attributes mapping, not IO's
+                        YAML_UNIT_ATTRIBUTES_REMAP[tool], meta)  # Use UNIT's attributes mapping, not IO's
         for k in ("children", "edges"):
             if k in port:
                 del port[k]
 
         port["id"] = port_id
-        _rndr_set(port, "is_port", True)
+        meta.set(port, "is_port", True)
 
         if tool == TOOL_HDELK:
             port["port"] = 1
@@ -932,7 +1842,7 @@ def _add_port(tool, unit, port_id, port_name, port_custom, reverse=False):
             if "dir" in attributes:
                 port_pin["direction"] = attributes["dir"]
             if reverse:
-                _rndr_set(port_pin, "pin_reverse", True)
+                meta.set(port_pin, "pin_reverse", True)
 
             # TODO: recurse and childs into top port if there is any
 
@@ -945,10 +1855,10 @@ def _add_port(tool, unit, port_id, port_name, port_custom, reverse=False):
         _to_target(port_custom, attributes, YAML_IO_KEYS)
         _pin_attrs_to_name(tool, attributes)
         port_name = attributes["name"]
-        _map_attributes(port, attributes, YAML_IO_REMAP[tool])
+        _map_attributes(port, attributes, YAML_IO_REMAP[tool], meta)
         port["id"] = port_id
         if reverse:
-            _rndr_set(port, "pin_reverse", True)
+            meta.set(port, "pin_reverse", True)
         if "ports" not in unit:
             unit["ports"] = []
         unit["ports"].append(port)
@@ -982,7 +1892,7 @@ def _pin_attrs_to_name(tool, attributes):
                     attributes["name"] = attributes["name"] + PIN_GATE_HIGH
 
 
-def _add_missing_ports(tool, scope, traverse, recurse) -> None:
+def _add_missing_ports(tool, scope, traverse, recurse, meta) -> None:
     """
     Walk thru scope nets, add units to scope if referred units are not found
     (non regex src/dst of nets are used)
@@ -990,55 +1900,110 @@ def _add_missing_ports(tool, scope, traverse, recurse) -> None:
     :param scope:
     :param traverse: True to look for missing ports within nested scopes
     :param recurse: True to recurse into nested scopes
+    :param meta: renderer's metadata
     :return:
     """
-    for _, ref_unit, ep_kind, ep in _walk_endpoints(scope, allow_regex=False):
-        if ep[0] == ".":
-            # If it's short from (without unit specification)
-            # take id straight from the unit fow which endpoint is specified
-            unit = ref_unit
-            if ref_unit == scope["root"]:
-                local_id = ""
+    scopes = _walk_tree(scope, _nested_scopes) if recurse else (scope, )
+    for scope in scopes:
+        meta.check_deadline()
+        for ref_unit, (ep_kind, ep, unit_id) in ((n.unit, e) for n in scope.nets for e in n.endpoints):
+            if ep[0] == ".":
+                # If it's short from (without unit specification)
+                # take id straight from the unit fow which endpoint is specified
+                unit = ref_unit
+                if ref_unit == scope.root:
+                    local_id = ""
+                else:
+                    root_id = scope.prefix
+                    assert ref_unit["id"][len(root_id)-1:len(root_id)] == "/", "Something went wrong"
+                    local_id = ref_unit["id"][len(root_id):]
+                name = ep[1:]
+                port_id = ref_unit["id"] + ep
+                port_local_id = local_id + ep
+                s = scope
+            elif "." in ep:  # Endpoint is port (it could be unit and this is out of interest here)
+                # Otherwise look for specified unit
+                s, local_id, unit = _find_item_in_scope(scope, unit_id, traverse)
+                # Skip if specified unit is not found
+                if unit is None:
+                    continue
+                name = ep[len(_ext_id(unit_id)):]
+                port_id = unit["id"] + ep[len(unit_id):]
+                port_local_id = local_id + ep[len(unit_id):]
             else:
-                root_id = _ext_id(scope["root"]["id"])
-                assert ref_unit["id"][len(root_id)-1:len(root_id)] == "/", "Something went wrong"
-                local_id = ref_unit["id"][len(root_id):]
-            name = ep[1:]
-            port_id = ref_unit["id"] + ep
-            port_local_id = local_id + ep
-            s = scope
-        elif "." in ep:  # Endpoint is port (it could be unit and this is out of interest here)
-            # Otherwise look for specified unit
-            unit_id = re.sub(r"\..*", "", ep)   # Extract unit path from endpoint
-            s, local_id, unit = _find_item_in_scope(scope, unit_id, traverse)
-            # Skip if specified unit is not found
-            if unit is None:
                 continue
-            name = ep[len(_ext_id(unit_id)):]
-            port_id = unit["id"] + ep[len(unit_id):]
-            port_local_id = local_id + ep[len(unit_id):]
-        else:
-            continue
 
-        # Add port if it wasn't found
-        if port_local_id not in s["items"]:
-            attributes = {
-                A_MISSING: True,
-                "dir": ["in", "out"][(ep_kind == NET_SRC)
-                                     ^ (unit["id"] == "//")],
-                # TODO: reverse direction if net endpoint is nested unit's port
-            }
-            port = _add_port(tool, unit, port_id, name, attributes)
-            s["items"][port_local_id] = port
+            # Add port if it wasn't found
+            if port_local_id not in s.items:
+                attributes = {
+                    A_MISSING: True,
+                    "dir": ["in", "out"][(ep_kind == NET_SRC)
+                                         ^ (unit["id"] == "//")],
+                    # TODO: reverse direction if net endpoint is nested unit's port
+                }
+                port = _add_port(tool, unit, port_id, name, attributes, meta)
+                s.items[port_local_id] = port
+
+
+def _endpoint_unit_id(scope, local_id, item) -> str:
+    """
+    Returns id of endpoint's unit (the item itself or unit of port)
+    Id is taken from the unit, so paths of endpoints share it instead of keeping their own copies
+    :param scope: scope in which endpoint were found
+    :param local_id: local id of endpoint to the scope
+    :param item: endpoint
+    """
+    unit = scope.items.get(local_id.partition(".")[0], None)
+    if unit is None:
+        return re.sub(r"\..*", "", item["id"])
+    return unit["id"]
+
 
-    if recurse:
-        for s in scope["scopes"].values():
-            _add_missing_ports(tool, s, traverse, recurse)
+def _lift_endpoint(tool, scope, found, is_source, net_data, meta):
+    """
+    Brings net's endpoint that was found within nested scope (i.e. U1/X1/U1.Q) up to the net's scope.
+    Edges don't cross hierarchy, so pass-through port is added to every unit along the way
+    and net's segment is connected to it within the unit
+    :param tool: target rendering tool
+    :param scope: net's scope
+    :param found: scope in which endpoint were found, local id of it to the scope, endpoint
+    :param is_source: True if endpoint is net's source
+    :param net_data: net, it's attributes are used for segments
+    :param meta: renderer's metadata
+    :return: the same as found, but for the net's scope
+    """
+    s, local_id, item = found
+    path = local_id     # Path of the endpoint relative to scope's root, it names pass-through port
+    while s is not scope:
+        unit = s.root
+        port_local_id = "." + path
+        port = s.items.get(port_local_id, None)
+        if port is None:
+            port = _add_port(tool, unit, unit["id"] + port_local_id, path, {"dir": ["in", "out"][is_source]}, meta)
+            _add_to_scope(s, port, root=True, port=True)
+            _add_to_scope(s.parent, port)
+
+            # Connect segment of the net within the unit
+            segment = copy.deepcopy(net_data)
+            segment_meta = {k: v for k, v in (meta.of(net_data) or {}).items() if k not in (NET_SRCR, NET_DSTR)}
+            if is_source:
+                segment_meta[NET_SRC], segment_meta[NET_DST] = [local_id], [port_local_id]
+            else:
+                segment_meta[NET_SRC], segment_meta[NET_DST] = [port_local_id], [local_id]
+            segment_meta["unit_id"] = unit["id"]
+            meta.put(segment, segment_meta)
+            _connect_net(tool, s, unit, segment, meta)
+
+        # One level up
+        unit_local_id = unit["id"][len(s.parent.prefix):]
+        s, local_id, item = s.parent, unit_local_id + port_local_id, port
+        path = unit_local_id + "/" + path
+    return s, local_id, item
 
 
-def _connect_net(tool, scope, unit, net_data):
+def _connect_net(tool, scope, unit, net_data, meta):
         net = copy.deepcopy(net_data)
-        v = net.get(RNDR, {})
+        v = dict(meta.of(net_data) or {})
         autoname = True
         if NET_SRC not in v and NET_SRCR not in v:
             raise ValueError(f"No source found in net `{net}`")
@@ -1069,70 +2034,81 @@ def _connect_net(tool, scope, unit, net_data):
         sources = []
         for ep in v[NET_SRC]:
             if ep[:1] == "/":
-                ep = _ext_id(scope["root"]["id"])+ep[1:]
-            sources += _find_item_in_scope(scope, id=ep, recurse=False, me=unit, regex=v[NET_SRCR], want_list=True)
-            # NOTE: nets traversing not works, so recursion is turned off
+                ep = scope.prefix+ep[1:]
+            # NOTE: regex endpoints aren't traversed, they're matched within the scope only
+            sources += [_lift_endpoint(tool, scope, found, True, net_data, meta)
+                        for found in _find_item_in_scope(scope, id=ep, recurse=not v[NET_SRCR], me=unit,
+                                                         regex=v[NET_SRCR], want_list=True)]
 
         targets = []
         for ep in v[NET_DST]:
             if ep[:1] == "/":
-                ep = _ext_id(scope["root"]["id"])+ep[1:]
-            targets += _find_item_in_scope(scope, id=ep, recurse=False, me=unit, regex=v[NET_DSTR], want_list=True)
-            # NOTE: nets traversing not works, so recursion is turned off
+                ep = scope.prefix+ep[1:]
+            targets += [_lift_endpoint(tool, scope, found, False, net_data, meta)
+                        for found in _find_item_in_scope(scope, id=ep, recurse=not v[NET_DSTR], me=unit,
+                                                         regex=v[NET_DSTR], want_list=True)]
 
         # TODO: avoid hidden
 
         if len(sources) < 1 or len(targets) < 1:
             return
 
-        root = scope["root"]
-        net_id = f'{_ext_id(root["id"])}:{v[NET_SRC]}:{v[NET_DST]}'
+        root = scope.root
 
         src = []
         trg = []
         src_name = None
         trg_name = None
-        for _, _, source in sources:
-            src_name = _rndr(source, "name")
-            if tool != TOOL_D3HW or _rndr(source, "is_port") is not True:
+        for s, local_id, source in sources:
+            src_name = meta.get(source, "name")
+            if tool != TOOL_D3HW or meta.get(source, "is_port") is not True:
                 # Common case
-                src.append([re.sub(r"\..*", "", source["id"]), source["id"]])
+                src.append([_endpoint_unit_id(s, local_id, source), source["id"]])
             else:
                 # Case for top's ports for D3HW
-                src.append([source["id"], source["id"]+"-port_pin"])
+                src.append([source["id"], source["ports"][0]["id"]])
 
-            for _, _, target in targets:
-                trg_name = _rndr(target, "name")
-                if tool != TOOL_D3HW or _rndr(target, "is_port") is not True:
-                    # Common case
-                    trg.append([re.sub(r"\..*", "", target["id"]), target["id"]])
-                else:
-                    # Case for top's ports for D3HW
-                    trg.append([target["id"], target["id"]+"-port_pin"])
+        for s, local_id, target in targets:
+            trg_name = meta.get(target, "name")
+            if tool != TOOL_D3HW or meta.get(target, "is_port") is not True:
+                # Common case
+                trg.append([_endpoint_unit_id(s, local_id, target), target["id"]])
+            else:
+                # Case for top's ports for D3HW
+                trg.append([target["id"], target["ports"][0]["id"]])
 
         if len(src) == 0 or len(trg) == 0:
             return
 
         # TODO: increase net references on ports (required to use auto_hide later)
 
-        # "_nets_" is a dict to gather all merge all nets with same sources into one
-        if "_nets_" not in root:
-            root["_nets_"] = {}
-        nets = root["_nets_"]
+        # "connected_nets" is a dict to gather all merge all nets with same sources into one
+        nets = meta.get(root, "connected_nets", {})
+
+        if tool == TOOL_D3HW:
+            # d3hw refers to items by numeric ids
+            src_ids = [[_d3hw_id(i, meta) for i in ep] for ep in src]
+            trg_ids = [[_d3hw_id(i, meta) for i in ep] for ep in trg]
+        else:
+            src_ids = src
+            trg_ids = trg
 
         # key is sorted sources list
-        net_key = tuple([tuple(v) for v in sorted(src)])
+        net_key = tuple([tuple(v) for v in sorted(src_ids)])
 
         if net_key not in nets:
             # init net data
-            nets[net_key] = {"sources": src, "targets": [], **net}
+            nets[net_key] = {"sources": src_ids, "targets": [], **net}
 
             if tool == TOOL_D3HW:
                 # add id
-                nets[net_key]["id"] = net_id
+                # NOTE: id is derived from resolved sources (the same as net_key), not from net's text,
+                #       the same relative text may be declared in different units of one scope
+                net_id = f'{scope.prefix}:' + ";".join(sorted(":".join(ep) for ep in src))
+                nets[net_key]["id"] = _d3hw_id(net_id, meta)
                 # autoname net if this is D3HW
                 if autoname and (len(src) == 1 or len(trg) == 1):
-                    home_unit = _rndr(net_data, "unit_id")
+                    home_unit = meta.get(net_data, "unit_id")
                     if len(src) == 1:
                         # By default - if there is single source pin then it's name is used to name the net
                         name = src_name
@@ -1171,36 +2147,58 @@ def _connect_net(tool, scope, unit, net_data):
         else:
             pass
 
-        nets[net_key]["targets"] += trg
-
+        nets[net_key]["targets"] += trg_ids
 
-def _nets_to_edges(tool, unit):
 
-    for v in unit.get("_nets_", {}).values():
-        if "edges" not in unit:
-            unit["edges"] = []
-
-        if tool == TOOL_D3HW:
-            unit["edges"].append(v)
+def _nets_to_edges(tool, unit, meta):
+    for unit in _walk_tree(unit):
+        meta.check_deadline()
+        for i, v in enumerate((meta.get(unit, "connected_nets") or {}).values()):
+            if "edges" not in unit:
+                unit["edges"] = []
 
-        if tool == TOOL_HDELK:
-            for _, sid in v["sources"]:
-                for _, tid in v["targets"]:
-                    unit["edges"].append({
-                        **v,
-                        "sources": [sid],
-                        "targets": [tid],
-                    })
-    for u in unit.get("children", []):
-        _nets_to_edges(tool, u)
-
-
-def connect(tool: str, top_unit: dict, options: tuple or list) -> None:
+            if tool == TOOL_D3HW:
+                unit["edges"].append(v)
+
+            if tool == TOOL_HDELK:
+                if 0 < _HDELK_FANOUT < len(v["sources"]) * len(v["targets"]):
+                    _hdelk_junction(unit, v, i)
+                    continue
+                for _, sid in v["sources"]:
+                    for _, tid in v["targets"]:
+                        unit["edges"].append({
+                            **v,
+                            "sources": [sid],
+                            "targets": [tid],
+                        })
+
+
+def _hdelk_junction(unit, net, index):
+    """
+    Adds net to unit as junction node with an edge from every source to it and from it to every target,
+    so amount of edges is sum of sources and targets, not their product
+    :param unit: unit in which net is connected
+    :param net: connected net (see _connect_net)
+    :param index: net's index within unit, junction's id is made of it
+    """
+    junction = {**HDELK_JUNCTION_DEFAULTS, "id": f'{unit["id"]}:J{index}'}
+    if "children" not in unit:
+        unit["children"] = []
+    unit["children"].append(junction)
+    shared = {k: net[k] for k in HDELK_JUNCTION_KEYS if k in net}
+    for _, sid in net["sources"]:
+        unit["edges"].append({**net, "sources": [sid], "targets": [junction["id"]]})
+    for _, tid in net["targets"]:
+        unit["edges"].append({**shared, "sources": [junction["id"]], "targets": [tid]})
+
+
+def connect(tool: str, top_unit: dict, options: tuple or list, meta: RenderMeta) -> None:
     """
     Generates 'edges' items
     :param tool: name of tool
     :param top_unit: data with rendered units
     :param options: nodes within scope
+    :param meta: renderer's metadata of rendered units (see render_unit)
     :return: nothing - data is modified just in place
     """
     options = (RENDER_ADD_MISSING_PORTS, RENDER_ADD_MISSING_UNITS)
@@ -1209,42 +2207,33 @@ def connect(tool: str, top_unit: dict, options: tuple or list) -> None:
     _scopes = {}
     top_scope = _scope_data(top_unit, _scopes, None)
 
+    # Collect nets once, all the steps below use them
+    for s in _walk_tree(top_scope, _nested_scopes):
+        meta.check_deadline()
+        s.nets = _scope_nets(s, meta)
+
     # Walk thru nets, add missing units
     if RENDER_ADD_MISSING_UNITS in options:
-        _add_missing_units(tool, top_scope, recurse=True)
+        _add_missing_units(tool, top_scope, recurse=True, meta=meta)
 
     # Walt thru nets, add missing ports if necessary
     if RENDER_ADD_MISSING_PORTS in options:
-        _add_missing_ports(tool, top_scope, traverse=True, recurse=True)
+        _add_missing_ports(tool, top_scope, traverse=True, recurse=True, meta=meta)
 
     # Walk thru nets again - connect as necessary
-    _connect_nets(tool, top_scope)
+    _connect_nets(tool, top_scope, meta)
 
     # Transforms nets data into edges
-    _nets_to_edges(tool, top_unit)
-
-
-def _connect_nets(tool, starting_scope):
-    for scope, unit, _, net_data in _walk_endpoints(starting_scope, allow_regex=True, recurse=False, want_net=True):
-        # TODO: skip hidden
-        _connect_net(tool, scope, unit, net_data)
+    _nets_to_edges(tool, top_unit, meta)
 
-    for scope in starting_scope.get("scopes").values():
-        # TODO: skip hidden
-        _connect_nets(tool, scope)
 
-
-def cleanup(data):
-    if isinstance(data, list):
-        for d in data:
-            cleanup(d)
-    elif isinstance(data, dict):
-        keys = list(data.keys())
-        for k in keys:
-            if k[:1] == "_" and k[-1:] == "_":
-                del data[k]
-        for v in data.values():
-            cleanup(v)
+def _connect_nets(tool, starting_scope, meta):
+    # TODO: skip hidden
+    for scope in _walk_tree(starting_scope, _nested_scopes):
+        meta.check_deadline()
+        for n in scope.nets:
+            # TODO: skip hidden
+            _connect_net(tool, scope, n.unit, n.net, meta)
 
 
 def renderer(tool, data):
@@ -1257,21 +2246,26 @@ def renderer(tool, data):
     pass
 
 
-def tool_adaptation(tool, data):
-
+def postprocess(tool, data, meta):
+    """
+    Adapts schematic for target rendering tool with a single walk over units
+    :param tool: target rendering tool
+    :param data: rendered and connected schematic, changed in place
+    :param meta: renderer's metadata of rendered units (see render_unit)
+    """
     if tool == TOOL_HDELK:
-        hdelk_adaptation(data)
-    if tool == TOOL_D3HW:
-        d3hw_adaptation(data)
+        hdelk_adaptation(data, meta)    # NOTE: it's a single walk already
+    elif tool == TOOL_D3HW:
+        d3hw_postprocess(data, meta)
 
 
-def _hdelk_portGroups(data):
+def _hdelk_unit_port_groups(data, meta):
     # Translate ports into port specific groups
     hdelk_ports = {}
     ports = data.get("ports", [])
     for p in ports:
-        ports_group = p.get(RNDR, {}).get("pin_dir", "in")+"Ports"
-        side = p.get(RNDR, {}).get("pin_side", None)
+        ports_group = (meta.of(p) or {}).get("pin_dir", "in")+"Ports"
+        side = (meta.of(p) or {}).get("pin_side", None)
         if side is not None:
             ports_group = side + "Ports"
         if ports_group not in hdelk_ports:
@@ -1282,35 +2276,29 @@ def _hdelk_portGroups(data):
     if "ports" in data:
         del data["ports"]
 
-    for c in data.get("children", []):
-        _hdelk_portGroups(c)
 
+def _hdelk_portGroups(data, meta):
+    for unit in _walk_tree(data):
+        meta.check_deadline()
+        _hdelk_unit_port_groups(unit, meta)
 
-def hdelk_adaptation(data):
-    _hdelk_portGroups(data)
 
+def hdelk_adaptation(data, meta):
+    _hdelk_portGroups(data, meta)
 
-def _d3hw_adaptation_unit(unit):
-    """
-    set some default values
-    :param unit:
-    :return:
-    """
+
+def _d3hw_unit_defaults(unit, meta):
     if "hwMeta" not in unit:
         unit["hwMeta"] = {}
     if "name" not in unit["hwMeta"]:
         unit["hwMeta"]["name"] = unit["id"]
-        u_type = _rndr(unit, "type")
+        u_type = meta.get(unit, "type")
         if u_type is not None:
             unit["hwMeta"]["name"] += ":" + u_type
-    for u in unit.get("children", []):
-        _d3hw_adaptation_unit(u)
 
 
-def _d3hw_hide_content(unit):
-
-    children = unit.get("children", [])
-    if _rndr(unit, "hide_content"):
+def _d3hw_unit_hide_content(unit, meta):
+    if meta.get(unit, "hide_content"):
         if "children" in unit:
             unit["_children"] = unit["children"]
             del unit["children"]
@@ -1318,17 +2306,8 @@ def _d3hw_hide_content(unit):
             unit["_edges"] = unit["edges"]
             del unit["edges"]
 
-    for u in children:
-        _d3hw_hide_content(u)
-
 
-def _d3hw_adaptation_port(unit):
-    """
-    transform values for side and direction
-    set port index
-    :param unit:
-    :return:
-    """
+def _d3hw_unit_ports(unit, meta):
     index_auto_step = 1000
     index = {
         "WEST": -index_auto_step,
@@ -1344,7 +2323,7 @@ def _d3hw_adaptation_port(unit):
         else:
             p["direction"] = "INPUT"
 
-        if _rndr(p, "pin_reverse"):
+        if meta.get(p, "pin_reverse"):
             if p["direction"] == "INPUT":
                 p["direction"] = "OUTPUT"
             else:
@@ -1371,72 +2350,357 @@ def _d3hw_adaptation_port(unit):
             if side in ("WEST", "SOUTH"):
                 props["index"] = -props["index"]
 
-    for u in unit.get("children", []):
-        _d3hw_adaptation_port(u)
+
+_D3HW_DEBUG_IDS = 0     # If set then string IDs are kept after numeric IDs
+_D3HW_ID_BITS = 40      # Numeric IDs of d3hw are below 2 ** _D3HW_ID_BITS, see D3hwIds
 
 
-def _d3hw_id_map(item, id_map, id_counter, is_unit):
+class D3hwIds:
     """
-    Assigns numeric ID for each unit, port and edge
-    Fills in string ID to numeric ID map
-    Replaces string ID with numeric
-    Sets maxID for unit meta
-    :param item: unit, port or edge
-    :param id_map: dict with mapping string ids to numeric ids
-    :param id_counter: list with single item - id counter (list is used to 'pass by ref')
-    :param is_unit: True if item is unit, otherwise False
-    :return:
+    Interning table of d3hw numeric ids (d3hw needs them)
+    Numeric id is taken from hash of item's string id, which is it's hierarchical path, so unchanged parts
+    of a design keep their ids across builds. Colliding hash is resolved by taking the next free number
     """
-    id_map[item["id"]] = id_counter[0]
-    DEBUG = 0
-    item["id"] = str(id_counter[0]) + ["", ":" + item["id"]][DEBUG]
-    id_counter[0] += 1
-    if not is_unit:
-        return
+    __slots__ = ("_ids", "_taken")
 
-    for i in item.get("ports", []):
-        _d3hw_id_map(i, id_map, id_counter, is_unit=False)
+    def __init__(self):
+        self._ids = {}          # String id -> numeric id (as string)
+        self._taken = set()     # Numeric ids that are in use
 
-    for i in item.get("edges", []):
-        _d3hw_id_map(i, id_map, id_counter, is_unit=False)
+    def get(self, string_id: str) -> str:
+        numeric_id = self._ids.get(string_id, None)
+        if numeric_id is None:
+            n = int.from_bytes(hashlib.blake2b(string_id.encode("utf-8"), digest_size=8).digest(), "little")
+            n &= (1 << _D3HW_ID_BITS) - 1
+            while n in self._taken:
+                n = (n + 1) & ((1 << _D3HW_ID_BITS) - 1)
+            self._taken.add(n)
+            numeric_id = self._ids[string_id] = str(n)
+        return numeric_id
 
-    for i in item.get("children", []):
-        _d3hw_id_map(i, id_map, id_counter, is_unit=True)
 
-    item["hwMeta"]["maxId"] = id_counter[0]
+def _d3hw_id(string_id: str, meta: RenderMeta) -> str:
+    numeric_id = meta.d3hw_ids.get(string_id)
+    return numeric_id if not _D3HW_DEBUG_IDS else numeric_id + ":" + string_id
 
 
-def _d3hw_id_sub(item, id_map, is_unit):
+def _d3hw_unit_map_ids(unit, meta):
     """
-    Replaces string ID in strings with numeric ID
-    - in edges sources and targets
-    :param item: unit, port or edge
-    :param id_map: dict with mapping string ids to numeric ids
-    :param is_unit: True if item is unit, otherwise False
-    :return:
+    Replaces string ids of unit and it's ports with numeric ones
+    Edges got numeric ids and refer to numeric ids of ports when they were connected (see _connect_net)
+    """
+    unit["id"] = _d3hw_id(unit["id"], meta)
+    for i in unit.get("ports", []):
+        i["id"] = _d3hw_id(i["id"], meta)
+    # NOTE: generated ids of d3hw (i.e. edges split from hyperedges) start after maxId
+    unit["hwMeta"]["maxId"] = 1 << _D3HW_ID_BITS
+
+
+def _d3hw_nested(unit):
+    # NOTE: content of collapsed unit is moved before it's walked
+    return unit.get("children", unit.get("_children", []))
+
+
+def d3hw_postprocess(data, meta):
+    """
+    Adapts schematic for d3hw: sets defaults, port directions and indexes, numeric ids and hides content
+    of collapsed units. Units are walked once, every step is made for a unit before it's nested units are walked
+    """
+    for unit in _walk_tree(data, _d3hw_nested):
+        meta.check_deadline()
+        _d3hw_unit_defaults(unit, meta)
+        _d3hw_unit_ports(unit, meta)
+        _d3hw_unit_map_ids(unit, meta)
+        _d3hw_unit_hide_content(unit, meta)
+
+
+def d3hw_stubbed(unit: dict) -> dict:
+    """
+    Returns copy of unit where content of collapsed units is dropped, so they are left as stubs (marked with hwMeta.lazy)
+    Content is taken with d3hw_hidden_content when unit is expanded
+    :param unit: unit in d3hw format (i.e. whole schematic), isn't changed,
+        so the same schematic could be kept to take content of collapsed units from it
+    :return: copy of unit, only dicts on the way to collapsed units are copied, the rest is shared with unit
+    """
+    result = dict(unit)
+    stack = [result]
+    while len(stack) > 0:
+        u = stack.pop()
+        if "_children" in u or "_edges" in u:
+            u.pop("_children", None)
+            u.pop("_edges", None)
+            u["hwMeta"] = {**u["hwMeta"], "lazy": True}
+        if "children" in u:
+            u["children"] = [dict(c) for c in u["children"]]
+            stack.extend(u["children"])
+    return result
+
+
+def d3hw_hidden_content(schm: dict, unit_id: str) -> dict or None:
+    """
+    Takes content of collapsed unit
+    :param schm: whole schematic in d3hw format, isn't changed
+    :param unit_id: id of collapsed unit
+    :return: dict with unit's children and edges, where collapsed units are stubs (see d3hw_stubbed)
+        None if there is no collapsed unit with such id
+    """
+    stack = [schm]
+    while len(stack) > 0:
+        u = stack.pop()
+        if u.get("id") == unit_id:
+            if "_children" not in u and "_edges" not in u:
+                return None
+            return {"children": [d3hw_stubbed(child) for child in u.get("_children", [])], "edges": u.get("_edges", [])}
+        stack.extend(u.get("children", []))
+        stack.extend(u.get("_children", []))
+    return None
+
+
+_CODE_HASH = None
+
+
+def _code_hash() -> str:
+    """
+    Returns hash of the tool's code, so render cache isn't used across code changes made without version bump
+    """
+    global _CODE_HASH
+    if _CODE_HASH is None:
+        h = hashlib.md5()
+        for module_name in (__name__, "yaml4schm_defs", "operators"):
+            with open(sys.modules[module_name].__file__, "rb") as f:
+                h.update(f.read())
+        _CODE_HASH = h.hexdigest()
+    return _CODE_HASH
+
+
+def _build_inputs(tool, filepath, yaml_string, shell_string, options, root=None, depth=None,
+                  dig_depth=_DIG_DEPTH) -> str:
+    """
+    Returns render cache key for build inputs that are known before build
+    Top file is taken by it's resolved path, so key is the same for CLI and server builds of the same file,
+    everything else that affects how file paths are resolved is in dependency closure (see _dep_path, _ROOT_DEP)
+    NOTE: limits of budget aren't in the key as schematics that were cut by budget aren't stored,
+          dig_depth is as it changes schematic without cutting it
+    """
+    return key(tool, list(options), _VERSION, _code_hash(), _dep_path(filepath),
+               yaml_string, shell_string, root, depth, dig_depth, _HDELK_FANOUT)
+
+
+def _finish(tool: str, schm: dict, options: tuple or list, meta: RenderMeta) -> None:
+    """ Completes rendered schematic: connect -> adaptation """
+    connect(tool, schm, options, meta)
+    renderer(tool, schm)
+    postprocess(tool, schm, meta)
+
+
+def _signature(*parts) -> str or None:
+    """ Returns comparable representation of given data, None if data can't be represented """
+    try:
+        return json.dumps(parts, sort_keys=True, default=repr)
+    except (TypeError, ValueError, RecursionError):
+        # NOTE: json's encoder is recursive, so too deep data isn't represented
+        return None
+
+
+class _NestedUnit:
+    """
+    Top unit's nested unit as it were built last time
     """
-    if not is_unit:
-        return
 
-    DEBUG = 0
-    for e in item.get("edges", []):
-        for eps in ("sources", "targets"):
-            for ep in e[eps]:
-                for i in range(0, len(ep)):
-                    ep[i] = str(id_map[ep[i]]) + ["", ":" + ep[i]][DEBUG]
+    def __init__(self, signature: str, files: dict, instance: dict):
+        self.signature = signature  # Everything unit's processing depends on, except content of files
+        self.files = files          # Files that were read to process unit: file path -> content hash
+        self.instance = instance    # Processed instance
+        self.rendered = None        # Rendered instance before connection
+        self.meta = None            # Metadata of rendered instance
+        self.reused = False         # Unit is taken from previous build
 
-    for u in item.get("children", []):
-        _d3hw_id_sub(u, id_map, is_unit=True)
 
+class BuildState:
+    """
+    State of previous build of a top unit (i.e. of an editor's session) to make next build incremental
+    Top unit's nested units are processed and rendered only if their instance description, display context
+    or files they were loaded from are changed, others are taken from previous build
+    Scopes are connected from scratch as connection takes only a small part of build time
+    """
+
+    def __init__(self, shadow: bool = False):
+        """
+        :param shadow: shadow-compare mode. Result of every incremental build is compared with full build's result,
+            full build's result is used if they differ
+        """
+        self.shadow = shadow
+        self.mismatches = 0         # Incremental builds that were different from full build (in shadow mode)
+        self.reused = 0             # Nested units that were reused by last build
+        self._inputs = None
+        self._units = {}            # Nested unit's name -> _NestedUnit
+        self._next = None
+        self._seen = None
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def _unchanged(files: dict) -> bool:
+        for file_path, file_hash in files.items():
+            try:
+                if _file_hash(file_path) != file_hash:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    def _process_nested(self, k, v, job, ctx):
+        signature = None
+        if id(v) not in self._seen and id(v["unit"]) not in self._seen:
+            # NOTE: instances that share data (YAML aliases) are changed in place more than once, so aren't reused
+            signature = _signature(k, v, job)
+        self._seen.update((id(v), id(v["unit"])))
+        unit = self._units.get(k, None)
+        if signature is not None and unit is not None and unit.signature == signature \
+                and self._unchanged(unit.files):
+            v.clear()
+            v.update(_deepcopy(unit.instance))
+            ctx.files.update(unit.files)
+            unit.reused = True
+            self._next[k] = unit
+            self.reused += 1
+            return
 
-def d3hw_adaptation(data):
-    _d3hw_adaptation_unit(data)
-    _d3hw_adaptation_port(data)
-    id_map = {}
-    id_counter = [0]
-    _d3hw_id_map(data, id_map, id_counter, is_unit=True)
-    _d3hw_id_sub(data, id_map, is_unit=True)
-    _d3hw_hide_content(data)
+        unit_ctx = BuildContext(ctx)
+        _process_nested_unit(v, *job, unit_ctx)
+        ctx.files.update(unit_ctx.files)
+        if signature is not None and ctx.meter.exceeded is None:
+            self._next[k] = _NestedUnit(signature, unit_ctx.files, _deepcopy(v))
+
+    def _render_nested(self, tool, k, v, hierpath, templates, meta):
+        unit = self._next.get(k, None)
+        if unit is not None and unit.reused and unit.rendered is not None:
+            return _relocate(unit.rendered, hierpath, hierpath, unit.meta, meta)
+        subunit = render_unit(tool, v["unit"], hierpath, False, v, templates=templates, meta=meta)
+        if unit is not None:
+            unit.meta = RenderMeta()
+            unit.rendered = _relocate(subunit, hierpath, hierpath, meta, unit.meta)
+        return subunit
+
+    def _build(self, tool, filepath, yaml_string, options, ctx):
+        inputs = _build_inputs(tool, filepath, None, None, options)
+        if inputs != self._inputs:
+            self._inputs = inputs
+            self._units = {}
+        self._next = {}
+        self._seen = set()
+        self.reused = 0
+        try:
+            data = load_unit(filepath, "", "", {}, None, yaml_string=yaml_string, ctx=ctx,
+                             process_nested=self._process_nested)
+            unit_type = data["attributes"].get("type", filepath)
+            templates = RenderTemplates(ctx)
+            meta = RenderMeta(ctx.meter.deadline)
+            schm = render_unit(tool, data, "", is_top=True, custom=data, meta=meta,
+                               render_nested=lambda k, v, hierpath: self._render_nested(tool, k, v, hierpath,
+                                                                                        templates, meta))
+            ctx.rendered()
+            data = templates = None     # NOTE: loaded units aren't needed anymore, so memory is released before connect
+            _finish(tool, schm, options, meta)
+            for unit in self._next.values():
+                unit.reused = False
+            self._units = self._next
+        finally:
+            self._next = None
+            self._seen = None
+        return unit_type, schm
+
+    def build(self, tool: str, filepath: str, yaml_string: str, options: tuple or list, ctx: BuildContext) -> tuple:
+        """
+        Builds schematic incrementally (see `build` for params)
+        :return: tuple with top unit's type and schematic
+        """
+        with self._mutex:
+            unit_type, schm = self._build(tool, filepath, yaml_string, options, ctx)
+        if self.shadow and ctx.meter.exceeded is None:
+            full_type, full_schm = build(tool, filepath, yaml_string, options=options, budget=ctx.meter.budget)
+            if _signature(unit_type, schm) != _signature(full_type, full_schm):
+                print(f"WARNING: incremental build of {filepath} differs from full build, "
+                      f"{self.reused} nested units were reused")
+                self.mismatches += 1
+                with self._mutex:
+                    self._units = {}
+                return full_type, full_schm
+        return unit_type, schm
+
+
+def _find_unit(unit: dict, unit_id: str) -> dict or None:
+    """ Looks for rendered unit by it's id """
+    stack = [unit]
+    while len(stack) > 0:
+        u = stack.pop()
+        if u.get("id") == unit_id:
+            return u
+        stack.extend(u.get("children", []))
+    return None
+
+
+def build(tool: str, filepath: str, yaml_string: str = None, shell_string: str = None,
+          options: tuple or list = (RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS),
+          cache: RenderCache = None, state: BuildState = None, root: str = None, depth: int = None,
+          budget: BuildBudget = None, ctx: BuildContext = None) -> tuple:
+    """
+    Builds schematic out of YAML description: load -> render -> connect -> adaptation
+    :param tool: target rendering tool
+    :param filepath: path to top unit description file
+    :param yaml_string: if set then top unit is loaded from yaml_string, filepath is used as root path when referencing to other files
+    :param shell_string: if set then schematic is built for this description of shell around top unit
+    :param options: render options
+    :param cache: render cache. If specified then schematic is taken from cache unless some of files,
+        that were read to build it, were changed
+        NOTE: files that would be found by name (paths within angle braces) if added later aren't tracked
+    :param state: state of previous build of the same top unit. If specified then schematic is built incrementally
+        (unless shell is used or build is cut) and state is updated
+    :param root: if set then only unit with this hierarchical path (i.e. /U1/X1) is built and returned as schematic,
+        nested units that aren't on the way to it aren't loaded
+    :param depth: if set then only this many levels of nested units under root (or top) are built,
+        content of units at the last level isn't loaded
+    :param budget: limits of the build. When any of limits is reached, the rest of nested units are left as stubs
+        (and schematic isn't stored into cache)
+    :param ctx: context to build with, after build it keeps files that were read and include graph
+        (those are left empty if schematic is taken from cache). Budget is ignored if it's specified
+    :return: tuple with top unit's type and schematic
+    """
+    if cache is not None:
+        inputs = _build_inputs(tool, filepath, yaml_string, shell_string, options, root, depth,
+                               _DIG_DEPTH if budget is None else budget.dig_depth)
+        cached = cache.get(inputs, _dep_hash)
+        if cached is not None:
+            return cached["type"], cached["schm"]
+
+    if ctx is None:
+        ctx = BuildContext(budget=budget)
+    ctx.cut(root, depth)
+    if state is not None and shell_string is None and not ctx.is_cut():
+        unit_type, schm = state.build(tool, filepath, yaml_string, options, ctx)
+    else:
+        data = load_unit(filepath, "", "", {}, None, yaml_string=yaml_string, ctx=ctx)
+        unit_type = data["attributes"].get("type", filepath)
+        if shell_string is not None:
+            hdata = load_unit(filepath, "", "", {}, None, yaml_string=shell_string, ctx=ctx)
+        else:
+            hdata = data
+        meta = RenderMeta(ctx.meter.deadline)
+        schm = render_unit(tool, hdata, "", is_top=True, custom=hdata, templates=RenderTemplates(ctx), meta=meta)
+        ctx.rendered()
+        data = hdata = None     # NOTE: loaded units aren't needed anymore, so memory is released before connect
+        root_id = _next_hierpath("", "/".join(ctx.root))
+        root_unit = _find_unit(schm, root_id)
+        if root_unit is None:
+            raise ValueError(f"Unit {root_id} is not found")
+        _finish(tool, schm, options, meta)
+        schm = root_unit
+
+    if ctx.meter.exceeded is not None:
+        print(f"WARNING: build of {filepath} is over budget: {ctx.meter.exceeded}, the rest of units are left as stubs",
+              file=sys.stderr)
+    elif cache is not None:
+        cache.put(inputs, {_dep_path(k): v for k, v in ctx.files.items()}, {"type": unit_type, "schm": schm})
+    return unit_type, schm
 
 
 def tool_html(tool: str, schm: dict, header: str = "Schematic", display_customizations: str = "", snippet_name: str = None,
@@ -1692,11 +2956,44 @@ if __name__ == "__main__":
                         dest="root",
                         help="Root path for units description files lookup",
                         type=str)
+    parser.add_argument("--http-cache",
+                        default=None,
+                        dest="http_cache",
+                        help="Directory for cache of remote (HTTP / HTTPS) files. "
+                             "Default is taken from YAML4SCHM_HTTP_CACHE environment variable or ~/.cache/yaml4schm/http",
+                        type=str)
+    parser.add_argument("--render-cache",
+                        default=None,
+                        dest="render_cache",
+                        help="Directory for cache of built schematics (shared with server and other runs). "
+                             "Default is taken from YAML4SCHM_RENDER_CACHE environment variable. "
+                             "If neither is set then schematic is built without cache",
+                        type=str)
+    parser.add_argument("--no-render-cache",
+                        action="store_true",
+                        dest="no_render_cache",
+                        help="If specified then schematic is always built from scratch and isn't stored into cache "
+                             "(even if cache directory is specified)")
+    parser.add_argument("--budget",
+                        default="",
+                        dest="budget",
+                        help="Limits of the build, i.e. 'files=100,units=10000,nets=20000,operators=1000,"
+                             "yaml_bytes=1000000,seconds=5,dig_depth=100'. "
+                             "When a limit is reached the rest of units are left as stubs. "
+                             "Time limit is for the whole build: units are loaded within it's first half, "
+                             "build fails if loaded units aren't rendered and connected in time",
+                        type=str)
     parser.add_argument("--hdelk_custom",
                         default="",
                         dest="hdelk_custom",
                         help="HDELk customizations file path",
                         type=str)
+    parser.add_argument("--hdelk-fanout",
+                        default=_HDELK_FANOUT,
+                        dest="hdelk_fanout",
+                        help="Nets that are drawn by more edges than this (sources by targets) "
+                             "are drawn thru junction node by HDElk, 0 - never",
+                        type=int)
     parser.add_argument("--width",
                         default="",
                         dest="width",
@@ -1725,7 +3022,18 @@ if __name__ == "__main__":
         opath = None
     oformat = args.format
     _ROOT_PATH = args.root
+    _HDELK_FANOUT = args.hdelk_fanout
     display_customizations = args.hdelk_custom
+    if args.http_cache is not None:
+        set_default_fetcher(HttpFetcher(args.http_cache))
+    # NOTE: CLI doesn't write into user's home unless asked to, so cache is used only if it's location is given
+    render_cache = None
+    if args.no_render_cache:
+        pass
+    elif args.render_cache is not None:
+        render_cache = open_cache(args.render_cache)
+    elif os.environ.get("YAML4SCHM_RENDER_CACHE", "") != "":
+        render_cache = default_cache()
 
     if args.shell:
         # Special shell around top unit is generated
@@ -1746,20 +3054,16 @@ units:
         hunit = None
 
     filepath = guess_filepath(_ROOT_PATH, filepath)
-    data = load_unit(filepath, "", "", {}, None)
-    hdata = load_unit(filepath, "", "", {}, None, yaml_string=hunit)
     tool = args.tool
-    schm = render_unit(tool, hdata, "", is_top=True, custom=hdata)
-    connect(tool, schm, (RENDER_ADD_MISSING_UNITS, RENDER_ADD_MISSING_PORTS))
-    renderer(tool, schm)
-    tool_adaptation(tool, schm)
-    cleanup(schm)
+    unit_type, schm = build(tool, filepath, shell_string=hunit,
+                            cache=render_cache,
+                            budget=BuildBudget.parse(args.budget) if args.budget != "" else None)
     if oformat in ("HTML", "HTML_SNIPPET"):
         snippet_name = None
         if oformat == "HTML_SNIPPET":
             snippet_name = args.snippet_name
         opts = {"width": args.width, "height": args.height, "zoom": args.zoom}
-        result = tool_html(tool, schm, "Schematic of " + data["attributes"].get("type", filepath),
+        result = tool_html(tool, schm, "Schematic of " + unit_type,
                            display_customizations, snippet_name, opts)
     else:
         result = json.dumps(schm, indent=2)
@@ -257,6 +257,10 @@ NET_DEFAULTS = {
     }
 }
 
+# Node through which net with high fan-out is drawn by HDElk (instead of edge per source and target pair)
+HDELK_JUNCTION_DEFAULTS = {"label": "", "port": 1, "width": 6, "height": 6}
+HDELK_JUNCTION_KEYS = ("bus", "color", "highlight", "reverse")     # Net's attributes kept on junction's targets edges
+
 VIEW_NONE = "none"
 VIEW_SYMBOL = "symbol"
 VIEW_FULL = "full"